@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""各图像处理操作、编解码的性能基准测试
+
+每个用例在独立的子进程(spawn)中执行，避免用例之间的缓存和内存占用相互影响；
+记录每个用例的耗时和峰值内存，可以保存为基准结果，之后与基准结果对比找出性能退化的用例。
+
+用法:
+
+    # 保存基准结果
+    python -m benchmarks.run --save benchmarks/baseline.json
+    # 与基准结果对比，耗时增加超过20%或内存增加超过20%的用例视为退化，存在退化时返回1
+    python -m benchmarks.run --compare benchmarks/baseline.json
+    # 只执行名称包含resize的用例
+    python -m benchmarks.run -k resize --sizes m l
+"""
+import typing
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import tempfile
+import multiprocessing
+
+import PIL
+from PIL import Image
+
+from imgprocessor import VERSION
+from imgprocessor.utils import base64url_encode
+
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    # windows 没有 resource 模块，不统计内存
+    resource = None  # type: ignore
+
+
+# 输入图像尺寸
+SIZES = {
+    "s": (640, 480),
+    "m": (1920, 1080),
+    "l": (4000, 3000),
+}
+MODES = ["RGB", "RGBA", "L", "P", "CMYK"]
+# 编码/解码的格式
+FORMATS = ["JPEG", "PNG", "WEBP", "GIF"]
+
+# 每个操作的参数矩阵；{overlay} 会替换成叠加图像路径的base64编码
+ACTIONS = {
+    "resize": [
+        "resize,s_200",
+        "resize,w_1200",
+        "resize,w_1200,fast_1",
+        "resize,s_200,f_bilinear",
+        "resize,p_50",
+        "resize,m_fit,w_300,h_300",
+        "resize,m_pad,w_300,h_300",
+    ],
+    "crop": ["crop,w_300,h_300,g_center", "crop,x_100,y_100,w_400,h_300", "crop,ratio_1:1,g_center"],
+    "circle": ["circle,r_100", "circle,r_4000"],
+    "blur": ["blur,r_3", "blur,r_20", "blur,r_100", "blur,r_100,fast_1"],
+    "rotate": ["rotate,90", "rotate,45"],
+    "alpha": ["alpha,50"],
+    "gray": ["gray"],
+    "watermark": [
+        "watermark,image_{overlay},t_50,g_se",
+        "watermark,image_{overlay},fill_1,padx_50,pady_50",
+        "watermark,text_{text},size_40,g_center",
+    ],
+    "merge": ["merge,image_{overlay},order_1,align_1", "merge,image_{overlay},g_center,bg_1"],
+}
+
+
+def make_image(size: tuple[int, int], mode: str) -> Image.Image:
+    """生成确定的合成图像：渐变 + 噪声，兼顾平坦区域和细节，压缩率接近照片"""
+    w, h = size
+    gradient = Image.linear_gradient("L").resize(size)
+    radial = Image.radial_gradient("L").resize(size)
+    noise = Image.effect_noise(size, 64)
+    im = Image.merge("RGB", (gradient, radial, noise))
+    if mode == "RGBA":
+        im.putalpha(Image.linear_gradient("L").rotate(90).resize(size))
+    elif mode == "P":
+        im = im.quantize(256)
+    elif mode != "RGB":
+        im = im.convert(mode)
+    return im
+
+
+def iter_cases(
+    sizes: typing.Sequence[str], modes: typing.Sequence[str], formats: typing.Sequence[str]
+) -> typing.Generator[dict, None, None]:
+    """生成所有用例，用例名称唯一，用于与基准结果对比"""
+    for size in sizes:
+        w, h = SIZES[size]
+        for mode in modes:
+            suffix = f"{mode} {w}x{h}"
+            for action, param_strs in ACTIONS.items():
+                for param_str in param_strs:
+                    yield {
+                        "name": f"{param_str} {suffix}",
+                        "kind": "action",
+                        "param": param_str,
+                        "size": size,
+                        "mode": mode,
+                    }
+            for fmt in formats:
+                yield {"name": f"encode:{fmt} {suffix}", "kind": "encode", "format": fmt, "size": size, "mode": mode}
+                yield {"name": f"decode:{fmt} {suffix}", "kind": "decode", "format": fmt, "size": size, "mode": mode}
+
+
+def _read_status(key: str) -> typing.Optional[int]:
+    """读取linux中 /proc/self/status 的内存信息，单位字节"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(f"{key}:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss() -> int:
+    """重置当前进程的峰值常驻内存(linux支持)，返回当前的常驻内存，单位字节
+
+    不支持重置时返回当前的峰值，此时只能统计超出之前峰值的部分
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        rss = _read_status("VmRSS")
+        if rss is not None:
+            return rss
+    except OSError:
+        pass
+    return _peak_rss()
+
+
+def _peak_rss() -> int:
+    """当前进程的峰值常驻内存，单位字节"""
+    peak = _read_status("VmHWM")
+    if peak is not None:
+        return peak
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux单位是KB，macOS是字节
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _prepare(
+    case: dict, workdir: str, font: typing.Optional[str]
+) -> tuple[typing.Callable[[typing.Any], typing.Any], typing.Callable[[], typing.Any]]:
+    """准备输入
+
+    Returns:
+        (执行一次用例的函数, 生成该函数参数的函数)；生成参数不计入耗时
+    """
+    from imgprocessor.parsers import ProcessParams
+    from imgprocessor.processor import ProcessorCtr
+
+    im: typing.Any = make_image(SIZES[case["size"]], case["mode"])
+
+    if case["kind"] == "encode":
+        fmt = case["format"]
+        return lambda src: ProcessorCtr.save_img_to_file(src, format=fmt), lambda: im
+
+    if case["kind"] == "decode":
+        data = typing.cast(bytes, ProcessorCtr.save_img_to_file(im, format=case["format"]))
+
+        def decode(fp: io.BytesIO) -> None:
+            with Image.open(fp) as src:
+                src.load()
+
+        return decode, lambda: io.BytesIO(data)
+
+    overlay = os.path.join(workdir, "overlay.png")
+    if not os.path.exists(overlay):
+        make_image((200, 200), "RGBA").save(overlay)
+    param_str = case["param"].format(overlay=base64url_encode(overlay), text=base64url_encode("Hello 世界"))
+    if font and "text_" in param_str:
+        param_str = f"{param_str},font_{base64url_encode(font)}"
+    actions = ProcessParams.parse_str(param_str).actions
+
+    def run(src: typing.Any) -> typing.Any:
+        for parser in actions:
+            src = parser.do_action(src)
+        return src
+
+    if any(parser.IN_PLACE for parser in actions):
+        # 会直接修改输入图像的操作，每次执行前复制输入图像
+        return run, im.copy
+    return run, lambda: im
+
+
+def run_case(case: dict, repeat: int, workdir: str, font: typing.Optional[str] = None) -> dict:
+    """执行一个用例，在子进程中调用
+
+    Returns:
+        {"name": 用例名称, "time": 耗时中位数(秒), "min": 最小耗时(秒), "mem": 执行时增加的峰值内存(字节), "error": 错误信息}
+    """
+    result: dict = {"name": case["name"]}
+    try:
+        func, setup = _prepare(case, workdir, font)
+        # 第一次执行统计内存，同时作为预热不计入耗时
+        arg = setup()
+        before = _reset_peak_rss()
+        func(arg)
+        result["mem"] = max(_peak_rss() - before, 0)
+        times = []
+        for _ in range(repeat):
+            arg = setup()
+            start = time.perf_counter()
+            func(arg)
+            times.append(time.perf_counter() - start)
+        result["time"] = statistics.median(times)
+        result["min"] = min(times)
+    except Exception as e:
+        result["error"] = repr(e)
+    return result
+
+
+def _run_case(args: tuple) -> dict:
+    return run_case(*args)
+
+
+def compare(
+    results: typing.Sequence[dict], baseline: dict, threshold: float = 0.2, mem_threshold: float = 0.2
+) -> list[str]:
+    """与基准结果对比
+
+    Args:
+        results: 本次的执行结果
+        baseline: 基准结果，即 `--save` 保存的内容
+        threshold: 耗时增加超过该比例视为退化
+        mem_threshold: 峰值内存增加超过该比例视为退化
+
+    Returns:
+        退化的用例说明
+    """
+    base_cases = {case["name"]: case for case in baseline.get("cases", [])}
+    regressions = []
+    for result in results:
+        base = base_cases.get(result["name"])
+        if not base or "error" in base:
+            continue
+        if "error" in result:
+            regressions.append(f"{result['name']}: 基准结果正常，本次执行失败 {result['error']}")
+            continue
+        if base["time"] and result["time"] > base["time"] * (1 + threshold):
+            regressions.append(
+                f"{result['name']}: 耗时 {base['time'] * 1000:.2f}ms -> {result['time'] * 1000:.2f}ms "
+                f"(+{(result['time'] / base['time'] - 1) * 100:.0f}%)"
+            )
+        # 内存统计的精度有限，忽略1MB以内的变化
+        if result["mem"] > max(base["mem"] * (1 + mem_threshold), base["mem"] + 1024 * 1024):
+            regressions.append(
+                f"{result['name']}: 峰值内存 {base['mem'] / 1024 / 1024:.1f}MB -> {result['mem'] / 1024 / 1024:.1f}MB"
+            )
+    return regressions
+
+
+def environment() -> dict:
+    return {
+        "imgprocessor": VERSION,
+        "pillow": PIL.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+    }
+
+
+def main(argv: typing.Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run", description="图像处理性能基准测试")
+    parser.add_argument("-k", "--keyword", type=str, help="只执行名称包含该字符串的用例")
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=["s", "m"], help="输入图像尺寸")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES, help="输入图像模式")
+    parser.add_argument("--formats", nargs="+", choices=FORMATS, default=FORMATS, help="编码/解码的格式")
+    parser.add_argument("--repeat", type=int, default=5, help="每个用例计时的执行次数，取中位数")
+    parser.add_argument("--font", type=str, help="文字水印使用的字体，默认为 settings.PROCESSOR_TEXT_FONT")
+    parser.add_argument("--save", type=str, help="保存结果为基准结果的json文件路径")
+    parser.add_argument("--compare", type=str, help="对比的基准结果json文件路径")
+    parser.add_argument("--threshold", type=float, default=0.2, help="耗时增加超过该比例视为退化")
+    parser.add_argument("--mem-threshold", type=float, default=0.2, help="峰值内存增加超过该比例视为退化")
+    parser.add_argument("--no-isolate", action="store_true", help="在当前进程中执行所有用例，不统计内存")
+    args = parser.parse_args(argv)
+
+    cases = [
+        case
+        for case in iter_cases(args.sizes, args.modes, args.formats)
+        if not args.keyword or args.keyword in case["name"]
+    ]
+    print(json.dumps(environment(), ensure_ascii=False), flush=True)
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        tasks = [(case, args.repeat, workdir, args.font) for case in cases]
+        if args.no_isolate:
+            iterator: typing.Iterator[dict] = map(_run_case, tasks)
+        else:
+            # 每个用例一个新的子进程，峰值内存互不影响
+            pool = multiprocessing.get_context("spawn").Pool(1, maxtasksperchild=1)
+            iterator = pool.imap(_run_case, tasks)
+        for result in iterator:
+            results.append(result)
+            if "error" in result:
+                print(f"{result['name']:<60} 失败：{result['error']}", flush=True)
+            else:
+                print(
+                    f"{result['name']:<60} {result['time'] * 1000:>10.2f}ms {result['mem'] / 1024 / 1024:>8.1f}MB",
+                    flush=True,
+                )
+        if not args.no_isolate:
+            pool.close()
+            pool.join()
+
+    if args.no_isolate:
+        # 同一个进程中内存统计不准确
+        for result in results:
+            result["mem"] = 0
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"env": environment(), "cases": results}, f, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("env") != environment():
+            print(f"基准结果的运行环境不同：{json.dumps(baseline.get('env'), ensure_ascii=False)}", flush=True)
+        regressions = compare(results, baseline, threshold=args.threshold, mem_threshold=args.mem_threshold)
+        for msg in regressions:
+            print(f"\033[31m{msg}\033[0m", file=sys.stderr, flush=True)
+        print(f"对比基准结果：{len(regressions)} 个用例退化", flush=True)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
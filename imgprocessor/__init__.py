@@ -7,7 +7,7 @@ from PIL import Image
 
 
 __all__ = ["settings", "VERSION"]
-__version__ = "1.3.3"
+__version__ = "1.4.0"
 
 
 VERSION = __version__
@@ -49,6 +49,48 @@ class SettingsProxy(object):
     PROCESSOR_ALLOW_DOMAINS = ()
     # 临时文件目录
     PROCESSOR_TEMP_DIR = None
+    # JPEG图像在缩小场景下使用draft模式(DCT缩放)解码，减少解码耗时和内存
+    PROCESSOR_USE_DRAFT = True
+    # 执行前优化图像处理操作：去掉无效操作、合并连续的缩放/裁剪等
+    PROCESSOR_OPTIMIZE_ACTIONS = True
+    # 处理操作不改变像素、输出格式和质量与输入一致时，直接输出输入图像的原始内容，不再解码和编码
+    PROCESSOR_PASSTHROUGH = True
+    # 下载链接资源的超时时间，单位秒
+    PROCESSOR_HTTP_TIMEOUT = 10
+    # 下载链接资源遇到连接错误或5xx响应时的重试次数
+    PROCESSOR_HTTP_RETRIES = 2
+    # 下载链接资源时每个域名保持的空闲连接数
+    PROCESSOR_HTTP_POOL_SIZE = 10
+    # 链接资源的磁盘缓存目录，为空则不缓存
+    PROCESSOR_HTTP_CACHE_DIR = None
+    # 链接资源磁盘缓存的大小限制，单位 MB
+    PROCESSOR_HTTP_CACHE_SIZE = 1024
+    # 解码后的水印/合并图像在内存中的缓存大小(按像素数据计算)，单位 MB；0表示不缓存
+    PROCESSOR_OVERLAY_CACHE_SIZE = 128
+    # 没有ETag/Last-Modified、也没有Cache-Control有效期的链接水印/合并图像，在内存缓存中的有效期，单位秒
+    PROCESSOR_OVERLAY_CACHE_TTL = 60
+    # 缓存已加载的字体(字体文件+字号)的数量；0表示不缓存
+    PROCESSOR_FONT_CACHE_SIZE = 32
+    # 缓存最终粘贴到图像上的水印(按水印参数和输入图像大小)的大小(按像素数据计算)，单位 MB；0表示不缓存
+    PROCESSOR_MARK_CACHE_SIZE = 64
+    # 缓存圆角遮罩(按半径)的大小(按像素数据计算)，单位 MB；0表示不缓存
+    PROCESSOR_CIRCLE_CACHE_SIZE = 16
+    # 缓存编译后的图像处理参数(参数字符串)的数量；0表示不缓存
+    PROCESSOR_PLAN_CACHE_SIZE = 1024
+    # 图像处理结果的内存缓存大小，单位 MB；0表示不使用内存缓存
+    PROCESSOR_RESULT_CACHE_MEMORY_SIZE = 0
+    # 图像处理结果的磁盘缓存目录，为空表示不使用磁盘缓存
+    PROCESSOR_RESULT_CACHE_DIR = None
+    # 图像处理结果的磁盘缓存大小，单位 MB
+    PROCESSOR_RESULT_CACHE_DISK_SIZE = 1024
+    # 异步接口执行解码、处理和编码的线程数，为空时使用CPU核数
+    PROCESSOR_ASYNC_WORKERS = None
+    # 异步接口同时提交到线程池的最大任务数，超出时等待；为空时是线程数的2倍
+    PROCESSOR_ASYNC_MAX_PENDING = None
+    # 进程内同时处理的图像预计占用内存之和的上限，单位 MB；超出时排队等待，单个图像超出时直接失败；0表示不限制
+    PROCESSOR_MEMORY_BUDGET = 0
+    # 等待内存预算的最长时间，单位秒；0表示不等待直接失败，None表示一直等待
+    PROCESSOR_MEMORY_BUDGET_TIMEOUT = 30
 
     def __getattribute__(self, attr: str) -> typing.Any:
         try:
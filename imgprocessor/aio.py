@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# coding=utf-8
+import typing
+import os
+import asyncio
+import threading
+import functools
+import weakref
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from imgprocessor import settings, processor
+from imgprocessor.parsers import BaseParser, ProcessParams, CompiledParams, compile_params
+from imgprocessor.parsers.base import is_url, download_im, load_overlay, overlay_scope
+
+
+T = typing.TypeVar("T")
+
+
+class AsyncProcessor(object):
+    """异步图像处理
+
+    - 输入图像和 `watermark`/`merge` 的链接地址在IO线程中并发下载，不阻塞事件循环；
+    - 解码、处理和编码在有界的线程池中执行(Pillow 在解码、缩放、编码等操作中会释放GIL)；
+    - 提交到线程池的任务数达到上限时，调用方等待，不会无限堆积任务；
+    - 协程被取消后，线程中的处理在下一个操作开始前中断。
+    """
+
+    def __init__(
+        self,
+        max_workers: typing.Optional[int] = None,
+        max_pending: typing.Optional[int] = None,
+        io_workers: typing.Optional[int] = None,
+    ) -> None:
+        """
+        Args:
+            max_workers: 执行解码、处理和编码的线程数，默认为 `settings.PROCESSOR_ASYNC_WORKERS`
+            max_pending: 同时提交到线程池的最大任务数(包括执行中和排队中)，默认为 `settings.PROCESSOR_ASYNC_MAX_PENDING`
+            io_workers: 下载使用的线程数，默认为 `settings.PROCESSOR_HTTP_POOL_SIZE`
+        """
+        self.max_workers = max_workers or settings.PROCESSOR_ASYNC_WORKERS or os.cpu_count() or 1
+        self.max_pending = max_pending or settings.PROCESSOR_ASYNC_MAX_PENDING or self.max_workers * 2
+        self.executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="imgprocessor")
+        self.io_executor = ThreadPoolExecutor(
+            io_workers or settings.PROCESSOR_HTTP_POOL_SIZE, thread_name_prefix="imgprocessor-io"
+        )
+        # asyncio.Semaphore 只能在一个事件循环中使用，每个事件循环一个
+        self._semaphores: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore] = (
+            weakref.WeakKeyDictionary()
+        )
+        self._lock = threading.Lock()
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            semaphore = self._semaphores.get(loop)
+            if semaphore is None:
+                semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_pending)
+        return semaphore
+
+    async def run(self, func: typing.Callable[..., T], *args: typing.Any, **kwargs: typing.Any) -> T:
+        """在线程池中执行 `func(*args, check=check, **kwargs)`
+
+        提交的任务数达到 `max_pending` 时等待其他任务完成；
+        协程被取消后，`check` 会抛出 `concurrent.futures.CancelledError`，`func` 应在每个操作之前调用 `check`。
+        """
+        semaphore = self._get_semaphore()
+        await semaphore.acquire()
+        cancelled = threading.Event()
+
+        def check() -> None:
+            if cancelled.is_set():
+                raise concurrent.futures.CancelledError()
+
+        def on_done(fut: asyncio.Future) -> None:
+            # 线程中的任务结束后才释放，取消后仍在执行的任务也占用名额
+            semaphore.release()
+            if not fut.cancelled():
+                # 取消后任务的异常没有调用方获取，避免输出 "exception was never retrieved"
+                fut.exception()
+
+        loop = asyncio.get_running_loop()
+        try:
+            fut = loop.run_in_executor(self.executor, functools.partial(func, *args, check=check, **kwargs))
+        except BaseException:
+            semaphore.release()
+            raise
+        fut.add_done_callback(on_done)
+        try:
+            return await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    async def fetch(
+        self, uri: typing.Union[str, bytes, bytearray, memoryview, typing.BinaryIO]
+    ) -> typing.Union[str, bytes, bytearray, memoryview, typing.BinaryIO]:
+        """链接地址在IO线程中下载到内存，其他输入原样返回"""
+        if isinstance(uri, str) and is_url(uri):
+            loop = asyncio.get_running_loop()
+            fp = await loop.run_in_executor(self.io_executor, download_im, uri)
+            return fp.getvalue()
+        return uri
+
+    async def prefetch_overlays(self, actions: typing.Sequence[BaseParser]) -> dict:
+        """在IO线程中并发下载(或重新验证) `watermark`/`merge` 中链接地址的图像
+
+        Returns:
+            {链接地址: `load_overlay` 的返回值}，传递给 `overlay_scope` 后处理时直接使用，不再下载或重新验证
+        """
+        uris = list(dict.fromkeys(uri for uri in processor.iter_overlay_uris(actions) if is_url(uri)))
+        if not uris:
+            return {}
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*(loop.run_in_executor(self.io_executor, load_overlay, uri) for uri in uris))
+        return dict(zip(uris, results))
+
+    async def process_image(
+        self,
+        input_uri: typing.Union[str, bytes, bytearray, memoryview, typing.BinaryIO],
+        params: typing.Union[CompiledParams, ProcessParams, dict, str],
+        out_path: typing.Optional[typing.Union[str, os.PathLike, typing.BinaryIO]] = None,
+        **kwargs: typing.Any,
+    ) -> typing.Optional[typing.ByteString]:
+        """同 `processor.process_image`"""
+        params_obj = compile_params(params)
+        input_uri, overlays = await asyncio.gather(self.fetch(input_uri), self.prefetch_overlays(params_obj.actions))
+        return await self.run(
+            _with_overlays, overlays, processor.process_image, input_uri, params_obj, out_path=out_path, **kwargs
+        )
+
+    async def process_image_multi(
+        self,
+        input_uri: typing.Union[str, bytes, bytearray, memoryview, typing.BinaryIO],
+        params_list: typing.Sequence[typing.Union[CompiledParams, ProcessParams, dict, str]],
+        out_paths: typing.Optional[
+            typing.Sequence[typing.Optional[typing.Union[str, os.PathLike, typing.BinaryIO]]]
+        ] = None,
+        **kwargs: typing.Any,
+    ) -> list[typing.Optional[typing.ByteString]]:
+        """同 `processor.process_image_multi`"""
+        plans = [compile_params(params) for params in params_list]
+        actions = [parser for plan in plans for parser in plan.actions]
+        input_uri, overlays = await asyncio.gather(self.fetch(input_uri), self.prefetch_overlays(actions))
+        return await self.run(
+            _with_overlays, overlays, processor.process_image_multi, input_uri, plans, out_paths=out_paths, **kwargs
+        )
+
+    async def extract_main_color(
+        self,
+        img_path: typing.Union[str, bytes, typing.BinaryIO, Image.Image],
+        delta_h: float = 0.3,
+        sample_size: int = 512,
+    ) -> str:
+        """同 `processor.extract_main_color`"""
+        if isinstance(img_path, str) and is_url(img_path):
+            loop = asyncio.get_running_loop()
+            img_path = (await loop.run_in_executor(self.io_executor, download_im, img_path)).getvalue()
+        return await self.run(_extract_main_color, img_path, delta_h=delta_h, sample_size=sample_size)
+
+    def close(self) -> None:
+        """关闭线程池，不等待执行中的任务"""
+        self.executor.shutdown(wait=False)
+        self.io_executor.shutdown(wait=False)
+
+
+def _with_overlays(overlays: dict, func: typing.Callable[..., T], *args: typing.Any, **kwargs: typing.Any) -> T:
+    """在线程池中使用预先下载的叠加图像执行 `func`，see `AsyncProcessor.prefetch_overlays`"""
+    with overlay_scope(overlays):
+        return func(*args, **kwargs)
+
+
+def _extract_main_color(
+    img_path: typing.Union[str, bytes, typing.BinaryIO, Image.Image],
+    delta_h: float,
+    sample_size: int,
+    check: typing.Callable[[], None],
+) -> str:
+    check()
+    return processor.extract_main_color(img_path, delta_h=delta_h, sample_size=sample_size)
+
+
+_processor: typing.Optional[AsyncProcessor] = None
+_processor_lock = threading.Lock()
+
+
+def get_async_processor() -> AsyncProcessor:
+    """获取异步接口默认使用的 `AsyncProcessor`，按settings配置创建"""
+    global _processor
+    if _processor is None:
+        with _processor_lock:
+            if _processor is None:
+                _processor = AsyncProcessor()
+    return _processor
+
+
+def set_async_processor(async_processor: typing.Optional[AsyncProcessor]) -> None:
+    """替换异步接口默认使用的 `AsyncProcessor`；传入None时，下次使用时按settings重新创建"""
+    global _processor
+    with _processor_lock:
+        old, _processor = _processor, async_processor
+    if old is not None and old is not async_processor:
+        old.close()
+
+
+async def process_image_async(
+    input_uri: typing.Union[str, bytes, bytearray, memoryview, typing.BinaryIO],
+    params: typing.Union[CompiledParams, ProcessParams, dict, str],
+    out_path: typing.Optional[typing.Union[str, os.PathLike, typing.BinaryIO]] = None,
+    **kwargs: typing.Any,
+) -> typing.Optional[typing.ByteString]:
+    """异步处理图像，参数和返回值同 `processor.process_image`
+
+    Raises:
+        ProcessLimitException: 超过处理限制会抛出异常
+    """
+    return await get_async_processor().process_image(input_uri, params, out_path=out_path, **kwargs)
+
+
+async def process_image_multi_async(
+    input_uri: typing.Union[str, bytes, bytearray, memoryview, typing.BinaryIO],
+    params_list: typing.Sequence[typing.Union[CompiledParams, ProcessParams, dict, str]],
+    out_paths: typing.Optional[
+        typing.Sequence[typing.Optional[typing.Union[str, os.PathLike, typing.BinaryIO]]]
+    ] = None,
+    **kwargs: typing.Any,
+) -> list[typing.Optional[typing.ByteString]]:
+    """异步处理图像输出多个图像，参数和返回值同 `processor.process_image_multi`"""
+    return await get_async_processor().process_image_multi(input_uri, params_list, out_paths=out_paths, **kwargs)
+
+
+async def extract_main_color_async(
+    img_path: typing.Union[str, bytes, typing.BinaryIO, Image.Image], delta_h: float = 0.3, sample_size: int = 512
+) -> str:
+    """异步获取图像主色调，参数和返回值同 `processor.extract_main_color`"""
+    return await get_async_processor().extract_main_color(img_path, delta_h=delta_h, sample_size=sample_size)
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+# coding=utf-8
+import typing
+
+import os
+import json
+import struct
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+from imgprocessor import settings
+
+
+# 缓存文件头：4字节元数据长度 + json格式的元数据，之后是缓存内容
+_HEADER = struct.Struct(">I")
+
+
+class LRUCache(object):
+    """线程安全的内存缓存，按条目大小之和限制容量，超出时淘汰最久未使用的条目"""
+
+    def __init__(self, max_size: int, sizeof: typing.Optional[typing.Callable[[typing.Any], int]] = None) -> None:
+        """
+        Args:
+            max_size: 缓存容量，即所有条目大小之和的上限；0表示不缓存
+            sizeof: 计算条目大小的函数，默认每个条目大小为1(即按条目数量限制)
+        """
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda value: 1)
+        self._data: OrderedDict[typing.Hashable, tuple[typing.Any, int]] = OrderedDict()
+        self._lock = threading.RLock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: typing.Hashable, default: typing.Any = None) -> typing.Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key: typing.Hashable, value: typing.Any) -> None:
+        size = self.sizeof(value)
+        with self._lock:
+            self._remove(key)
+            if size > self.max_size:
+                return
+            self._data[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def pop(self, key: typing.Hashable) -> None:
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key: typing.Hashable) -> None:
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.size -= item[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "count": len(self._data),
+                "size": self.size,
+                "max_size": self.max_size,
+            }
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: typing.Hashable) -> bool:
+        return key in self._data
+
+
+class DiskCache(object):
+    """磁盘缓存，按占用字节数限制大小，超出时淘汰最久未使用的条目
+
+    - 每个条目是一个文件，文件头保存元数据，写入时先写临时文件再原子替换，支持多线程/多进程并发写入；
+    - 读取命中时更新文件的修改时间，淘汰时按修改时间从旧到新删除；
+    """
+
+    def __init__(self, directory: str, max_size: int) -> None:
+        """
+        Args:
+            directory: 缓存目录，不存在会自动创建
+            max_size: 缓存占用的最大字节数
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # 当前进程估算的缓存大小，None表示还未统计
+        self._size: typing.Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _path(self, key: str) -> str:
+        name = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.directory, name[:2], name)
+
+    def get(self, key: str) -> typing.Optional[tuple[dict, typing.BinaryIO]]:
+        """读取缓存
+
+        Returns:
+            (元数据, 已定位到缓存内容起始位置的文件对象)，使用完需要close；未命中返回None
+        """
+        path = self._path(key)
+        try:
+            fp = open(path, "rb")
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            (length,) = _HEADER.unpack(fp.read(_HEADER.size))
+            meta = json.loads(fp.read(length))
+            if meta.get("key") != key:
+                raise ValueError("hash collision")
+            os.utime(path)
+        except Exception:
+            fp.close()
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return meta, fp
+
+    def get_bytes(self, key: str) -> typing.Optional[tuple[dict, bytes]]:
+        """读取缓存，直接返回缓存内容"""
+        ret = self.get(key)
+        if ret is None:
+            return None
+        meta, fp = ret
+        with fp:
+            return meta, fp.read()
+
+    def writer(self, key: str, meta: dict) -> "DiskCacheWriter":
+        """流式写入缓存，调用 `commit` 后才会生效"""
+        return DiskCacheWriter(self, key, meta)
+
+    def set(self, key: str, meta: dict, data: typing.Union[bytes, memoryview]) -> None:
+        with self.writer(key, meta) as writer:
+            writer.write(data)
+            writer.commit()
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self) -> None:
+        for path, _, _ in self._iter_files():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self._lock:
+            self._size = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": self._size,
+                "max_size": self.max_size,
+            }
+
+    def _iter_files(self) -> typing.Generator[tuple[str, int, float], None, None]:
+        if not os.path.isdir(self.directory):
+            return
+        for sub in os.scandir(self.directory):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith(".tmp"):
+                    # 正在写入的临时文件，不统计也不淘汰
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                yield entry.path, stat.st_size, stat.st_mtime
+
+    def _add_size(self, size: int) -> None:
+        with self._lock:
+            if self._size is None:
+                self._size = sum(s for _, s, _ in self._iter_files())
+            else:
+                self._size += size
+            if self._size <= self.max_size:
+                return
+            # 超出限制，重新统计(其他进程也可能写入)并淘汰最久未使用的条目
+            files = sorted(self._iter_files(), key=lambda x: x[2])
+            total = sum(s for _, s, _ in files)
+            for path, s, _ in files:
+                if total <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= s
+                self.evictions += 1
+            self._size = total
+
+
+class DiskCacheWriter(object):
+    """先写入同目录下的临时文件，commit时原子替换成缓存文件；未commit则丢弃"""
+
+    def __init__(self, cache: DiskCache, key: str, meta: dict) -> None:
+        self.cache = cache
+        self.key = key
+        self.path = cache._path(key)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd, self.tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix=".tmp")
+        self.fp = os.fdopen(fd, "wb")
+        header = json.dumps(dict(meta, key=key)).encode()
+        self.fp.write(_HEADER.pack(len(header)))
+        self.fp.write(header)
+        self.size = _HEADER.size + len(header)
+        self.done = False
+
+    def write(self, data: typing.Union[bytes, memoryview]) -> None:
+        self.fp.write(data)
+        self.size += len(data)
+
+    def commit(self) -> None:
+        if self.done:
+            return
+        self.done = True
+        self.fp.close()
+        if self.size > self.cache.max_size:
+            os.remove(self.tmp_path)
+            return
+        try:
+            os.replace(self.tmp_path, self.path)
+        except OSError:
+            # 临时文件被其他进程删除等，当作未缓存
+            try:
+                os.remove(self.tmp_path)
+            except OSError:
+                pass
+            return
+        self.cache._add_size(self.size)
+
+    def discard(self) -> None:
+        if self.done:
+            return
+        self.done = True
+        self.fp.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+    def __enter__(self) -> "DiskCacheWriter":
+        return self
+
+    def __exit__(self, *args: typing.Any) -> None:
+        self.discard()
+
+
+class TieredCache(object):
+    """内存 + 磁盘两级缓存，缓存内容是bytes；读取时先读内存，磁盘命中后放入内存"""
+
+    def __init__(self, memory_size: int, directory: typing.Optional[str] = None, disk_size: int = 0) -> None:
+        """
+        Args:
+            memory_size: 内存缓存的大小限制，单位字节；0表示不使用内存缓存
+            directory: 磁盘缓存目录，为空表示不使用磁盘缓存
+            disk_size: 磁盘缓存的大小限制，单位字节
+        """
+        self.memory = LRUCache(memory_size, sizeof=len)
+        self.disk = DiskCache(directory, disk_size) if directory else None
+
+    def get(self, key: str) -> typing.Optional[bytes]:
+        data = self.memory.get(key)
+        if data is not None:
+            return data
+        if self.disk is None:
+            return None
+        ret = self.disk.get_bytes(key)
+        if ret is None:
+            return None
+        data = ret[1]
+        self.memory.set(key, data)
+        return data
+
+    def set(self, key: str, data: bytes) -> None:
+        self.memory.set(key, data)
+        if self.disk is not None:
+            self.disk.set(key, {}, data)
+
+    def clear(self) -> None:
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self) -> dict:
+        return {
+            "memory": self.memory.stats(),
+            "disk": self.disk.stats() if self.disk is not None else None,
+        }
+
+
+_result_cache: typing.Optional[TieredCache] = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache() -> typing.Optional[TieredCache]:
+    """获取图像处理结果的缓存，按settings配置创建；未配置时返回None"""
+    global _result_cache
+    if _result_cache is None:
+        memory_size = settings.PROCESSOR_RESULT_CACHE_MEMORY_SIZE * 1024 * 1024
+        directory = settings.PROCESSOR_RESULT_CACHE_DIR
+        if not memory_size and not directory:
+            return None
+        with _result_cache_lock:
+            if _result_cache is None:
+                _result_cache = TieredCache(
+                    memory_size, directory, settings.PROCESSOR_RESULT_CACHE_DISK_SIZE * 1024 * 1024
+                )
+    return _result_cache
+
+
+def set_result_cache(cache: typing.Optional[TieredCache]) -> None:
+    """替换图像处理结果的缓存；传入None时，下次使用时按settings重新创建"""
+    global _result_cache
+    with _result_cache_lock:
+        _result_cache = cache
@@ -54,6 +54,17 @@ class ResizeMode(ChoiceEnum):
     FIXED = ("fixed", "固定宽高，强制缩放")
 
 
+class ResizeFilter(ChoiceEnum):
+    """图像缩放的插值算法，按速度从快到慢、质量从低到高排列"""
+
+    NEAREST = ("nearest", "最近邻，最快，缩小时有锯齿，适合像素风格的图像")
+    BOX = ("box", "区域平均，缩小时接近bilinear的质量")
+    BILINEAR = ("bilinear", "双线性插值")
+    HAMMING = ("hamming", "Hamming窗，缩小时比bilinear更清晰")
+    BICUBIC = ("bicubic", "双三次插值")
+    LANCZOS = ("lanczos", "Lanczos插值，最慢，质量最好")
+
+
 class ArgType(ChoiceEnum):
     STRING = ("str", "字符串")
     INTEGER = ("int", "整数")
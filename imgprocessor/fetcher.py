@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+# coding=utf-8
+import typing
+
+import io
+import os
+import ssl
+import time
+import threading
+import http.client
+import urllib.parse
+import urllib.error
+import email.utils
+
+from imgprocessor import settings, VERSION
+from imgprocessor.cache import DiskCache, DiskCacheWriter
+from imgprocessor.exceptions import ParamValidateException
+
+
+_REDIRECT_STATUS = (301, 302, 303, 307, 308)
+# 服务端临时错误，可重试
+_RETRY_STATUS = (500, 502, 503, 504)
+# 重试前等待的时间，单位秒；每次重试翻倍
+_RETRY_BACKOFF = 0.1
+
+
+class FetchResponse(object):
+    """链接资源的响应，可以像文件对象一样读取内容
+
+    Attributes:
+        url: 最终的链接地址(跟随跳转后)
+        status: 200表示有内容；304表示调用方传入的ETag/Last-Modified仍有效，没有内容
+        etag: 响应的ETag
+        last_modified: 响应的Last-Modified
+        content_length: 内容大小，未知为None
+        from_cache: 内容是否来自磁盘缓存
+    """
+
+    def __init__(
+        self,
+        url: str,
+        status: int,
+        headers: dict,
+        fp: typing.Any,
+        on_close: typing.Optional[typing.Callable[[bool], None]] = None,
+        writer: typing.Optional[DiskCacheWriter] = None,
+        content_length: typing.Optional[int] = None,
+        from_cache: bool = False,
+    ) -> None:
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.etag: typing.Optional[str] = headers.get("etag")
+        self.last_modified: typing.Optional[str] = headers.get("last-modified")
+        self.content_length = content_length
+        self.from_cache = from_cache
+        self._fp = fp
+        self._on_close = on_close
+        self._writer = writer
+        self._eof = False
+        self.closed = False
+
+    @property
+    def not_modified(self) -> bool:
+        return self.status == 304
+
+    @property
+    def max_age(self) -> typing.Optional[float]:
+        """按响应的Cache-Control/Expires计算的缓存有效期，单位秒；None表示不允许缓存"""
+        return _parse_max_age(self.headers)
+
+    def read(self, size: int = -1) -> bytes:
+        if self._eof:
+            return b""
+        data = self._fp.read() if size is None or size < 0 else self._fp.read(size)
+        if self._writer is not None and data:
+            self._writer.write(data)
+        if not data or size is None or size < 0 or getattr(self._fp, "isclosed", lambda: False)():
+            self._eof = True
+        return data
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        if self._writer is not None:
+            # 完整读取后才写入缓存
+            if self._eof:
+                self._writer.commit()
+            else:
+                self._writer.discard()
+        self._fp.close()
+        if self._on_close is not None:
+            self._on_close(self._eof)
+
+    def __enter__(self) -> "FetchResponse":
+        return self
+
+    def __exit__(self, *args: typing.Any) -> None:
+        self.close()
+
+
+class BaseFetcher(object):
+    """下载链接资源，可通过 `set_fetcher` 替换成自定义实现"""
+
+    def open(
+        self, url: str, etag: typing.Optional[str] = None, last_modified: typing.Optional[str] = None
+    ) -> FetchResponse:
+        """下载链接资源
+
+        Args:
+            url: 链接地址
+            etag: 调用方已有内容的ETag，仍有效时返回304
+            last_modified: 调用方已有内容的Last-Modified，仍有效时返回304
+
+        Raises:
+            urllib.error.HTTPError: 响应状态码错误
+            OSError: 网络错误
+
+        Returns:
+            响应对象，使用完需要close
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+def is_allowed_domain(domain: str) -> bool:
+    """域名是否在 `settings.PROCESSOR_ALLOW_DOMAINS` 范围内，未配置时不限制"""
+    allow_domains = settings.PROCESSOR_ALLOW_DOMAINS
+    return not allow_domains or domain.endswith(tuple(allow_domains))
+
+
+def _parse_max_age(headers: dict) -> typing.Optional[float]:
+    """解析响应的缓存有效期，单位秒；None表示不允许缓存"""
+    cache_control = [v.strip().lower() for v in headers.get("cache-control", "").split(",")]
+    if "no-store" in cache_control:
+        return None
+    if "no-cache" in cache_control:
+        return 0
+    for v in cache_control:
+        if v.startswith("max-age="):
+            try:
+                return max(0, int(v[8:]))
+            except ValueError:
+                return 0
+    if headers.get("expires"):
+        try:
+            return max(0, email.utils.parsedate_to_datetime(headers["expires"]).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return 0
+    return 0
+
+
+def _validators_match(meta: dict, etag: typing.Optional[str], last_modified: typing.Optional[str]) -> bool:
+    if etag:
+        return etag == meta.get("etag")
+    if last_modified:
+        return last_modified == meta.get("last_modified")
+    return False
+
+
+class HttpFetcher(BaseFetcher):
+    """基于http.client的下载器
+
+    - 按域名复用keep-alive连接；
+    - 连接错误和5xx响应自动重试，自动跟随跳转；
+    - 设置了缓存目录时，将响应缓存到磁盘，按照Cache-Control判断是否过期，过期后用ETag/Last-Modified重新验证；
+    """
+
+    def __init__(
+        self,
+        timeout: typing.Optional[float] = None,
+        retries: typing.Optional[int] = None,
+        pool_size: typing.Optional[int] = None,
+        cache_dir: typing.Optional[str] = None,
+        cache_size: typing.Optional[int] = None,
+        max_redirects: int = 5,
+    ) -> None:
+        """
+        Args:
+            timeout: 连接和读取的超时时间，单位秒；默认 `settings.PROCESSOR_HTTP_TIMEOUT`
+            retries: 重试次数；默认 `settings.PROCESSOR_HTTP_RETRIES`
+            pool_size: 每个域名保持的空闲连接数；默认 `settings.PROCESSOR_HTTP_POOL_SIZE`
+            cache_dir: 磁盘缓存目录；默认 `settings.PROCESSOR_HTTP_CACHE_DIR`，为空不缓存
+            cache_size: 磁盘缓存大小限制，单位MB；默认 `settings.PROCESSOR_HTTP_CACHE_SIZE`
+            max_redirects: 最多跟随跳转的次数
+        """
+        self.timeout = settings.PROCESSOR_HTTP_TIMEOUT if timeout is None else timeout
+        self.retries = settings.PROCESSOR_HTTP_RETRIES if retries is None else retries
+        self.pool_size = settings.PROCESSOR_HTTP_POOL_SIZE if pool_size is None else pool_size
+        self.max_redirects = max_redirects
+        cache_dir = cache_dir or settings.PROCESSOR_HTTP_CACHE_DIR
+        cache_size = settings.PROCESSOR_HTTP_CACHE_SIZE if cache_size is None else cache_size
+        self.cache = DiskCache(cache_dir, cache_size * 1024 * 1024) if cache_dir else None
+        self._lock = threading.Lock()
+        self._pool: dict[tuple, list[http.client.HTTPConnection]] = {}
+        self._pid = os.getpid()
+        self._ssl_context: typing.Optional[ssl.SSLContext] = None
+
+    def open(
+        self, url: str, etag: typing.Optional[str] = None, last_modified: typing.Optional[str] = None
+    ) -> FetchResponse:
+        cached = self.cache.get(url) if self.cache else None
+        if cached is not None:
+            meta, fp = cached
+            if meta.get("expires", 0) > time.time():
+                return self._from_cache(url, meta, fp, etag, last_modified)
+            # 缓存已过期，用缓存的验证信息重新验证
+            headers = self._conditional_headers(meta.get("etag"), meta.get("last_modified"))
+        else:
+            headers = self._conditional_headers(etag, last_modified)
+
+        try:
+            resp, release, final_url = self._request(url, headers)
+        except BaseException:
+            if cached is not None:
+                cached[1].close()
+            raise
+        resp_headers = {k.lower(): v for k, v in resp.getheaders()}
+
+        if resp.status == 304:
+            resp.read()
+            release(True)
+            if cached is None:
+                return FetchResponse(final_url, 304, resp_headers, io.BytesIO())
+            # 缓存仍有效，更新有效期
+            meta, fp = cached
+            with fp:
+                data = fp.read()
+            max_age = _parse_max_age(resp_headers)
+            meta["expires"] = time.time() + (max_age or 0)
+            assert self.cache is not None
+            self.cache.set(url, meta, data)
+            return self._from_cache(url, meta, io.BytesIO(data), etag, last_modified, content_length=len(data))
+
+        if cached is not None:
+            cached[1].close()
+        if not 200 <= resp.status < 300:
+            body = resp.read()
+            release(True)
+            raise urllib.error.HTTPError(final_url, resp.status, resp.reason, resp.msg, io.BytesIO(body))
+
+        content_length = resp_headers.get("content-length")
+        writer = None
+        max_age = _parse_max_age(resp_headers)
+        if (
+            self.cache is not None
+            and resp.status == 200
+            and max_age is not None
+            and (max_age > 0 or resp_headers.get("etag") or resp_headers.get("last-modified"))
+            and (content_length is None or int(content_length) <= self.cache.max_size)
+        ):
+            meta = {
+                "url": final_url,
+                "etag": resp_headers.get("etag"),
+                "last_modified": resp_headers.get("last-modified"),
+                "expires": time.time() + max_age,
+            }
+            writer = self.cache.writer(url, meta)
+        return FetchResponse(
+            final_url,
+            resp.status,
+            resp_headers,
+            resp,
+            on_close=release,
+            writer=writer,
+            content_length=int(content_length) if content_length else None,
+        )
+
+    def _from_cache(
+        self,
+        url: str,
+        meta: dict,
+        fp: typing.BinaryIO,
+        etag: typing.Optional[str],
+        last_modified: typing.Optional[str],
+        content_length: typing.Optional[int] = None,
+    ) -> FetchResponse:
+        headers = {"etag": meta.get("etag"), "last-modified": meta.get("last_modified")}
+        if _validators_match(meta, etag, last_modified):
+            fp.close()
+            return FetchResponse(meta.get("url") or url, 304, headers, io.BytesIO(), from_cache=True)
+        if content_length is None:
+            content_length = os.fstat(fp.fileno()).st_size - fp.tell()
+        return FetchResponse(meta.get("url") or url, 200, headers, fp, content_length=content_length, from_cache=True)
+
+    @staticmethod
+    def _conditional_headers(etag: typing.Optional[str], last_modified: typing.Optional[str]) -> dict:
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def _request(self, url: str, headers: dict) -> tuple[http.client.HTTPResponse, typing.Callable, str]:
+        """发送请求，跟随跳转；跳转的域名同样需要在 `settings.PROCESSOR_ALLOW_DOMAINS` 范围内"""
+        for _ in range(self.max_redirects + 1):
+            resp, release = self._send(url, headers)
+            location = resp.getheader("Location")
+            if resp.status not in _REDIRECT_STATUS or not location:
+                return resp, release, url
+            resp.read()
+            release(True)
+            url = urllib.parse.urljoin(url, location)
+            domain = urllib.parse.urlsplit(url).netloc
+            if not is_allowed_domain(domain):
+                raise ParamValidateException(
+                    f"域名不合法, 跳转的 {domain} 不在 {settings.PROCESSOR_ALLOW_DOMAINS} 范围内: {url}"
+                )
+        raise urllib.error.HTTPError(url, resp.status, "Too many redirects", resp.msg, None)
+
+    def _send(self, url: str, headers: dict) -> tuple[http.client.HTTPResponse, typing.Callable]:
+        """发送请求，连接错误和5xx响应自动重试"""
+        parsed = urllib.parse.urlsplit(url)
+        key = (parsed.scheme, parsed.hostname, parsed.port)
+        path = parsed.path or "/"
+        if parsed.query:
+            path = f"{path}?{parsed.query}"
+        headers = {
+            "User-Agent": f"py-img-processor/{VERSION}",
+            "Accept-Encoding": "identity",
+            **headers,
+        }
+
+        attempt = 0
+        while True:
+            conn, reused = self._acquire(key)
+            try:
+                conn.request("GET", path, headers=headers)
+                resp = conn.getresponse()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                # 复用的空闲连接可能已被服务端关闭，直接换新连接，不计入重试次数
+                if reused:
+                    continue
+                if attempt >= self.retries:
+                    raise
+            else:
+                if resp.status not in _RETRY_STATUS or attempt >= self.retries:
+                    return resp, lambda complete: self._release(key, conn, complete)
+                resp.read()
+                self._release(key, conn, True)
+            time.sleep(_RETRY_BACKOFF * 2**attempt)
+            attempt += 1
+
+    def _acquire(self, key: tuple) -> tuple[http.client.HTTPConnection, bool]:
+        with self._lock:
+            if self._pid != os.getpid():
+                # fork出的子进程不能复用父进程的连接
+                self._pool = {}
+                self._pid = os.getpid()
+            idle = self._pool.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, host, port = key
+        if scheme == "https":
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            conn: http.client.HTTPConnection = http.client.HTTPSConnection(
+                host, port, timeout=self.timeout, context=self._ssl_context
+            )
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        return conn, False
+
+    def _release(self, key: tuple, conn: http.client.HTTPConnection, complete: bool) -> None:
+        """响应读取完整且连接未关闭时，放回连接池"""
+        if complete and conn.sock is not None:
+            with self._lock:
+                idle = self._pool.setdefault(key, [])
+                if len(idle) < self.pool_size:
+                    idle.append(conn)
+                    return
+        conn.close()
+
+    def close(self) -> None:
+        with self._lock:
+            pool, self._pool = self._pool, {}
+        for idle in pool.values():
+            for conn in idle:
+                conn.close()
+
+
+_fetcher: typing.Optional[BaseFetcher] = None
+_fetcher_lock = threading.Lock()
+
+
+def get_fetcher() -> BaseFetcher:
+    """获取下载链接资源使用的下载器，默认使用按settings配置的 `HttpFetcher`"""
+    global _fetcher
+    if _fetcher is None:
+        with _fetcher_lock:
+            if _fetcher is None:
+                _fetcher = HttpFetcher()
+    return _fetcher
+
+
+def set_fetcher(fetcher: typing.Optional[BaseFetcher]) -> None:
+    """替换下载器；传入None时，下次使用时按settings重新创建默认的下载器"""
+    global _fetcher
+    with _fetcher_lock:
+        old, _fetcher = _fetcher, fetcher
+    if old is not None and old is not fetcher:
+        old.close()
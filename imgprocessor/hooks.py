@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# coding=utf-8
+import typing
+import time
+import threading
+
+from PIL import Image
+
+
+class StageEvent(object):
+    """一个处理阶段的统计信息
+
+    处理阶段：
+
+    - `load`: 读取输入图像(`trans_uri_to_im`)，包括下载、打开文件和校验；
+      Pillow延迟到使用像素数据时才解码，解码耗时计入之后第一个使用像素数据的阶段(通常是 `transpose`)；
+    - `transpose`: 按EXIF中的方向信息摆正图像(开头90度倍数的 `rotate` 合并在内)，方向正常且没有合并 `rotate` 时没有该阶段；
+    - `convert`: 执行操作前将输入图像转换成后续操作需要的模式(只转换一次)，输入图像是 `L`/`LA`/`RGB`/`RGBA` 时没有该阶段；
+    - `action`: 执行一个图像处理操作；
+    - `save`: 编码并保存图像(`save_img_to_file`)。
+
+    Attributes:
+        stage: 阶段，`load`/`transpose`/`convert`/`action`/`save`
+        name: `action` 阶段是操作名称；`convert` 阶段是转换后的模式；`save` 阶段是输出格式；`load` 阶段是输入图像的格式
+        wall_time: 耗时，单位秒
+        cpu_time: 当前线程的CPU耗时，单位秒；Pillow释放GIL执行的部分也计算在内
+        in_size: 输入图像的大小 (w, h)
+        in_mode: 输入图像的模式
+        out_size: 输出图像的大小 (w, h)
+        out_mode: 输出图像的模式
+        nbytes: `load` 阶段是读取的字节数(未知时为None)；`save` 阶段是编码后的字节数
+        error: 阶段执行失败时的异常
+    """
+
+    __slots__ = (
+        "stage",
+        "name",
+        "wall_time",
+        "cpu_time",
+        "in_size",
+        "in_mode",
+        "out_size",
+        "out_mode",
+        "nbytes",
+        "error",
+        "_start",
+        "_cpu_start",
+    )
+
+    def __init__(self, stage: str, name: typing.Optional[str] = None, im: typing.Optional[Image.Image] = None) -> None:
+        self.stage = stage
+        self.name = name
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.in_size: typing.Optional[tuple[int, int]] = im.size if im is not None else None
+        self.in_mode: typing.Optional[str] = im.mode if im is not None else None
+        self.out_size: typing.Optional[tuple[int, int]] = None
+        self.out_mode: typing.Optional[str] = None
+        self.nbytes: typing.Optional[int] = None
+        self.error: typing.Optional[BaseException] = None
+
+    @property
+    def converted(self) -> bool:
+        """是否发生了图像模式的转换"""
+        return bool(self.in_mode and self.out_mode and self.in_mode != self.out_mode)
+
+    def done(
+        self,
+        im: typing.Optional[Image.Image] = None,
+        nbytes: typing.Optional[int] = None,
+        name: typing.Optional[str] = None,
+    ) -> None:
+        """记录阶段的输出结果"""
+        if name is not None:
+            self.name = name
+        if im is not None:
+            self.out_size = im.size
+            self.out_mode = im.mode
+        if nbytes is not None:
+            self.nbytes = nbytes
+
+    def __enter__(self) -> "StageEvent":
+        self._start = time.perf_counter()
+        self._cpu_start = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type: typing.Any, exc: typing.Optional[BaseException], tb: typing.Any) -> None:
+        self.wall_time = time.perf_counter() - self._start
+        self.cpu_time = time.thread_time() - self._cpu_start
+        self.error = exc
+        for hook in _hooks:
+            hook(self)
+
+    def __repr__(self) -> str:
+        return (
+            f"<StageEvent {self.stage}:{self.name} wall={self.wall_time * 1000:.2f}ms cpu={self.cpu_time * 1000:.2f}ms "
+            f"{self.in_mode}{self.in_size}->{self.out_mode}{self.out_size} nbytes={self.nbytes}>"
+        )
+
+
+class _NoopStage(object):
+    """没有注册钩子时使用，不做任何统计"""
+
+    __slots__ = ()
+
+    def __bool__(self) -> bool:
+        # 用于判断是否需要统计额外的信息，例如输出文件的大小
+        return False
+
+    def done(
+        self,
+        im: typing.Optional[Image.Image] = None,
+        nbytes: typing.Optional[int] = None,
+        name: typing.Optional[str] = None,
+    ) -> None:
+        pass
+
+    def __enter__(self) -> "_NoopStage":
+        return self
+
+    def __exit__(self, *args: typing.Any) -> None:
+        pass
+
+
+_NOOP = _NoopStage()
+
+# 注册的钩子函数；注册/移除时整体替换，遍历时不需要加锁
+_hooks: tuple[typing.Callable[[StageEvent], None], ...] = ()
+_hooks_lock = threading.Lock()
+
+
+def add_hook(hook: typing.Callable[[StageEvent], None]) -> None:
+    """注册钩子函数，每个阶段结束后调用 `hook(event)`，see `StageEvent`
+
+    钩子函数在执行该阶段的线程中同步调用；同一次处理的事件在同一个线程中依次触发，
+    可以结合 `contextvars`/`threading.local` 关联到具体的请求。钩子函数中的异常会中断图像处理。
+    """
+    global _hooks
+    with _hooks_lock:
+        if hook not in _hooks:
+            _hooks = _hooks + (hook,)
+
+
+def remove_hook(hook: typing.Callable[[StageEvent], None]) -> None:
+    """移除注册的钩子函数"""
+    global _hooks
+    with _hooks_lock:
+        _hooks = tuple(h for h in _hooks if h != hook)
+
+
+def clear_hooks() -> None:
+    """移除所有注册的钩子函数"""
+    global _hooks
+    with _hooks_lock:
+        _hooks = ()
+
+
+def stage(
+    stage: str, name: typing.Optional[str] = None, im: typing.Optional[Image.Image] = None
+) -> typing.Union[StageEvent, _NoopStage]:
+    """统计一个处理阶段，没有注册钩子时不做任何统计
+
+    Examples:
+        ```python
+        with hooks.stage("action", parser.KEY, im) as event:
+            im = parser.do_action(im)
+            event.done(im)
+        ```
+    """
+    if not _hooks:
+        return _NOOP
+    return StageEvent(stage, name, im)
@@ -3,11 +3,105 @@
 import typing
 import os
 import sys
+import time
 import argparse
+import itertools
+import threading
 import traceback
+from concurrent.futures import Future, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
-from imgprocessor import VERSION
-from imgprocessor.processor import ProcessParams, process_image
+from imgprocessor import VERSION, utils
+from imgprocessor.processor import ProcessParams, process_image, process_image_multi
+
+
+# 每个进程最多同时提交的任务数，避免一次性提交大量任务占用内存
+_IN_FLIGHT_PER_WORKER = 2
+
+
+def _process_task(file_path: str, param_strs: list[str], out_paths: list[str]) -> typing.Optional[str]:
+    """处理一个输入文件的一个或多个操作，可在子进程中执行
+
+    Returns:
+        失败时返回异常信息；异常对象不一定能在进程间传递，因此转换成字符串
+    """
+    try:
+        if len(param_strs) == 1:
+            process_image(file_path, param_strs[0], out_path=out_paths[0])
+        else:
+            # 多个操作只解码一次
+            process_image_multi(file_path, param_strs, out_paths=out_paths)
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+
+class _FileCounter(threading.Thread):
+    """在后台线程中统计输入目录下的文件数量，用于估算剩余时间；只按后缀过滤，不读取文件头
+
+    会额外遍历一次目录，仅在指定 `--count-total` 时使用。
+    """
+
+    def __init__(self, path: str, extensions: typing.Optional[typing.Iterable[str]] = None) -> None:
+        super().__init__(daemon=True)
+        self.path = path
+        self.extensions = extensions
+        self.count = 0
+        self.finished = False
+
+    def run(self) -> None:
+        for _ in utils.iter_image_files(self.path, extensions=self.extensions, check_magic=False):
+            self.count += 1
+        self.finished = True
+
+
+class _Progress(object):
+    """按时间间隔输出处理进度(已处理数量、速度、预计剩余时间)，不会每个文件输出一行"""
+
+    def __init__(
+        self, interval: float, counter: typing.Optional[_FileCounter] = None, total: typing.Optional[int] = None
+    ) -> None:
+        """
+        Args:
+            interval: 输出间隔，单位秒；0表示不输出
+            counter: 统计输入文件数量的线程
+            total: 已知的输入文件数量；与counter都为空时只输出已处理数量和速度
+        """
+        self.interval = interval
+        self.counter = counter
+        self.total = total
+        self.start = self.last = time.monotonic()
+        self.done = 0
+        self.isatty = sys.stdout.isatty()
+
+    def update(self) -> None:
+        """处理完一个输入文件"""
+        self.done += 1
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if now - self.last >= self.interval:
+            self.last = now
+            print(self.format(now), end="\r" if self.isatty else "\n", flush=True)
+
+    def format(self, now: float) -> str:
+        elapsed = now - self.start
+        speed = self.done / elapsed if elapsed > 0 else 0
+        if self.counter is not None:
+            total, counting = self.counter.count, not self.counter.finished
+        elif self.total is not None:
+            total, counting = self.total, False
+        else:
+            # 没有统计文件总数
+            return f"进度：{self.done}，{speed:.2f} 文件/秒"
+        if counting:
+            # 还在统计文件数量，无法估算剩余时间
+            return f"进度：{self.done}/{total}+，{speed:.2f} 文件/秒"
+        eta = max(total - self.done, 0) / speed if speed else 0
+        return f"进度：{self.done}/{total}，{speed:.2f} 文件/秒，预计剩余 {eta:.0f}s"
+
+    def clear(self) -> None:
+        if self.interval and self.isatty:
+            print(" " * 80, end="\r", flush=True)
 
 
 def main(argv: typing.Optional[list[str]] = None) -> int:
@@ -27,82 +121,219 @@ def main(argv: typing.Optional[list[str]] = None) -> int:
         "-O", "--output", type=str, required=True, help="输出图像路径，多个图像或多个操作时请设置已存在的目录"
     )
     parser.add_argument("--overwrite", action="store_true", help="是否覆盖输出路径中已有文件")
+    parser.add_argument("--workers", type=int, default=1, help="并行处理的进程数，默认为1即在当前进程中逐个处理")
+    parser.add_argument("--continue-on-error", action="store_true", help="处理失败时继续处理其他图像，默认立即中断")
+    parser.add_argument(
+        "--ext", type=str, nargs="+", help="输入是目录时只处理这些后缀的文件，例如 jpg png；默认为所有支持的图像后缀"
+    )
+    parser.add_argument(
+        "--progress-interval",
+        type=float,
+        help="输出处理进度的间隔秒数，0表示不输出；默认在终端中为1秒，否则为30秒",
+    )
+    parser.add_argument(
+        "--count-total",
+        action="store_true",
+        help="输入是目录时另起线程统计文件总数，用于输出预计剩余时间；会额外遍历一次目录，默认不统计",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="输出每个文件的处理结果，默认只输出失败的文件")
 
     args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("参数workers必须大于0")
 
     # 输入
     path = args.path
     base_dir = path
-    # 初始化输入图像文件列表
-    file_paths = []
+    skipped = 0
+
+    def on_skip(file_path: str) -> None:
+        nonlocal skipped
+        skipped += 1
+
+    counter = None
+    file_paths: typing.Iterator[str]
     if os.path.isdir(path):
-        for path, dir_list, file_list in os.walk(path):
-            for file_name in file_list:
-                p = os.path.join(path, file_name)
-                file_paths.append(p)
+        # 边遍历边处理，不会先列出所有文件；跳过非图像文件
+        file_paths = utils.iter_image_files(path, extensions=args.ext, on_skip=on_skip)
+        head = list(itertools.islice(file_paths, 2))
+        single = len(head) == 1
+        file_paths = itertools.chain(head, file_paths)
+        if args.count_total:
+            # 另起线程统计文件数量，用于估算剩余时间
+            counter = _FileCounter(path, extensions=args.ext)
+            counter.start()
     else:
-        file_paths = [path]
+        file_paths = iter([path])
+        single = True
         base_dir = os.path.dirname(path)
 
-    total = len(file_paths)
     ac_num = len(args.action)
+    # 每个操作只解析一次
+    params_list = [ProcessParams.parse_str(param_str) for param_str in args.action]
 
     # 输出目录
     output = args.output
-    if (total > 1 or ac_num > 1) and not os.path.isdir(output):
+    if (not single or ac_num > 1) and not os.path.isdir(output):
         print("\033[31m参数output目录不存在,请先创建\033[0m", file=sys.stderr, flush=True)
         return 1
-    count = 0
-    for file_path in file_paths:
-        count += 1
-        f_tag = f"{count}/{total}\t处理 {file_path}"
-        print(f_tag, flush=True, end="\r")
-        # 相对path的相对路径
-        if not base_dir or base_dir in [".", "./"]:
-            input_file_name = file_path
-        else:
-            input_file_name = file_path.split(base_dir, 1)[-1]
-        input_file_name = input_file_name.strip("/")
-
-        prefix, ext = os.path.splitext(input_file_name)
-        for idx, param_str in enumerate(args.action):
-            params = ProcessParams.parse_str(param_str)
-            # 初始化目标文件路径
-            if total == 1 and ac_num == 1 and os.path.splitext(output)[-1]:
-                out_path = output
+
+    interval = args.progress_interval
+    if interval is None:
+        interval = 1 if sys.stdout.isatty() else 30
+    progress = _Progress(interval, counter=counter, total=1 if single and counter is None else None)
+
+    def iter_tasks() -> typing.Generator[tuple[str, list[tuple[str, str, str, typing.Optional[str]]]], None, None]:
+        """按输入文件生成处理任务 (输入文件, [(tag, 操作参数, 输出路径, 错误信息)])，输出路径只由输入路径和操作决定"""
+        # 输出路径保留了输入文件的相对目录，只有同一目录下的输入文件会重复，不必记录所有输出路径
+        cur_dir: typing.Optional[str] = None
+        out_paths: set[str] = set()
+        for count, file_path in enumerate(file_paths, 1):
+            if os.path.dirname(file_path) != cur_dir:
+                cur_dir, out_paths = os.path.dirname(file_path), set()
+            f_tag = f"{count}\t处理 {file_path}"
+            # 相对path的相对路径
+            if not base_dir or base_dir in [".", "./"]:
+                input_file_name = file_path
             else:
-                if params.save_parser.format:
-                    ext = f".{params.save_parser.format}"
-                if ac_num == 1:
-                    target_name = f"{prefix}{ext}"
+                input_file_name = file_path.split(base_dir, 1)[-1]
+            input_file_name = input_file_name.strip("/")
+
+            prefix, ext = os.path.splitext(input_file_name)
+            items = []
+            for idx, (param_str, params) in enumerate(zip(args.action, params_list)):
+                # 初始化目标文件路径
+                if single and ac_num == 1 and os.path.splitext(output)[-1]:
+                    out_path = output
                 else:
-                    target_name = f"{prefix}-{idx}{ext}"
-                out_path = os.path.join(output, target_name)
-
-            tag = f"{f_tag}\t action={idx + 1}\t 保存于 {out_path}"
-            print(f"{tag}\t ...", flush=True, end="\r")
-
-            # 判断目标文件是否存在
-            if os.path.exists(out_path):
-                if not args.overwrite:
-                    print(f"\033[31m{tag} 目标文件已存在\033[0m", file=sys.stderr, flush=True)
-                    print("处理中断，可以添加参数 \033[33m--overwrite\033[0m 覆盖现有文件", file=sys.stderr, flush=True)
-                    return 1
-
-                tag = f"{tag}\t \033[33moverwrite\033[0m"
-
-            cur_out_dir = os.path.dirname(out_path)
-            if not os.path.exists(cur_out_dir):
-                os.makedirs(cur_out_dir)
-            try:
-                process_image(file_path, param_str, out_path=out_path)
-                print(f"{tag}\t 成功", flush=True)
-            except Exception as e:
-                print(f"{tag}\t \033[31m失败：{e}\033[0m", file=sys.stderr, flush=True)
-                print(traceback.format_exc(), file=sys.stderr, flush=True)
-                return 1
-
-    return 0
+                    if params.save_parser.format:
+                        ext = f".{params.save_parser.format}"
+                    if ac_num == 1:
+                        target_name = f"{prefix}{ext}"
+                    else:
+                        target_name = f"{prefix}-{idx}{ext}"
+                    out_path = os.path.join(output, target_name)
+
+                tag = f"{f_tag}\t action={idx + 1}\t 保存于 {out_path}"
+
+                # 判断目标文件是否存在
+                error = None
+                if out_path in out_paths:
+                    error = "与其他输入图像的输出路径重复"
+                elif os.path.exists(out_path):
+                    if not args.overwrite:
+                        error = "目标文件已存在，可以添加参数 \033[33m--overwrite\033[0m 覆盖现有文件"
+                    else:
+                        tag = f"{tag}\t \033[33moverwrite\033[0m"
+                out_paths.add(out_path)
+
+                if not error:
+                    cur_out_dir = os.path.dirname(out_path)
+                    if cur_out_dir:
+                        os.makedirs(cur_out_dir, exist_ok=True)
+                items.append((tag, param_str, out_path, error))
+            yield file_path, items
+
+    total, success, failure = 0, 0, 0
+    stopped = False
+    start = time.monotonic()
+
+    def report(tags: list[str], error: typing.Optional[str]) -> bool:
+        """输出任务的结果，返回是否继续处理"""
+        nonlocal success, failure
+        for tag in tags:
+            if not error:
+                success += 1
+                if args.verbose:
+                    print(f"{tag}\t 成功", flush=True)
+            else:
+                failure += 1
+                print(f"{tag}\t \033[31m失败：{error}\033[0m", file=sys.stderr, flush=True)
+        return not error or args.continue_on_error
+
+    def iter_ready() -> typing.Generator[tuple[list[str], str, list[str], list[str]], None, None]:
+        """输出无法处理的任务，同一个输入文件的其他操作合并成一个任务"""
+        nonlocal stopped, total
+        for file_path, items in iter_tasks():
+            total += 1
+            ready = []
+            for tag, param_str, out_path, error in items:
+                if not error:
+                    ready.append((tag, param_str, out_path))
+                elif not report([tag], error):
+                    stopped = True
+                    return
+            if ready:
+                yield [r[0] for r in ready], file_path, [r[1] for r in ready], [r[2] for r in ready]
+            else:
+                progress.update()
+
+    def report_task(tags: list[str], error: typing.Optional[str]) -> bool:
+        ok = report(tags, error)
+        progress.update()
+        return ok
+
+    if args.workers == 1:
+        ok = True
+        for tags, file_path, param_strs, out_paths in iter_ready():
+            ok = report_task(tags, _process_task(file_path, param_strs, out_paths))
+            if not ok:
+                break
+    else:
+        ok = _run_in_pool(args.workers, iter_ready(), report_task)
+    ok = ok and not stopped
+    progress.clear()
+    if not ok:
+        print("处理中断，可以添加参数 \033[33m--continue-on-error\033[0m 跳过失败的图像", file=sys.stderr, flush=True)
+
+    elapsed = time.monotonic() - start
+    speed = total / elapsed if elapsed > 0 else 0
+    msg = f"处理完成：成功 {success}，失败 {failure}，共 {total} 个文件，耗时 {elapsed:.2f}s，{speed:.2f} 文件/秒"
+    if skipped:
+        msg = f"{msg}，跳过 {skipped} 个非图像文件"
+    print(msg, file=sys.stderr if failure else sys.stdout, flush=True)
+    return 0 if ok and not failure else 1
+
+
+def _run_in_pool(
+    workers: int,
+    tasks: typing.Iterator[tuple[list[str], str, list[str], list[str]]],
+    report: typing.Callable[[list[str], typing.Optional[str]], bool],
+) -> bool:
+    """多进程并行处理，同时提交的任务数不超过 workers * _IN_FLIGHT_PER_WORKER
+
+    Returns:
+        是否全部处理完成(未中断)
+    """
+    max_in_flight = workers * _IN_FLIGHT_PER_WORKER
+    pending: dict[Future, list[str]] = {}
+
+    def collect() -> bool:
+        # 等待至少一个任务完成并输出结果
+        ok = True
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            exc = future.exception()
+            # 子进程异常退出等情况，任务本身没有返回结果
+            error = repr(exc) if exc else future.result()
+            ok = report(pending.pop(future), error) and ok
+        return ok
+
+    ok = True
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for tags, file_path, param_strs, out_paths in tasks:
+            pending[executor.submit(_process_task, file_path, param_strs, out_paths)] = tags
+            if len(pending) >= max_in_flight:
+                ok = collect()
+            if not ok:
+                break
+        while ok and pending:
+            ok = collect()
+        if not ok:
+            # 中断时取消还未开始的任务，等待执行中的任务结束
+            for future in pending:
+                future.cancel()
+    return ok
 
 
 # if __name__ == "__main__":
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# coding=utf-8
+import typing
+import time
+import threading
+import collections
+from contextlib import contextmanager
+
+from PIL import ImageFile
+
+from imgprocessor import settings
+from imgprocessor.exceptions import ProcessLimitException
+from imgprocessor.parsers.base import BaseParser, pixel_bytes, get_orientation, is_transposed
+from imgprocessor.optimizer import plan_mode
+
+
+# 等待内存预算时，每隔多久调用一次check，单位秒
+_CHECK_INTERVAL = 0.1
+
+
+def estimate_actions(
+    src_w: int, src_h: int, mode: str, actions: typing.Sequence[BaseParser], keep_intermediate: bool = False
+) -> tuple[int, int, str, int]:
+    """不执行操作，估算按顺序执行操作时占用内存的峰值
+
+    峰值包括输入图像、当前处理的图像和每个操作执行时新分配的内存(see `BaseParser.estimate_memory`)。
+
+    Args:
+        src_w: 输入图像宽度
+        src_h: 输入图像高度
+        mode: 输入图像模式
+        actions: 图像处理操作
+        keep_intermediate: 中间结果是否一直保留(例如 `process_image_multi` 中被多个分支共用的图像)
+
+    Returns:
+        (输出宽度, 输出高度, 输出模式, 占用内存峰值的字节数)
+    """
+    w, h = src_w, src_h
+    # 一直占用的内存，以及当前处理的图像占用的内存
+    base, cur = w * h * pixel_bytes(mode), 0
+    peak = base
+    for parser in actions:
+        w, h, mode, nbytes = parser.estimate_memory(w, h, mode)
+        peak = max(peak, base + cur + nbytes)
+        if keep_intermediate:
+            base += cur
+        cur = w * h * pixel_bytes(mode)
+    return w, h, mode, peak
+
+
+def estimate_memory(
+    im: ImageFile.ImageFile, actions: typing.Sequence[BaseParser], keep_intermediate: bool = False
+) -> int:
+    """根据图像头信息(尚未解码)估算处理图像占用内存的峰值，单位字节
+
+    包括解码后的输入图像、按EXIF方向旋转的副本、执行操作前和编码时转换模式、各个操作占用的内存；
+    不包括水印、字体等有单独容量限制的缓存。图像使用draft模式时，按draft之后的大小计算。
+
+    Args:
+        im: 输入图像
+        actions: 图像处理操作
+        keep_intermediate: 同 `estimate_actions`
+
+    Returns:
+        占用内存峰值的字节数
+    """
+    src_w, src_h = im.size
+    if is_transposed(get_orientation(im)):
+        src_w, src_h = src_h, src_w
+    decoded = src_w * src_h * pixel_bytes(im.mode)
+    # 旋转方向得到的是一个副本，原图在处理过程中一直保留
+    mode = plan_mode(im.mode, actions, transparency=im.info.get("transparency") is not None)
+    w, h, _, peak = estimate_actions(src_w, src_h, mode or im.mode, actions, keep_intermediate=keep_intermediate)
+    if mode:
+        # 执行操作前转换模式，转换时同时占用转换前后的图像
+        peak = max(peak, decoded + src_w * src_h * pixel_bytes(mode))
+    # 编码时转换模式(例如JPEG转换成RGB)
+    return decoded + max(peak, decoded + w * h * 4)
+
+
+class MemoryBudget(object):
+    """进程内的内存预算，限制同时处理的图像预计占用的内存之和
+
+    - 预计占用内存超过整个预算的图像直接失败；
+    - 预算不足时按先后顺序排队等待，超过等待时间则失败，避免同时处理多个大图像导致进程内存溢出。
+    """
+
+    def __init__(self, limit: int, timeout: typing.Optional[float] = None) -> None:
+        """
+        Args:
+            limit: 内存预算，单位字节
+            timeout: 等待预算的最长时间，单位秒；0表示不等待，None表示一直等待
+        """
+        self.limit = limit
+        self.timeout = timeout
+        self.used = 0
+        self._cond = threading.Condition()
+        self._waiters: collections.deque = collections.deque()
+
+    def acquire(self, nbytes: int, check: typing.Optional[typing.Callable[[], None]] = None) -> None:
+        """申请内存预算
+
+        Args:
+            nbytes: 申请的字节数
+            check: 等待期间定期调用，可以抛出异常中断等待，例如处理被取消
+
+        Raises:
+            ProcessLimitException: 超过整个预算或等待超时
+        """
+        if nbytes > self.limit:
+            raise ProcessLimitException(
+                f"图像处理预计占用内存 {nbytes / 1024 / 1024:.0f}MB 超过了内存预算 {self.limit / 1024 / 1024:.0f}MB"
+            )
+        deadline = time.monotonic() + self.timeout if self.timeout is not None else None
+        token = object()
+        with self._cond:
+            self._waiters.append(token)
+            try:
+                # 按申请的先后顺序分配，避免大图像一直等不到预算
+                while self._waiters[0] is not token or self.used + nbytes > self.limit:
+                    wait = None
+                    if deadline is not None:
+                        wait = deadline - time.monotonic()
+                        if wait <= 0:
+                            raise ProcessLimitException(
+                                f"等待内存预算超时，预计占用内存 {nbytes / 1024 / 1024:.0f}MB，"
+                                f"已使用 {self.used / 1024 / 1024:.0f}MB"
+                            )
+                    if check:
+                        check()
+                        wait = min(wait, _CHECK_INTERVAL) if wait is not None else _CHECK_INTERVAL
+                    self._cond.wait(wait)
+                self.used += nbytes
+            finally:
+                self._waiters.remove(token)
+                self._cond.notify_all()
+
+    def release(self, nbytes: int) -> None:
+        with self._cond:
+            self.used -= nbytes
+            self._cond.notify_all()
+
+    @contextmanager
+    def reserve(
+        self, nbytes: int, check: typing.Optional[typing.Callable[[], None]] = None
+    ) -> typing.Generator[None, None, None]:
+        """在with中占用内存预算，退出时释放"""
+        self.acquire(nbytes, check=check)
+        try:
+            yield
+        finally:
+            self.release(nbytes)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {"limit": self.limit, "used": self.used, "waiting": len(self._waiters)}
+
+
+_budget: typing.Optional[MemoryBudget] = None
+_budget_lock = threading.Lock()
+
+
+def get_memory_budget() -> typing.Optional[MemoryBudget]:
+    """获取进程内的内存预算，按settings配置创建；未配置时返回None"""
+    global _budget
+    if _budget is None:
+        limit = settings.PROCESSOR_MEMORY_BUDGET * 1024 * 1024
+        if not limit:
+            return None
+        with _budget_lock:
+            if _budget is None:
+                _budget = MemoryBudget(limit, settings.PROCESSOR_MEMORY_BUDGET_TIMEOUT)
+    return _budget
+
+
+def set_memory_budget(budget: typing.Optional[MemoryBudget]) -> None:
+    """替换进程内的内存预算；传入None时，下次使用时按settings重新创建"""
+    global _budget
+    with _budget_lock:
+        _budget = budget
+
+
+@contextmanager
+def reserve_memory(
+    im: ImageFile.ImageFile,
+    actions: typing.Sequence[BaseParser],
+    keep_intermediate: bool = False,
+    check: typing.Optional[typing.Callable[[], None]] = None,
+) -> typing.Generator[None, None, None]:
+    """按估算的内存占用申请进程内的内存预算，未配置预算时不做任何处理
+
+    Raises:
+        ProcessLimitException: 超过整个预算或等待超时
+    """
+    budget = get_memory_budget()
+    if budget is None:
+        yield
+        return
+    with budget.reserve(estimate_memory(im, actions, keep_intermediate=keep_intermediate), check=check):
+        yield
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# coding=utf-8
+import typing
+
+from PIL import ImageFile
+
+from imgprocessor import enums
+from imgprocessor.parsers import BaseParser, ResizeParser, CropParser, RotateParser, AlphaParser, GrayParser
+from imgprocessor.parsers.base import pre_processing, WORKING_MODES
+
+
+class BoxResizeParser(ResizeParser):
+    """将输入图像中的box区域缩放到指定宽高，由 `resize` + `crop` 操作合并而来
+
+    缩放时box之外的像素同样参与插值计算，结果与先缩放整个图像再裁剪一致，但只计算裁剪区域的像素。
+    """
+
+    def __init__(
+        self,
+        box: tuple[float, float, float, float],
+        w: int,
+        h: int,
+        f: typing.Optional[str] = None,
+        fast: int = 0,
+        **kwargs: typing.Any,
+    ) -> None:
+        super().__init__(m=enums.ResizeMode.FIXED.value, w=w, h=h, limit=0, f=f, fast=fast)
+        self.box = box
+
+    def compute(self, src_w: int, src_h: int) -> tuple:
+        return (self.w, self.h)
+
+    def to_dict(self) -> dict:
+        data = super().to_dict()
+        data["box"] = self.box
+        return data
+
+    def do_action(self, im: ImageFile.ImageFile) -> ImageFile.ImageFile:
+        im = pre_processing(im, mode=self.working_mode(im.mode))
+        if self.box == (0, 0, *im.size) and (self.w, self.h) == im.size:
+            return im
+        return self.resize(im, (self.w, self.h), box=self.box)
+
+
+def _is_plain_resize(parser: BaseParser) -> bool:
+    """仅缩放、不会填充或裁剪的resize操作"""
+    return isinstance(parser, ResizeParser) and parser.m not in [
+        enums.ResizeMode.PAD.value,
+        enums.ResizeMode.FIT.value,
+    ]
+
+
+def _is_noop(parser: BaseParser, size: typing.Optional[tuple[int, int]]) -> bool:
+    """判断操作是否对像素没有任何改变"""
+    if isinstance(parser, RotateParser):
+        return parser.value % 360 == 0
+    if isinstance(parser, AlphaParser):
+        return parser.value >= 100
+    if size is None:
+        return False
+    if isinstance(parser, BoxResizeParser):
+        return parser.box == (0, 0, *size) and (parser.w, parser.h) == size
+    if isinstance(parser, ResizeParser):
+        return parser.compute(*size) == size
+    if isinstance(parser, CropParser):
+        return parser.compute(*size) == (0, 0, *size)
+    return False
+
+
+def _fuse(prev: BaseParser, parser: BaseParser, size: typing.Optional[tuple[int, int]]) -> typing.Optional[BaseParser]:
+    """尝试将相邻的两个操作合并成一个操作
+
+    Args:
+        prev: 前一个操作
+        parser: 当前操作
+        size: 前一个操作的输入图像宽高；None表示无法推算
+
+    Returns:
+        合并后的操作；不能合并返回None
+    """
+    if isinstance(prev, RotateParser) and isinstance(parser, RotateParser):
+        # 90度倍数的旋转是无损的transpose，可直接叠加角度
+        if prev.value % 90 == 0 and parser.value % 90 == 0:
+            return RotateParser(value=(prev.value + parser.value) % 360)
+        return None
+
+    if isinstance(prev, AlphaParser) and isinstance(parser, AlphaParser):
+        return AlphaParser(value=min(prev.value, parser.value))
+
+    if isinstance(prev, GrayParser) and isinstance(parser, GrayParser):
+        return prev
+
+    if size is None:
+        return None
+
+    if isinstance(prev, CropParser) and isinstance(parser, CropParser):
+        # 连续裁剪：坐标叠加
+        x1, y1, w1, h1 = prev.compute(*size)
+        x2, y2, w2, h2 = parser.compute(w1, h1)
+        return CropParser(x=x1 + x2, y=y1 + y2, w=w2, h=h2)
+
+    if not _is_plain_resize(prev):
+        return None
+    prev = typing.cast(ResizeParser, prev)
+    box = prev.box if isinstance(prev, BoxResizeParser) else (0, 0, *size)
+    rw, rh = prev.compute(*size)
+
+    if _is_plain_resize(parser):
+        # 连续缩放：直接缩放到最终大小，只做一次插值；插值算法不同时不合并
+        parser = typing.cast(ResizeParser, parser)
+        if (prev.get_resample(), prev.fast) != (parser.get_resample(), parser.fast):
+            return None
+        w, h = parser.compute(rw, rh)
+        return BoxResizeParser(box, w, h, f=parser.f, fast=parser.fast)
+
+    if isinstance(parser, CropParser):
+        # 缩放后裁剪：换算成缩放前的区域，只缩放需要的区域
+        x, y, w, h = parser.compute(rw, rh)
+        fx, fy = (box[2] - box[0]) / rw, (box[3] - box[1]) / rh
+        new_box = (box[0] + x * fx, box[1] + y * fy, box[0] + (x + w) * fx, box[1] + (y + h) * fy)
+        return BoxResizeParser(new_box, w, h, f=prev.f, fast=prev.fast)
+
+    return None
+
+
+def optimize_actions(actions: typing.Sequence[BaseParser], src_w: int, src_h: int) -> list[BaseParser]:
+    """优化图像处理操作，输出与原操作效果一致且计算量更少的操作列表
+
+    - 去掉对像素没有改变的操作，例如 `rotate,0`、`alpha,100`、不改变大小的 `resize` 和 `crop`；
+    - 合并连续的 `resize`，直接缩放到最终大小；
+    - 将 `resize` 之后的 `crop` 换算成只缩放裁剪区域，结果与先缩放再裁剪一致；
+    - 合并连续的 `crop`、90度倍数的 `rotate`、`alpha` 和 `gray`；
+
+    注意：被去掉的操作不再将图像统一转换成 `RGB`/`RGBA` 模式，像素内容不变。
+
+    Args:
+        actions: 图像处理操作
+        src_w: 输入图像宽度(已处理EXIF方向)
+        src_h: 输入图像高度(已处理EXIF方向)
+
+    Returns:
+        优化后的操作列表，不会修改输入的操作对象
+    """
+    out: list[BaseParser] = []
+    # 与out对应，每个操作的输入图像大小；None表示无法推算
+    sizes: list[typing.Optional[tuple[int, int]]] = []
+    size: typing.Optional[tuple[int, int]] = (src_w, src_h)
+    for parser in actions:
+        cur: typing.Optional[BaseParser] = parser
+        while cur is not None:
+            if _is_noop(cur, size):
+                cur = None
+                break
+            fused = _fuse(out[-1], cur, sizes[-1]) if out else None
+            if fused is None:
+                break
+            out.pop()
+            size = sizes.pop()
+            cur = fused
+        if cur is None:
+            continue
+        out.append(cur)
+        sizes.append(size)
+        size = cur.compute_output_size(*size) if size else None
+    return out
+
+
+def plan_mode(mode: str, actions: typing.Sequence[BaseParser], transparency: bool = False) -> typing.Optional[str]:
+    """选择输入图像在执行操作前转换成的模式，使图像只转换一次
+
+    输入图像是 `L`/`LA`/`RGB`/`RGBA` 时不需要提前转换，各操作按需转换(例如粘贴水印时灰度图转换成彩色)；
+    其他模式(例如 `P`/`CMYK`/`I;16`)按后续操作需要的模式(see `BaseParser.working_mode`)提前转换一次：
+    有操作需要透明度时带透明度，有操作需要彩色时使用彩色，否则灰度图保持灰度。
+    `gray` 直接从输入图像的模式转换，之后的操作不影响选择。
+
+    Args:
+        mode: 输入图像的模式
+        actions: 图像处理操作
+        transparency: 输入图像是否指定了透明色(`im.info["transparency"]`)
+
+    Returns:
+        需要转换成的模式；不需要提前转换时返回None
+    """
+    if mode in WORKING_MODES and not transparency:
+        return None
+    if transparency:
+        # 指定了透明色，转换时保留透明度
+        mode = "LA" if mode in ["1", "L"] else "PA"
+    modes = []
+    for parser in actions:
+        if isinstance(parser, GrayParser):
+            break
+        modes.append(parser.working_mode(mode))
+    if not modes:
+        return None
+    alpha = "A" if any(m in ["LA", "RGBA"] for m in modes) else ""
+    if any(m in ["RGB", "RGBA"] for m in modes):
+        return f"RGB{alpha}"
+    return f"L{alpha}"
@@ -2,7 +2,10 @@
 # coding=utf-8
 import typing
 
-from imgprocessor import enums
+import os
+
+from imgprocessor import enums, settings
+from imgprocessor.cache import LRUCache
 from imgprocessor.exceptions import ParamParseException
 
 from .base import BaseParser, ImgSaveParser
@@ -97,3 +100,86 @@ class ProcessParams(object):
 
         kwargs = ImgSaveParser.parse_str(",".join(save_args))
         return cls(enable_base64=True, actions=actions, **kwargs)
+
+
+def _freeze(value: typing.Any) -> typing.Hashable:
+    """将参数值转换成可哈希的规范形式"""
+    if isinstance(value, BaseParser):
+        return (value.KEY, _freeze(value.to_dict()))
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def action_key(parser: BaseParser) -> typing.Hashable:
+    """操作的规范化key，参数相同的操作key相同"""
+    return _freeze(parser)
+
+
+class CompiledParams(object):
+    """编译后的图像处理参数：不可修改、可哈希，可以在多次处理、多个线程之间复用
+
+    Attributes:
+        actions: 图像处理操作
+        save_parser: 输出图像的参数
+        key: 规范化后的参数，处理效果相同的参数key相同，可用于比较和缓存
+    """
+
+    __slots__ = ("actions", "save_parser", "key")
+
+    actions: tuple[BaseParser, ...]
+    save_parser: ImgSaveParser
+    key: typing.Hashable
+
+    def __init__(self, params: ProcessParams) -> None:
+        object.__setattr__(self, "actions", tuple(params.actions))
+        object.__setattr__(self, "save_parser", params.save_parser)
+        object.__setattr__(self, "key", (_freeze(params.save_parser), _freeze(params.actions)))
+
+    def __setattr__(self, name: str, value: typing.Any) -> None:
+        raise AttributeError("CompiledParams is immutable")
+
+    def __hash__(self) -> int:
+        return hash(self.key)
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, CompiledParams) and self.key == other.key
+
+    def __repr__(self) -> str:
+        return f"CompiledParams({self.key})"
+
+
+# 参数字符串到编译后参数的缓存
+plan_cache = LRUCache(settings.PROCESSOR_PLAN_CACHE_SIZE)
+
+
+def compile_params(params: typing.Union[CompiledParams, ProcessParams, dict, str]) -> CompiledParams:
+    """解析、校验并编译图像处理参数
+
+    字符串参数的结果缓存在 `plan_cache` 中，相同的参数字符串不再重复解析和校验。
+    由于资源路径在校验时会按当前工作目录转换成绝对路径并受 `PROCESSOR_WORKSPACES`/`PROCESSOR_ALLOW_DOMAINS` 限制，
+    这些值也是缓存key的一部分。
+
+    Args:
+        params: 图像处理参数
+
+    Raises:
+        ParamValidateException: 参数校验异常
+        ParamParseException: 参数解析异常
+
+    Returns:
+        编译后的参数
+    """
+    if isinstance(params, CompiledParams):
+        return params
+    if not isinstance(params, str):
+        return CompiledParams(ProcessParams.init(params))
+
+    key = (params, os.getcwd(), settings.PROCESSOR_WORKSPACES, settings.PROCESSOR_ALLOW_DOMAINS)
+    compiled = plan_cache.get(key)
+    if compiled is None:
+        compiled = CompiledParams(ProcessParams.parse_str(params))
+        plan_cache.set(key, compiled)
+    return compiled
@@ -5,12 +5,13 @@ import typing
 from PIL import ImageFile
 
 from imgprocessor import enums
-from .base import BaseParser, pre_processing
+from .base import BaseParser, pre_processing, estimate_pre_processing, get_working_mode
 
 
 class AlphaParser(BaseParser):
 
     KEY = enums.OpAction.ALPHA.value
+    IN_PLACE = True
     ARGS = {
         # 不透明度, 为100时，完全不透明，即原图; 为0时，完全透明
         "value": {"type": enums.ArgType.INTEGER.value, "default": 100, "min": 0, "max": 100},
@@ -23,10 +24,21 @@ class AlphaParser(BaseParser):
     ) -> None:
         self.value = value
 
+    def working_mode(self, mode: str) -> str:
+        return get_working_mode(mode, use_alpha=True)
+
+    def estimate_memory(self, src_w: int, src_h: int, mode: str) -> tuple[int, int, str, int]:
+        to_mode = self.working_mode(mode)
+        nbytes = estimate_pre_processing(src_w, src_h, mode, to_mode)
+        if self.value < 100:
+            # 透明度通道 + 修改后的透明度通道
+            nbytes += src_w * src_h * 2
+        return src_w, src_h, to_mode, nbytes
+
     def do_action(self, im: ImageFile.ImageFile) -> ImageFile.ImageFile:
-        im = pre_processing(im, use_alpha=True)
+        im = pre_processing(im, mode=self.working_mode(im.mode))
         if self.value < 100:
-            _, _, _, alpha_channel = im.split()
+            alpha_channel = im.getchannel("A")
             alpha_channel = alpha_channel.point(lambda i: min(int(255 * self.value / 100), i))
             im.putalpha(alpha_channel)
         return im
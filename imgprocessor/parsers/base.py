@@ -2,27 +2,44 @@
 # coding=utf-8
 import typing
 
+import io
 import os
 import re
-import tempfile
+import time
+import hashlib
+import contextvars
 import urllib.parse
-from urllib.request import urlretrieve
 from contextlib import contextmanager
 
-from PIL import Image, ImageOps, ImageFile
+from PIL import Image, ImageFile
 
 from py_enum import ChoiceEnum
-from imgprocessor import settings, enums, utils
+from imgprocessor import settings, enums, utils, hooks
+from imgprocessor.fetcher import get_fetcher, is_allowed_domain
+from imgprocessor.cache import LRUCache
 from imgprocessor.exceptions import ParamValidateException, ParamParseException, ProcessLimitException
 
 
 _ALLOW_SCHEMES = ("http", "https")
+# 读取文件对象时每次读取的大小
+_READ_CHUNK_SIZE = 64 * 1024
+# 只读取文件头获取图像宽高时，最多读取的大小
+_PROBE_MAX_SIZE = 1024 * 1024
+
+# 解码并预处理后的水印/合并图像缓存，值是(版本, 图像, 有效期截止时间)，按像素数据大小限制容量
+overlay_cache = LRUCache(
+    settings.PROCESSOR_OVERLAY_CACHE_SIZE * 1024 * 1024, sizeof=lambda value: utils.get_im_nbytes(value[1])
+)
+# 当前处理中已读取的叠加图像 {uri: (版本, 图像)}，see `overlay_scope`
+_overlay_scope: contextvars.ContextVar[typing.Optional[dict]] = contextvars.ContextVar("overlay_scope", default=None)
 
 
 class BaseParser(object):
     # 用来定义参数
     KEY: typing.Any = ""
     ARGS: dict = {}
+    # do_action 是否会直接修改输入的图像(而不是返回新图像)，输入图像需要复用时要先复制
+    IN_PLACE = False
 
     def __init__(self, **kwargs: typing.Any) -> None:
         pass
@@ -46,6 +63,43 @@ class BaseParser(object):
     def do_action(self, im: ImageFile.ImageFile) -> ImageFile.ImageFile:
         raise NotImplementedError
 
+    def compute_output_size(self, src_w: int, src_h: int) -> typing.Optional[tuple[int, int]]:
+        """不执行操作，推算处理后图像的宽高
+
+        Args:
+            src_w: 输入图像宽度
+            src_h: 输入图像高度
+
+        Returns:
+            输出图像的宽高；无法推算时返回None
+        """
+        return src_w, src_h
+
+    def working_mode(self, mode: str) -> str:
+        """执行操作时使用的图像模式，输入图像是其他模式时先转换，see `get_working_mode`
+
+        Args:
+            mode: 输入图像模式
+
+        Returns:
+            图像模式
+        """
+        return get_working_mode(mode)
+
+    def estimate_memory(self, src_w: int, src_h: int, mode: str) -> tuple[int, int, str, int]:
+        """不执行操作，估算处理后图像的宽高、模式，以及执行时新分配的内存
+
+        Args:
+            src_w: 输入图像宽度
+            src_h: 输入图像高度
+            mode: 输入图像模式
+
+        Returns:
+            (输出宽度, 输出高度, 输出模式, 执行时新分配的内存字节数(包括输出图像，不包括输入图像))
+        """
+        w, h = self.compute_output_size(src_w, src_h) or (src_w, src_h)
+        return w, h, mode, w * h * pixel_bytes(mode)
+
     def to_dict(self) -> dict:
         data = {}
         for k in self.ARGS.keys():
@@ -53,6 +107,9 @@ class BaseParser(object):
                 data[k] = self.__dict__.get(k)
         return data
 
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.to_dict()})"
+
     @classmethod
     def validate_args(cls, enable_base64: bool = False, **kwargs: typing.Any) -> dict:
         data = {}
@@ -177,10 +234,9 @@ class BaseParser(object):
             domain = parsed_url.netloc
             if not domain:
                 raise ParamValidateException(f"链接未解析出域名: {ori_value}")
-            allow_domains = settings.PROCESSOR_ALLOW_DOMAINS
-            if allow_domains and not parsed_url.netloc.endswith(tuple(allow_domains)):
+            if not is_allowed_domain(domain):
                 raise ParamValidateException(
-                    f"域名不合法, {parsed_url.netloc} 不在 {allow_domains} 范围内: {ori_value}"
+                    f"域名不合法, {domain} 不在 {settings.PROCESSOR_ALLOW_DOMAINS} 范围内: {ori_value}"
                 )
         return value
 
@@ -214,33 +270,172 @@ class BaseParser(object):
         return params
 
 
-def pre_processing(im: ImageFile.ImageFile, use_alpha: bool = False) -> ImageFile.ImageFile:
-    """预处理图像，默认转成`RGB`，若为`use_alpha=True`转为`RGBA`
+# 处理图像时使用的模式，其他模式的图像先转换成其中之一
+WORKING_MODES = ("L", "LA", "RGB", "RGBA")
+# 单通道的灰度图，包括16位/32位整数和浮点数(转换成 `L` 与转换成 `RGB` 的灰度值相同)
+_GRAY_MODES = ("1", "L", "LA", "La", "I", "F", "I;16", "I;16L", "I;16B", "I;16N")
+_ALPHA_MODES = ("LA", "La", "PA", "RGBA", "RGBa")
+
+
+def get_working_mode(mode: str, use_alpha: bool = False, use_color: bool = False) -> str:
+    """处理图像时使用的模式：灰度图(包括 `I;16`/`I`/`F`)使用 `L`/`LA`，其他图像(`P`/`CMYK`等)使用 `RGB`/`RGBA`
 
     Args:
-        im: 输入图像
-        use_alpha: 是否处理透明度
+        mode: 输入图像模式
+        use_alpha: 是否需要透明度，已有透明度的图像始终保留透明度
+        use_color: 是否需要彩色，例如粘贴彩色的水印
 
     Returns:
-        输出图像
+        `WORKING_MODES` 中的一个模式
+    """
+    alpha = use_alpha or mode in _ALPHA_MODES
+    if mode in _GRAY_MODES and not use_color:
+        return "LA" if alpha else "L"
+    return "RGBA" if alpha else "RGB"
+
+
+# Pillow<9.1 没有 `Image.Transpose`
+_Transpose: typing.Any = getattr(Image, "Transpose", Image)
+# EXIF中的方向信息对应的transpose操作，同 `ImageOps.exif_transpose`
+_ORIENTATION_TRANSPOSE = {
+    enums.ImageOrientation.TOP_RIGHT.value: _Transpose.FLIP_LEFT_RIGHT,
+    enums.ImageOrientation.BOTTOM_RIGHT.value: _Transpose.ROTATE_180,
+    enums.ImageOrientation.BOTTOM_LEFT.value: _Transpose.FLIP_TOP_BOTTOM,
+    enums.ImageOrientation.LEFT_TOP.value: _Transpose.TRANSPOSE,
+    enums.ImageOrientation.RIGHT_TOP.value: _Transpose.ROTATE_270,
+    enums.ImageOrientation.RIGHT_BOTTOM.value: _Transpose.TRANSVERSE,
+    enums.ImageOrientation.LEFT_BOTTOM.value: _Transpose.ROTATE_90,
+}
+# 顺时针旋转的度数对应的transpose操作(`ROTATE_*` 是逆时针旋转)
+_ROTATE_TRANSPOSE = {0: None, 90: _Transpose.ROTATE_270, 180: _Transpose.ROTATE_180, 270: _Transpose.ROTATE_90}
+# transpose操作对像素坐标(以图像中心为原点，x向右，y向下)的变换矩阵 (a, b, c, d)：(x, y) -> (ax+by, cx+dy)
+_TRANSPOSE_MATRIX = {
+    None: (1, 0, 0, 1),
+    _Transpose.FLIP_LEFT_RIGHT: (-1, 0, 0, 1),
+    _Transpose.FLIP_TOP_BOTTOM: (1, 0, 0, -1),
+    _Transpose.ROTATE_90: (0, 1, -1, 0),
+    _Transpose.ROTATE_180: (-1, 0, 0, -1),
+    _Transpose.ROTATE_270: (0, -1, 1, 0),
+    _Transpose.TRANSPOSE: (0, 1, 1, 0),
+    _Transpose.TRANSVERSE: (0, -1, -1, 0),
+}
+_MATRIX_TRANSPOSE = {v: k for k, v in _TRANSPOSE_MATRIX.items()}
+_XMP_ORIENTATION = r'tiff:Orientation="[0-9]"|<tiff:Orientation>[0-9]</tiff:Orientation>'
+
+
+def get_orientation(im: Image.Image) -> int:
+    """读取EXIF(或XMP)中的方向信息，see `enums.ImageOrientation`；没有或无效时返回1
+
+    Pillow会缓存图像解析的EXIF，同一个图像对象只解析一次；每次处理只需要在打开输入图像后读取一次。
     """
-    # 去掉方向信息
     orientation = im.getexif().get(0x0112)
-    if orientation and 2 <= orientation <= 8:
-        im = ImageOps.exif_transpose(im)
+    return int(orientation) if orientation in _ORIENTATION_TRANSPOSE else 1
+
+
+def is_transposed(orientation: int) -> bool:
+    """按方向信息摆正图像时是否交换宽高"""
+    return orientation >= enums.ImageOrientation.LEFT_TOP.value
+
+
+def orientation_transpose(orientation: int, rotate: int = 0) -> typing.Any:
+    """按方向信息摆正图像、再顺时针旋转 `rotate` 度，合并成一个transpose操作
+
+    Args:
+        orientation: EXIF中的方向信息
+        rotate: 摆正后顺时针旋转的度数，必须是90的倍数
 
-    if im.mode not in ["RGB", "RGBA"]:
-        # 统一处理成RGBA进行操作:
-        # 1. 像rotate/resize操作需要RGB模式；
-        # 2. 像水印操作需要RGBA；
-        im = im.convert("RGBA")
+    Returns:
+        `Image.transpose` 的参数；不需要变换时返回None
+    """
+    a, b, c, d = _TRANSPOSE_MATRIX[_ORIENTATION_TRANSPOSE.get(orientation)]
+    e, f, g, h = _TRANSPOSE_MATRIX[_ROTATE_TRANSPOSE[rotate % 360]]
+    # 先摆正再旋转，变换矩阵相乘
+    return _MATRIX_TRANSPOSE[(e * a + f * c, e * b + f * d, g * a + h * c, g * b + h * d)]
+
+
+def apply_orientation(im: ImageFile.ImageFile, orientation: int, rotate: int = 0) -> ImageFile.ImageFile:
+    """按方向信息摆正图像(同 `ImageOps.exif_transpose`)，并顺时针旋转 `rotate` 度，只做一次transpose
+
+    Args:
+        im: 输入图像
+        orientation: EXIF中的方向信息，see `get_orientation`
+        rotate: 摆正后顺时针旋转的度数，必须是90的倍数
+
+    Returns:
+        输出图像，去掉了元数据中的方向信息；不需要变换时返回输入图像
+    """
+    method = orientation_transpose(orientation, rotate)
+    if method is None:
+        return im
+    out = im.transpose(method)
+    if orientation != 1:
+        _strip_orientation(out)
+    return out
+
+
+def _strip_orientation(im: Image.Image) -> None:
+    """去掉摆正后图像的元数据(从输入图像复制)中的方向信息，同 `ImageOps.exif_transpose`"""
+    exif = im.getexif()
+    if 0x0112 not in exif:
+        return
+    del exif[0x0112]
+    if "exif" in im.info:
+        im.info["exif"] = exif.tobytes()
+    elif "Raw profile type exif" in im.info:
+        im.info["Raw profile type exif"] = exif.tobytes().hex()
+    for key in ("XML:com.adobe.xmp", "xmp"):
+        value = im.info.get(key)
+        if isinstance(value, str):
+            im.info[key] = re.sub(_XMP_ORIENTATION, "", value)
+        elif isinstance(value, tuple):
+            im.info[key] = tuple(re.sub(_XMP_ORIENTATION.encode(), b"", v) for v in value)
+        elif value:
+            im.info[key] = re.sub(_XMP_ORIENTATION.encode(), b"", value)
+
+
+def pre_processing(
+    im: ImageFile.ImageFile, use_alpha: bool = False, use_color: bool = False, mode: typing.Optional[str] = None
+) -> ImageFile.ImageFile:
+    """预处理图像，转换成处理时使用的模式，see `get_working_mode`
+
+    不处理EXIF中的方向信息，输入图像应该已经摆正，see `apply_orientation`
+
+    Args:
+        im: 输入图像
+        use_alpha: 是否处理透明度
+        use_color: 是否需要彩色
+        mode: 直接指定转换成的模式，通常是 `BaseParser.working_mode` 的结果；优先于 `use_alpha`/`use_color`
 
-    if use_alpha and im.mode != "RGBA":
-        im = im.convert("RGBA")
+    Returns:
+        输出图像；模式一致时不会转换，返回输入图像
+    """
+    if mode is None:
+        mode = get_working_mode(im.mode, use_alpha=use_alpha, use_color=use_color)
+    if mode in ["L", "RGB"] and im.info.get("transparency") is not None:
+        # 指定了透明色的图像(例如 `P`)，转换时保留透明度
+        mode = f"{mode}A"
+    if im.mode != mode:
+        im = im.convert(mode)
 
     return im
 
 
+def pixel_bytes(mode: str) -> int:
+    """Pillow中每个像素占用的字节数；多通道的图像(包括RGB)每个像素按4字节存储"""
+    if mode in ["1", "L", "P"]:
+        return 1
+    if mode.startswith("I;16"):
+        return 2
+    return 4
+
+
+def estimate_pre_processing(src_w: int, src_h: int, mode: str, to_mode: str) -> int:
+    """估算 `pre_processing` 将图像从 `mode` 转换成 `to_mode` 新分配的内存字节数"""
+    if mode == to_mode:
+        return 0
+    return src_w * src_h * pixel_bytes(to_mode)
+
+
 def compute_by_geography(
     src_w: int, src_h: int, x: int, y: int, w: int, h: int, g: typing.Optional[str], pf: str
 ) -> tuple[int, int]:
@@ -386,13 +581,91 @@ def copy_full_img(ori_im: ImageFile.ImageFile) -> ImageFile.ImageFile:
     return out_im
 
 
+def _check_file_size(size: int) -> None:
+    if size > settings.PROCESSOR_MAX_FILE_SIZE * 1024 * 1024:
+        raise ProcessLimitException(f"图像文件大小不得超过{settings.PROCESSOR_MAX_FILE_SIZE}MB")
+
+
+def _validate_im_header(fp: typing.BinaryIO) -> bool:
+    """尝试用已读取的内容解析图像头信息，解析成功则校验图像宽高限制
+
+    Returns:
+        是否已完成校验
+    """
+    pos = fp.tell()
+    fp.seek(0)
+    try:
+        with Image.open(fp) as im:
+            validate_ori_im(im)
+        return True
+    except (OSError, SyntaxError):
+        # 内容还不足以解析出图像头信息
+        return False
+    finally:
+        fp.seek(pos)
+
+
+def read_im_stream(fp: typing.BinaryIO, content_length: typing.Optional[int] = None) -> io.BytesIO:
+    """从可读的文件对象中读取图像内容到内存，读取过程中校验文件大小和图像宽高限制，超出限制立即中断读取
+
+    Args:
+        fp: 可读的文件对象，例如 HTTP 响应、上传的文件
+        content_length: 已知的内容长度，超过文件大小限制直接中断
+
+    Raises:
+        ProcessLimitException: 处理图像大小/像素限制
+
+    Returns:
+        包含图像内容的内存文件对象
+    """
+    if content_length is not None:
+        _check_file_size(content_length)
+
+    buf = io.BytesIO()
+    size = 0
+    # 图像头信息解析成功前，每当读取的内容翻倍尝试解析一次
+    validated, next_check = False, _READ_CHUNK_SIZE
+    while True:
+        chunk = fp.read(_READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        buf.write(chunk)
+        size += len(chunk)
+        _check_file_size(size)
+        if not validated and size >= next_check:
+            validated = _validate_im_header(buf)
+            next_check = size * 2
+    buf.seek(0)
+    return buf
+
+
+def is_url(uri: str) -> bool:
+    """是否是可下载的链接地址"""
+    return urllib.parse.urlparse(uri).scheme in _ALLOW_SCHEMES
+
+
+def download_im(uri: str) -> io.BytesIO:
+    """下载链接地址的图像到内存中，下载过程中校验文件大小和图像宽高限制
+
+    Raises:
+        ProcessLimitException: 处理图像大小/像素限制
+
+    Returns:
+        包含图像内容的内存文件对象
+    """
+    with get_fetcher().open(uri) as resp:
+        return read_im_stream(typing.cast(typing.BinaryIO, resp), resp.content_length)
+
+
 @contextmanager
-def trans_uri_to_im(uri: str, use_copy: bool = False) -> typing.Generator:
+def trans_uri_to_im(
+    uri: typing.Union[str, bytes, bytearray, memoryview, typing.BinaryIO], use_copy: bool = False
+) -> typing.Generator:
     """将输入资源转换成Image对象
 
     Args:
-        uri: 文件路径 或者 可下载的链接地址
-        use_copy: 是否复制图像，使其不依赖打开的文件
+        uri: 文件路径、可下载的链接地址；也可以是图像的二进制内容(bytes/memoryview)或可读的文件对象
+        use_copy: 是否使图像不依赖打开的文件，在with之外也可以正常使用
 
     Raises:
         ProcessLimitException: 处理图像大小/像素限制
@@ -400,35 +673,228 @@ def trans_uri_to_im(uri: str, use_copy: bool = False) -> typing.Generator:
     Returns:
         Image对象
     """
-    parsed_url = urllib.parse.urlparse(uri)
-    if parsed_url.scheme in _ALLOW_SCHEMES:
-        # 可能包含 %20 (空格) 等编码，需要 unquote
-        filename = os.path.basename(urllib.parse.unquote(parsed_url.path))
-        _, suffix = os.path.splitext(filename)
-        with tempfile.NamedTemporaryFile(suffix=suffix, dir=settings.PROCESSOR_TEMP_DIR) as fp:
-            # 输入值计算md5作为文件名；重复地址本地若存在不下载多次
-            urlretrieve(uri, filename=fp.name)
-            fp.seek(0)
-
-            size = os.path.getsize(fp.name)
-            if size > settings.PROCESSOR_MAX_FILE_SIZE * 1024 * 1024:
-                raise ProcessLimitException(f"图像文件大小不得超过{settings.PROCESSOR_MAX_FILE_SIZE}MB")
-
-            with Image.open(fp) as uri_im:
-                validate_ori_im(uri_im)
-                # 解决临时文件close后im对象不能正常使用得问题
-                ori_im = copy_full_img(uri_im)
-                yield ori_im
-    else:
-        size = os.path.getsize(uri)
-        if size > settings.PROCESSOR_MAX_FILE_SIZE * 1024 * 1024:
-            raise ProcessLimitException(f"图像文件大小不得超过{settings.PROCESSOR_MAX_FILE_SIZE}MB")
-        with Image.open(uri) as uri_im:
+    with hooks.stage("load") as event:
+        fp: typing.Union[str, io.BytesIO]
+        if isinstance(uri, str) and not is_url(uri):
+            nbytes = os.path.getsize(uri)
+            _check_file_size(nbytes)
+            fp = uri
+        else:
+            if isinstance(uri, str):
+                # 链接地址直接下载到内存中，不经过临时文件
+                fp = download_im(uri)
+            elif isinstance(uri, (bytes, bytearray, memoryview)):
+                _check_file_size(memoryview(uri).nbytes)
+                fp = io.BytesIO(uri)
+            else:
+                fp = read_im_stream(uri)
+            nbytes = fp.getbuffer().nbytes
+
+        uri_im = Image.open(fp)
+        try:
             validate_ori_im(uri_im)
             ori_im = uri_im
             if use_copy:
-                ori_im = copy_full_img(ori_im)
-            yield ori_im
+                if isinstance(fp, str):
+                    ori_im = copy_full_img(uri_im)
+                else:
+                    # 内容已经在内存中，加载后即可不依赖文件对象，无需复制图像
+                    uri_im.load()
+        except BaseException:
+            uri_im.close()
+            raise
+        event.done(ori_im, nbytes=nbytes, name=uri_im.format)
+
+    with uri_im:
+        yield ori_im
+
+
+def digest_input(
+    uri: typing.Union[str, bytes, bytearray, memoryview, typing.BinaryIO]
+) -> tuple[typing.Union[str, bytes, bytearray, memoryview], str]:
+    """计算输入图像的摘要，用于缓存图像处理结果
+
+    文件路径使用(绝对路径, 修改时间, 大小)，不读取文件内容；链接地址和文件对象读取到内存后计算内容的sha256，
+    并返回读取到的内容用于后续解码，不会重复下载或读取。
+
+    Args:
+        uri: 同 `trans_uri_to_im`
+
+    Raises:
+        ProcessLimitException: 处理图像大小/像素限制
+
+    Returns:
+        (后续用于解码的输入, 摘要)
+    """
+    data = read_input(uri)
+    if isinstance(data, str):
+        stat = os.stat(data)
+        return data, f"file:{os.path.realpath(data)}:{stat.st_mtime_ns}:{stat.st_size}"
+    return data, f"sha256:{hashlib.sha256(data).hexdigest()}"
+
+
+def read_input(
+    uri: typing.Union[str, bytes, bytearray, memoryview, typing.BinaryIO]
+) -> typing.Union[str, bytes, bytearray, memoryview]:
+    """链接地址和文件对象读取到内存中，文件路径和二进制内容原样返回
+
+    Args:
+        uri: 同 `trans_uri_to_im`
+
+    Raises:
+        ProcessLimitException: 处理图像大小限制
+
+    Returns:
+        文件路径或图像的二进制内容，可以直接传递给 `trans_uri_to_im`
+    """
+    if isinstance(uri, str):
+        if is_url(uri):
+            return download_im(uri).getvalue()
+        return uri
+    if isinstance(uri, (bytes, bytearray, memoryview)):
+        return uri
+    return read_im_stream(uri).getvalue()
+
+
+def _decode_overlay_im(uri: typing.Union[str, bytes]) -> ImageFile.ImageFile:
+    with trans_uri_to_im(uri, use_copy=True) as im:
+        im = apply_orientation(im, get_orientation(im))
+        return pre_processing(im, use_alpha=True, use_color=True)
+
+
+@contextmanager
+def overlay_scope(overlays: typing.Optional[dict] = None) -> typing.Generator[dict, None, None]:
+    """在with中，每个叠加图像只读取(或重新验证)一次，同一次处理中的缓存key和各个操作使用同一个版本的图像
+
+    已经在其他scope中时沿用外层的scope。
+
+    Args:
+        overlays: 已读取的叠加图像 {uri: `load_overlay` 的返回值}，例如在IO线程中预先下载的
+
+    Returns:
+        当前scope中已读取的叠加图像
+    """
+    scope = _overlay_scope.get()
+    if scope is not None:
+        scope.update(overlays or {})
+        yield scope
+        return
+    scope = dict(overlays or {})
+    token = _overlay_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _overlay_scope.reset(token)
+
+
+def load_overlay(uri: str) -> tuple[typing.Optional[tuple], ImageFile.ImageFile]:
+    """读取水印、合并等叠加在输入图像上的图像，预处理成 `RGBA`
+
+    结果缓存在 `overlay_cache` 中：
+    - 文件路径按修改时间和文件大小判断是否变化；
+    - 链接地址在Cache-Control有效期内直接使用，过期后按ETag/Last-Modified重新验证；
+      没有ETag/Last-Modified时缓存 `PROCESSOR_OVERLAY_CACHE_TTL` 秒(Cache-Control有效期更长时按有效期)，过期后重新下载；
+      响应为 `no-store` 时不缓存。
+
+    在 `overlay_scope` 中时，同一个叠加图像只读取一次。返回的图像会被多次复用，调用方不能修改。
+
+    Args:
+        uri: 文件路径或链接地址
+
+    Returns:
+        (版本, `RGBA` 模式的图像)；版本是文件的(修改时间, 大小)，链接的(ETag, Last-Modified)，
+        链接没有ETag/Last-Modified时是(None, None, 内容的sha256)
+    """
+    scope = _overlay_scope.get()
+    if scope is None:
+        return _load_overlay(uri)
+    result = scope.get(uri)
+    if result is None:
+        result = scope[uri] = _load_overlay(uri)
+    return result
+
+
+def _load_overlay(uri: str) -> tuple[typing.Optional[tuple], ImageFile.ImageFile]:
+    cached = overlay_cache.get(uri)
+    if urllib.parse.urlparse(uri).scheme not in _ALLOW_SCHEMES:
+        stat = os.stat(uri)
+        version: typing.Optional[tuple] = (stat.st_mtime_ns, stat.st_size)
+        if cached is not None and cached[0] == version:
+            return cached[0], cached[1]
+        im = _decode_overlay_im(uri)
+        overlay_cache.set(uri, (version, im, None))
+        return version, im
+
+    now = time.time()
+    if cached is not None and cached[2] > now:
+        # 仍在有效期内，不需要重新验证
+        return cached[0], cached[1]
+    etag, last_modified = cached[0][:2] if cached else (None, None)
+    with get_fetcher().open(uri, etag=etag, last_modified=last_modified) as resp:
+        max_age = resp.max_age
+        if resp.not_modified and cached:
+            if max_age is not None:
+                overlay_cache.set(uri, (cached[0], cached[1], now + max_age))
+            return cached[0], cached[1]
+        validators = (resp.etag, resp.last_modified)
+        fp = read_im_stream(typing.cast(typing.BinaryIO, resp), resp.content_length)
+    data = fp.getvalue()
+    im = _decode_overlay_im(data)
+    if any(validators):
+        version = validators
+    else:
+        # 无法重新验证，按内容区分版本；缓存一段时间，避免每次重新下载和解码
+        version = (None, None, hashlib.sha256(data).hexdigest())
+        if max_age is not None:
+            max_age = max(max_age, settings.PROCESSOR_OVERLAY_CACHE_TTL)
+    if max_age is not None:
+        overlay_cache.set(uri, (version, im, now + max_age))
+    return version, im
+
+
+def load_overlay_im(uri: str) -> ImageFile.ImageFile:
+    """同 `load_overlay`，只返回图像"""
+    return load_overlay(uri)[1]
+
+
+def _probe_size(im: Image.Image) -> tuple[int, int]:
+    w, h = im.size
+    return (h, w) if is_transposed(get_orientation(im)) else (w, h)
+
+
+def probe_overlay_size(uri: str) -> tuple[int, int]:
+    """获取叠加图像(已按EXIF方向摆正)的宽高，用于估算内存
+
+    优先使用当前处理或 `overlay_cache` 中已读取的图像(不重新验证)；否则文件路径只读取文件头。
+    链接地址在 `overlay_scope` 中时通过 `load_overlay` 读取，之后执行操作时直接使用，不会重复下载；
+    不在scope中时只下载到能解析出宽高为止(最多 `_PROBE_MAX_SIZE`)，仍无法解析时读取整个图像。
+    """
+    scope = _overlay_scope.get()
+    cached = scope.get(uri) if scope else None
+    if cached is None:
+        cached = overlay_cache.get(uri)
+    if cached is not None:
+        return cached[1].size
+    if not is_url(uri):
+        with Image.open(uri) as im:
+            return _probe_size(im)
+    if scope is not None:
+        return load_overlay_im(uri).size
+    buf = io.BytesIO()
+    with get_fetcher().open(uri) as resp:
+        while buf.tell() < _PROBE_MAX_SIZE:
+            chunk = resp.read(_READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            buf.write(chunk)
+            buf.seek(0)
+            try:
+                with Image.open(buf) as im:
+                    return _probe_size(im)
+            except (OSError, SyntaxError):
+                # 文件头还不完整，继续读取
+                buf.seek(0, io.SEEK_END)
+    return load_overlay_im(uri).size
 
 
 class ImgSaveParser(BaseParser):
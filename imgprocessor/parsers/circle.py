@@ -1,16 +1,66 @@
 #!/usr/bin/env python
 # coding=utf-8
 import typing
+import math
 
-from PIL import Image, ImageDraw, ImageFile
+from PIL import Image, ImageOps, ImageFile
 
-from imgprocessor import enums, settings
-from .base import BaseParser, pre_processing
+from imgprocessor import enums, settings, utils
+from imgprocessor.cache import LRUCache
+from .base import BaseParser, pre_processing, estimate_pre_processing, get_working_mode
+
+
+# 左上角的圆角遮罩，key是半径；按像素数据大小限制容量
+mask_cache = LRUCache(settings.PROCESSOR_CIRCLE_CACHE_SIZE * 1024 * 1024, sizeof=utils.get_im_nbytes)
+
+
+def _cell_coverage(a: int, b: int, r: int) -> float:
+    """圆心在原点、半径为r的圆覆盖像素 [a, a+1] x [b, b+1] 的面积(a、b>=0)"""
+    # x <= x1 时整列都在圆内，x >= x0 时整列都在圆外
+    x1 = math.sqrt(r * r - (b + 1) ** 2)
+    x0 = math.sqrt(r * r - b * b)
+
+    def integral(x: float) -> float:
+        # sqrt(r^2 - x^2) 的原函数
+        return (x * math.sqrt(max(r * r - x * x, 0)) + r * r * math.asin(min(x / r, 1))) / 2
+
+    area = max(min(a + 1, x1) - a, 0)
+    start, end = max(a, x1), min(a + 1, x0)
+    if end > start:
+        area += integral(end) - integral(start) - b * (end - start)
+    return area
+
+
+def get_corner_mask(rad: int) -> Image.Image:
+    """左上角的圆角遮罩，`L` 模式，大小为 (rad, rad)
+
+    按圆覆盖每个像素的面积计算透明度(抗锯齿)，只有圆弧经过的像素需要计算，内存只占用遮罩本身；结果缓存在 `mask_cache` 中。
+    返回的图像会被多次复用，调用方不能修改。
+    """
+    mask = mask_cache.get(rad)
+    if mask is not None:
+        return mask
+    r2 = rad * rad
+    data = bytearray()
+    # 以圆心为原点，从上往下逐行计算：第j行对应 [b, b+1]，左边是圆外，右边是圆内
+    for b in range(rad - 1, -1, -1):
+        # 整个像素都在圆内的数量
+        full = math.isqrt(r2 - (b + 1) ** 2)
+        # 与圆有交集的像素数量
+        s = math.isqrt(r2 - b * b)
+        covered = min(s if s * s == r2 - b * b else s + 1, rad)
+        data += bytes(rad - covered)
+        data += bytes(round(_cell_coverage(a, b, rad) * 255) for a in range(covered - 1, full - 1, -1))
+        data += b"\xff" * full
+    mask = Image.frombytes("L", (rad, rad), bytes(data))
+    mask_cache.set(rad, mask)
+    return mask
 
 
 class CircleParser(BaseParser):
 
     KEY = enums.OpAction.CIRCLE.value
+    IN_PLACE = True
     ARGS = {
         "r": {"type": enums.ArgType.INTEGER.value, "default": 0, "min": 1, "max": settings.PROCESSOR_MAX_W_H},
     }
@@ -32,22 +82,36 @@ class CircleParser(BaseParser):
 
         return r
 
+    def working_mode(self, mode: str) -> str:
+        return get_working_mode(mode, use_alpha=True)
+
+    def estimate_memory(self, src_w: int, src_h: int, mode: str) -> tuple[int, int, str, int]:
+        to_mode = self.working_mode(mode)
+        nbytes = estimate_pre_processing(src_w, src_h, mode, to_mode)
+        rad = self.compute(src_w, src_h)
+        # 圆角遮罩及生成时的缓冲区 + 每个角：区域图像、翻转后的遮罩
+        nbytes += rad * rad * (2 + 4 + 1)
+        return src_w, src_h, to_mode, nbytes
+
     def do_action(self, im: ImageFile.ImageFile) -> ImageFile.ImageFile:
-        im = pre_processing(im, use_alpha=True)
+        im = pre_processing(im, mode=self.working_mode(im.mode))
 
         src_w, src_h = im.size
         rad = self.compute(*im.size)
-        # 放大倍数，解决圆角锯齿问题
-        expand = 6
-        new_rad = rad * expand
-        circle = Image.new("L", (new_rad * 2, new_rad * 2), 0)
-        ImageDraw.Draw(circle).ellipse((0, 0, new_rad * 2, new_rad * 2), fill=255)
-        circle = circle.resize((rad * 2, rad * 2), resample=Image.LANCZOS)
-
-        alpha = Image.new("L", (src_w, src_h), 255)
-        alpha.paste(circle.crop((0, 0, rad, rad)), (0, 0))
-        alpha.paste(circle.crop((0, rad, rad, rad * 2)), (0, src_h - rad))
-        alpha.paste(circle.crop((rad, 0, rad * 2, rad)), (src_w - rad, 0))
-        alpha.paste(circle.crop((rad, rad, rad * 2, rad * 2)), (src_w - rad, src_h - rad))
-        im.putalpha(alpha)
+        # 透明度替换成圆角遮罩：先直接填充成不透明(不分配新的透明度通道)，再只处理四个角的区域
+        im.putalpha(255)
+        if not rad:
+            return im
+        mask = get_corner_mask(rad)
+        corners = [
+            ((0, 0), mask),
+            ((src_w - rad, 0), ImageOps.mirror(mask)),
+            ((0, src_h - rad), ImageOps.flip(mask)),
+            ((src_w - rad, src_h - rad), mask.rotate(180)),
+        ]
+        for (x, y), corner in corners:
+            box = (x, y, x + rad, y + rad)
+            region = im.crop(box)
+            region.putalpha(corner)
+            im.paste(region, box)
         return im
@@ -4,7 +4,14 @@ import typing
 from PIL import ImageFile
 from imgprocessor import enums, settings
 from imgprocessor.exceptions import ParamValidateException
-from .base import BaseParser, pre_processing, compute_by_geography, compute_by_ratio
+from .base import (
+    BaseParser,
+    pre_processing,
+    compute_by_geography,
+    compute_by_ratio,
+    estimate_pre_processing,
+    pixel_bytes,
+)
 
 
 class CropParser(BaseParser):
@@ -89,8 +96,20 @@ class CropParser(BaseParser):
 
         return x, y, w, h
 
+    def compute_output_size(self, src_w: int, src_h: int) -> tuple[int, int]:
+        _, _, w, h = self.compute(src_w, src_h)
+        return w, h
+
+    def estimate_memory(self, src_w: int, src_h: int, mode: str) -> tuple[int, int, str, int]:
+        to_mode = self.working_mode(mode)
+        nbytes = estimate_pre_processing(src_w, src_h, mode, to_mode)
+        x, y, w, h = self.compute(src_w, src_h)
+        if x != 0 or y != 0 or (w, h) != (src_w, src_h):
+            nbytes += w * h * pixel_bytes(to_mode)
+        return w, h, to_mode, nbytes
+
     def do_action(self, im: ImageFile.ImageFile) -> ImageFile.ImageFile:
-        im = pre_processing(im)
+        im = pre_processing(im, mode=self.working_mode(im.mode))
         x, y, w, h = self.compute(*im.size)
 
         if x == 0 and y == 0 and (w, h) == im.size:
@@ -19,6 +19,13 @@ class GrayParser(BaseParser):
     ) -> None:
         pass
 
+    def working_mode(self, mode: str) -> str:
+        # 直接从输入图像的模式转换成灰度图
+        return mode
+
+    def estimate_memory(self, src_w: int, src_h: int, mode: str) -> tuple[int, int, str, int]:
+        return src_w, src_h, "L", src_w * src_h
+
     def do_action(self, im: ImageFile.ImageFile) -> ImageFile.ImageFile:
         im = im.convert("L")
         return im
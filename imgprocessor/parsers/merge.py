@@ -9,9 +9,12 @@ from imgprocessor.exceptions import ParamValidateException
 from .base import (
     BaseParser,
     pre_processing,
+    estimate_pre_processing,
+    get_working_mode,
     compute_by_geography,
     compute_splice_two_im,
-    trans_uri_to_im,
+    load_overlay_im,
+    probe_overlay_size,
 )
 
 
@@ -115,17 +118,42 @@ class MergeParser(BaseParser):
 
         return w, h, x1, y1, x2, y2
 
+    def compute_output_size(self, src_w: int, src_h: int) -> None:
+        # 依赖合并图像的大小，需打开图像才能计算
+        return None
+
+    def working_mode(self, mode: str) -> str:
+        return get_working_mode(mode, use_alpha=True, use_color=True)
+
+    def estimate_memory(self, src_w: int, src_h: int, mode: str) -> tuple[int, int, str, int]:
+        from imgprocessor.memory import estimate_actions
+
+        nbytes = estimate_pre_processing(src_w, src_h, mode, self.working_mode(mode))
+        # 合并的图像解码后缓存，只计算处理时新分配的内存；只获取宽高，see `probe_overlay_size`
+        w2, h2 = probe_overlay_size(self.image)
+        if self.actions:
+            w2, h2, _, peak = estimate_actions(w2, h2, "RGBA", self.actions)
+            nbytes += peak
+        if self.bg:
+            src_w, src_h, w2, h2 = w2, h2, src_w, src_h
+        if self.p:
+            w2, h2 = round(src_w * self.p / 100), round(src_h * self.p / 100)
+            nbytes += w2 * h2 * 4
+        w, h, _, _, _, _ = self.compute(src_w, src_h, w2, h2)
+        nbytes += w * h * 4
+        return w, h, "RGBA", nbytes
+
     def do_action(self, im: ImageFile.ImageFile) -> ImageFile.ImageFile:
-        im = pre_processing(im, use_alpha=True)
+        im = pre_processing(im, mode=self.working_mode(im.mode))
 
-        # 处理要合并的图像
-        with trans_uri_to_im(self.image, use_copy=True) as _im2:
-            im2 = pre_processing(_im2, use_alpha=True)
+        # 处理要合并的图像；im2是缓存的图像，不能修改
+        im2 = load_overlay_im(self.image)
 
         if self.actions:
             from imgprocessor.processor import ProcessorCtr
 
-            im2 = ProcessorCtr.handle_img_actions(im2, self.actions)
+            # 不会修改缓存的图像；缓存的图像已经摆正
+            im2 = ProcessorCtr.handle_img_actions(im2, self.actions, orientation=1)
 
         # 调整拼接顺序
         if self.bg:
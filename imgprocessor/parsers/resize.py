@@ -1,11 +1,18 @@
 #!/usr/bin/env python
 # coding=utf-8
 import typing
+import math
 
-from PIL import Image, ImageOps, ImageFile
+from PIL import Image, ImageOps, ImageFile, ImageColor
 from imgprocessor import enums, settings
 from imgprocessor.exceptions import ParamValidateException, ProcessLimitException
-from .base import BaseParser, pre_processing
+from .base import BaseParser, pre_processing, estimate_pre_processing, get_working_mode, pixel_bytes
+
+
+# 插值算法对应的 `Image.resize` 参数
+_RESAMPLE = {value: getattr(Image, value.upper()) for value in enums.ResizeFilter.values}
+# 快速模式下 `Image.resize` 的reducing_gap：先用 `Image.reduce` 按整数倍缩小，剩余的缩放倍数不小于该值再插值
+_FAST_REDUCING_GAP = 2.0
 
 
 class ResizeParser(BaseParser):
@@ -28,6 +35,10 @@ class ResizeParser(BaseParser):
             "regex": r"^([0-9a-fA-F]{6}|[0-9a-fA-F]{8}|[0-9a-fA-F]{3,4})$",
         },
         "p": {"type": enums.ArgType.INTEGER.value, "default": 0, "min": 1, "max": 1000},
+        # 插值算法，默认 `pad`/`fit` 为 `bicubic`，其他为 `lanczos`
+        "f": {"type": enums.ArgType.STRING.value, "default": None, "choices": enums.ResizeFilter},
+        # 快速模式：大比例缩小时先按整数倍缩小
+        "fast": {"type": enums.ArgType.INTEGER.value, "default": 0, "choices": [0, 1]},
     }
 
     def __init__(
@@ -40,6 +51,8 @@ class ResizeParser(BaseParser):
         limit: int = 1,
         color: str = "FFFFFF",
         p: int = 0,
+        f: typing.Optional[str] = None,
+        fast: int = 0,
         **kwargs: typing.Any,
     ) -> None:
         self.m = m
@@ -50,6 +63,8 @@ class ResizeParser(BaseParser):
         self.limit = limit
         self.color = color
         self.p = p
+        self.f = f
+        self.fast = fast
 
     def compute(self, src_w: int, src_h: int) -> tuple:
         """计算出`Image.resize`需要的参数"""
@@ -112,16 +127,110 @@ class ResizeParser(BaseParser):
             raise ProcessLimitException(f"缩放的目标图像总像素不可超过{settings.PROCESSOR_MAX_PIXEL}像素")
         return (w, h)
 
+    def compute_output_size(self, src_w: int, src_h: int) -> tuple[int, int]:
+        return self.compute(src_w, src_h)
+
+    def get_resample(self) -> int:
+        """`Image.resize` 的插值算法；未指定时 `pad`/`fit` 为 `bicubic`(同 `ImageOps.pad`/`ImageOps.fit`)，其他为 `lanczos`"""
+        f = self.f
+        if not f:
+            if self.m in [enums.ResizeMode.PAD.value, enums.ResizeMode.FIT.value]:
+                f = enums.ResizeFilter.BICUBIC.value
+            else:
+                f = enums.ResizeFilter.LANCZOS.value
+        return _RESAMPLE[f]
+
+    def resize(
+        self,
+        im: ImageFile.ImageFile,
+        size: tuple[int, int],
+        box: typing.Optional[tuple[float, float, float, float]] = None,
+    ) -> ImageFile.ImageFile:
+        """按参数指定的插值算法缩放图像(box区域)；快速模式下大比例缩小时先用 `Image.reduce` 按整数倍缩小"""
+        reducing_gap = _FAST_REDUCING_GAP if self.fast else None
+        return im.resize(size, resample=self.get_resample(), box=box, reducing_gap=reducing_gap)
+
+    def working_mode(self, mode: str) -> str:
+        if self.m != enums.ResizeMode.PAD.value:
+            return get_working_mode(mode)
+        rgba = ImageColor.getrgb(f"#{self.color}")
+        r, g, b = rgba[:3]
+        alpha = rgba[3] if len(rgba) == 4 else 255
+        # 填充彩色时灰度图需要转换成彩色；RGB图像(例如JPEG)填充时忽略颜色的透明度
+        return get_working_mode(mode, use_alpha=alpha < 255 and mode != "RGB", use_color=not r == g == b)
+
+    def estimate_memory(self, src_w: int, src_h: int, mode: str) -> tuple[int, int, str, int]:
+        to_mode = self.working_mode(mode)
+        nbytes = estimate_pre_processing(src_w, src_h, mode, to_mode)
+        w, h = self.compute(src_w, src_h)
+        if (w, h) != (src_w, src_h):
+            fh = 1
+            if self.fast:
+                # 同 `Image.resize` 中reducing_gap的计算方式，先按整数倍缩小
+                fw, fh = int(src_w / w / _FAST_REDUCING_GAP) or 1, int(src_h / h / _FAST_REDUCING_GAP) or 1
+                if fw > 1 or fh > 1:
+                    nbytes += math.ceil(src_w / fw) * math.ceil(src_h / fh) * pixel_bytes(to_mode)
+            # 输出图像 + 先缩放宽度再缩放高度的中间图像
+            nbytes += (w * h + w * math.ceil(src_h / fh)) * pixel_bytes(to_mode)
+            if self.m == enums.ResizeMode.PAD.value:
+                # 填充的画布
+                nbytes += w * h * pixel_bytes(to_mode)
+        return w, h, to_mode, nbytes
+
     def do_action(self, im: ImageFile.ImageFile) -> ImageFile.ImageFile:
-        im = pre_processing(im)
+        im = pre_processing(im, mode=self.working_mode(im.mode))
         size = self.compute(*im.size)
         if size == im.size:
             # 大小没有变化直接返回
             return im
+        out: Image.Image
         if self.m == enums.ResizeMode.PAD.value:
-            out = ImageOps.pad(im, size, color=f"#{self.color}")
+            if self.fast:
+                out = self.pad(im, size)
+            else:
+                # 不同版本Pillow计算缩放大小和位置的方式不同(int/round)，与各版本的 `ImageOps.pad` 保持一致
+                out = ImageOps.pad(im, size, method=self.get_resample(), color=f"#{self.color}")
         elif self.m == enums.ResizeMode.FIT.value:
-            out = ImageOps.fit(im, size)
+            if self.fast:
+                # 只缩放居中裁剪的区域，不需要先裁剪
+                out = self.resize(im, size, box=compute_fit_box(*im.size, *size))
+            else:
+                out = ImageOps.fit(im, size, method=self.get_resample())
+        else:
+            out = self.resize(im, size)
+        return out
+
+    def pad(self, im: ImageFile.ImageFile, size: tuple[int, int]) -> ImageFile.ImageFile:
+        """快速模式的 `pad`：等比缩放到size的矩形内，再居中粘贴到填充颜色的画布上
+
+        `ImageOps.pad` 不支持reducing_gap，按新版本Pillow的 `ImageOps.pad` 计算大小和位置(round)，
+        低版本Pillow中 `ImageOps.pad` 使用int取整，宽高和位置可能相差1个像素。缩放后的大小与size一致时不需要画布。
+        """
+        w, h = size
+        src_w, src_h = im.size
+        # 同 `ImageOps.contain` 计算缩放后的大小
+        if src_w * h > w * src_h:
+            rw, rh = w, round(src_h / src_w * w)
+        elif src_w * h < w * src_h:
+            rw, rh = round(src_w / src_h * h), h
         else:
-            out = im.resize(size, resample=Image.LANCZOS)
+            rw, rh = w, h
+        resized = self.resize(im, (rw, rh)) if (rw, rh) != im.size else im
+        if (rw, rh) == size:
+            return resized
+        out = Image.new(im.mode, size, f"#{self.color}")
+        out.paste(resized, (round((w - rw) / 2), round((h - rh) / 2)))
         return out
+
+
+def compute_fit_box(src_w: int, src_h: int, w: int, h: int) -> tuple[float, float, float, float]:
+    """`fit` 模式下居中裁剪的区域，裁剪后的宽高比与 (w, h) 一致，同新版本Pillow的 `ImageOps.fit`"""
+    src_ratio, ratio = src_w / src_h, w / h
+    if src_ratio == ratio:
+        return (0, 0, src_w, src_h)
+    if src_ratio > ratio:
+        crop_w, crop_h = ratio * src_h, float(src_h)
+    else:
+        crop_w, crop_h = float(src_w), src_w / ratio
+    left, top = (src_w - crop_w) / 2, (src_h - crop_h) / 2
+    return (left, top, left + crop_w, top + crop_h)
@@ -1,11 +1,12 @@
 #!/usr/bin/env python
 # coding=utf-8
 import typing
+import math
 
 from PIL import ImageFile
 
 from imgprocessor import enums
-from .base import BaseParser, pre_processing
+from .base import BaseParser, pre_processing, estimate_pre_processing, get_working_mode, pixel_bytes
 
 
 class RotateParser(BaseParser):
@@ -23,8 +24,40 @@ class RotateParser(BaseParser):
     ) -> None:
         self.value = value
 
+    def compute_output_size(self, src_w: int, src_h: int) -> tuple[int, int]:
+        angle = (360 - self.value) % 360
+        if angle == 0 or angle == 180:
+            return src_w, src_h
+        if angle == 90 or angle == 270:
+            return src_h, src_w
+        # 同 Image.rotate(expand=True) 中计算输出大小的方式
+        rad = -math.radians(angle)
+        a, b = round(math.cos(rad), 15), round(math.sin(rad), 15)
+        d, e = round(-math.sin(rad), 15), round(math.cos(rad), 15)
+        cx, cy = src_w / 2, src_h / 2
+        c = a * -cx + b * -cy + cx
+        f = d * -cx + e * -cy + cy
+        xx, yy = [], []
+        for x, y in ((0, 0), (src_w, 0), (src_w, src_h), (0, src_h)):
+            xx.append(a * x + b * y + c)
+            yy.append(d * x + e * y + f)
+        return math.ceil(max(xx)) - math.floor(min(xx)), math.ceil(max(yy)) - math.floor(min(yy))
+
+    def working_mode(self, mode: str) -> str:
+        # 非90度倍数的旋转，四角空白的部分：RGB图像(例如JPEG)是黑色，其他图像保持透明
+        return get_working_mode(mode, use_alpha=self.value % 90 != 0 and mode != "RGB")
+
+    def estimate_memory(self, src_w: int, src_h: int, mode: str) -> tuple[int, int, str, int]:
+        to_mode = self.working_mode(mode)
+        nbytes = estimate_pre_processing(src_w, src_h, mode, to_mode)
+        w, h = self.compute_output_size(src_w, src_h)
+        if 0 < self.value < 360:
+            # 非90度倍数的旋转，仿射变换时还有一个输出大小的中间图像
+            nbytes += w * h * pixel_bytes(to_mode) * (1 if self.value % 90 == 0 else 2)
+        return w, h, to_mode, nbytes
+
     def do_action(self, im: ImageFile.ImageFile) -> ImageFile.ImageFile:
-        im = pre_processing(im)
+        im = pre_processing(im, mode=self.working_mode(im.mode))
         if 0 < self.value < 360:
             # 函数提供的是逆时针旋转
             im = im.rotate(360 - self.value, expand=True)
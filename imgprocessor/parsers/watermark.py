@@ -2,22 +2,91 @@
 # coding=utf-8
 import typing
 
+import math
+
 from PIL import Image, ImageFont, ImageDraw, ImageFile
 
 from imgprocessor import enums, settings, utils
+from imgprocessor.cache import LRUCache
 from imgprocessor.exceptions import ParamValidateException
 from .base import (
     BaseParser,
     pre_processing,
+    estimate_pre_processing,
+    get_working_mode,
     compute_splice_two_im,
     compute_by_geography,
-    trans_uri_to_im,
+    load_overlay,
+    load_overlay_im,
+)
+
+
+# 已加载的字体，key是(字体文件, 字号)
+font_cache = LRUCache(settings.PROCESSOR_FONT_CACHE_SIZE)
+# 最终粘贴到图像上的水印，key是水印参数和输入图像大小；按像素数据大小限制容量
+mark_cache = LRUCache(
+    settings.PROCESSOR_MARK_CACHE_SIZE * 1024 * 1024, sizeof=lambda value: utils.get_im_nbytes(value[0])
 )
+# 平铺水印时一整行水印的图层，key是水印、水平间距、起始位置和图像宽度；与mark_cache共用容量配置
+fill_cache = LRUCache(
+    settings.PROCESSOR_MARK_CACHE_SIZE * 1024 * 1024, sizeof=lambda value: utils.get_im_nbytes(value[1])
+)
+
+
+def _tile_row(im: Image.Image, width: int) -> Image.Image:
+    """将图像左对齐，水平重复平铺到width宽度；每次复制已平铺的区域，粘贴次数是对数级的"""
+    w, h = im.size
+    out = Image.new(im.mode, (width, h))
+    out.paste(im, (0, 0))
+    filled = w
+    while filled < width:
+        out.paste(out.crop((0, 0, filled, h)), (filled, 0))
+        filled *= 2
+    return out
+
+
+def load_font(font: typing.Optional[str], size: int) -> ImageFont.FreeTypeFont:
+    """加载字体，结果会被缓存复用
+
+    Args:
+        font: 字体文件路径或系统中的字体名称，为空使用 `settings.PROCESSOR_TEXT_FONT`
+        size: 字号
+
+    Raises:
+        ParamValidateException: 未找到字体
+
+    Returns:
+        字体对象
+    """
+    font_path = font or settings.PROCESSOR_TEXT_FONT
+    key = (font_path, size)
+    ft = font_cache.get(key)
+    if ft is None:
+        try:
+            ft = ImageFont.truetype(font_path, size)
+        except OSError:
+            raise ParamValidateException(f"未找到字体 {font_path}")
+        font_cache.set(key, ft)
+    return ft
+
+
+def preload_fonts(fonts: typing.Iterable[tuple[typing.Optional[str], int]]) -> None:
+    """预加载字体，例如在服务启动时加载常用的字体，避免首次处理文字水印时耗时
+
+    Args:
+        fonts: (字体文件, 字号)列表，字体文件为空表示默认字体
+
+    Raises:
+        ParamValidateException: 未找到字体
+    """
+    for font, size in fonts:
+        load_font(font, size)
 
 
 class WatermarkParser(BaseParser):
 
     KEY = enums.OpAction.WATERMARK.value
+    IN_PLACE = True
     ARGS = {
         # 水印本身的不透明度，100表示完全不透明
         "t": {"type": enums.ArgType.INTEGER.value, "default": 100, "min": 0, "max": 100},
@@ -113,23 +182,22 @@ class WatermarkParser(BaseParser):
         if not self.image and not self.text:
             raise ParamValidateException("image或者text参数必须传递一个")
 
-    def get_watermark_im(self) -> ImageFile.ImageFile:
-        """初始化水印对象"""
+    def get_watermark_im(self, icon: typing.Optional[ImageFile.ImageFile] = None) -> ImageFile.ImageFile:
+        """初始化水印对象
+
+        Args:
+            icon: 已读取的图片水印，为空时按 `image` 参数读取
+        """
         w1, h1, w2, h2 = 0, 0, 0, 0
-        icon = None
         if self.image:
-            with trans_uri_to_im(self.image, use_copy=True) as _icon:
-                icon = pre_processing(_icon, use_alpha=True)
+            if icon is None:
+                icon = load_overlay_im(self.image)
             if not self.text:
-                # 没有文字，直接返回
+                # 没有文字，直接返回；注意icon是缓存的图像，不能修改
                 return icon
             w1, h1 = icon.size
 
-        try:
-            _font_path = self.font or settings.PROCESSOR_TEXT_FONT
-            font = ImageFont.truetype(_font_path, self.size)
-        except OSError:
-            raise ParamValidateException(f"未找到字体 {_font_path}")
+        font = load_font(self.font, self.size)
 
         if utils.get_pil_version() >= utils.Version("10.0.0"):
             _, _, w2, h2 = font.getbbox(self.text)
@@ -171,17 +239,22 @@ class WatermarkParser(BaseParser):
 
         return mark
 
-    def do_action(self, im: ImageFile.ImageFile) -> ImageFile.ImageFile:
-        im = pre_processing(im, use_alpha=True)
-        src_w, src_h = im.size
+    def render_mark(
+        self, src_w: int, src_h: int, icon: typing.Optional[ImageFile.ImageFile] = None
+    ) -> tuple[ImageFile.ImageFile, bool, bool]:
+        """生成经过缩放、旋转和透明度处理后，最终粘贴到图像上的水印
 
-        pf = self.pf or ""
-        if self.g:
-            # g在的时候pf不生效
-            pf = ""
+        Args:
+            src_w: 输入图像宽度
+            src_h: 输入图像高度
+            icon: 已读取的图片水印，为空时按 `image` 参数读取
 
-        mark = self.get_watermark_im()
+        Returns:
+            (水印, x是否置为0, y是否置为0)；水印大小超过输入图像时会缩小到输入图像内，相应方向的坐标置为0
+        """
+        mark = self.get_watermark_im(icon=icon)
         w, h = mark.size
+        reset_x, reset_y = False, False
 
         if self.design:
             # 处理缩放
@@ -200,38 +273,119 @@ class WatermarkParser(BaseParser):
             # 水印大小超过原图了, 原图矩形内的最大图像
             if w / h > src_w / src_h:
                 w, h = src_w, round(src_w * h / w)
-                self.x = 0
+                reset_x = True
             else:
                 w, h = round(src_h * w / h), src_h
-                self.y = 0
+                reset_y = True
             mark = mark.resize((w, h), resample=Image.LANCZOS)
 
         if self.t < 100:
             # 处理透明度
             _, _, _, alpha_channel = mark.split()
             alpha_channel = alpha_channel.point(lambda i: min(round(255 * self.t / 100), i))
+            # mark可能是缓存的图像，复制后再修改
+            mark = mark.copy()
             mark.putalpha(alpha_channel)
 
-        # 计算位置，粘贴水印
-        x, y = compute_by_geography(src_w, src_h, self.x, self.y, w, h, self.g, pf)
-        im.paste(mark, (x, y), mark)
+        return mark, reset_x, reset_y
+
+    def get_mark(self, src_w: int, src_h: int) -> tuple[ImageFile.ImageFile, int, int]:
+        """获取最终粘贴到图像上的水印，同样的水印参数和输入图像大小会复用缓存的结果
+
+        Returns:
+            (水印, x, y)；返回的水印会被复用，不能修改
+        """
+        icon, version = None, None
+        if self.image:
+            version, icon = load_overlay(self.image)
+        key = (
+            self.image,
+            version,
+            self.text,
+            self.font or settings.PROCESSOR_TEXT_FONT,
+            self.color,
+            self.size,
+            self.shadow,
+            self.order,
+            self.align,
+            self.interval,
+            self.design,
+            self.rotate,
+            self.t,
+            src_w,
+            src_h,
+        )
+        cached = mark_cache.get(key)
+        if cached is None:
+            cached = self.render_mark(src_w, src_h, icon=icon)
+            if not self.image or version is not None:
+                # 图片水印无法判断是否变化时不缓存
+                mark_cache.set(key, cached)
+        mark, reset_x, reset_y = cached
+        return mark, 0 if reset_x else self.x, 0 if reset_y else self.y
+
+    def working_mode(self, mode: str) -> str:
+        # 水印带有透明度，粘贴时作为蒙版，输入图像不需要透明度
+        return get_working_mode(mode, use_color=True)
+
+    def estimate_memory(self, src_w: int, src_h: int, mode: str) -> tuple[int, int, str, int]:
+        # 直接修改输入图像；水印和平铺的图层有缓存的容量限制，不计算在内
+        to_mode = self.working_mode(mode)
+        return src_w, src_h, to_mode, estimate_pre_processing(src_w, src_h, mode, to_mode)
 
+    def do_action(self, im: ImageFile.ImageFile) -> ImageFile.ImageFile:
+        im = pre_processing(im, mode=self.working_mode(im.mode))
+        src_w, src_h = im.size
+
+        pf = self.pf or ""
+        if self.g:
+            # g在的时候pf不生效
+            pf = ""
+
+        mark, mark_x, mark_y = self.get_mark(src_w, src_h)
+        w, h = mark.size
+
+        # 计算位置，粘贴水印
+        x, y = compute_by_geography(src_w, src_h, mark_x, mark_y, w, h, self.g, pf)
         if self.fill:
-            # 铺满整个图片
-            # 寻找平铺最左上角的原点
-            wx, wy = x, y
-            while wx > 0:
-                wx = wx - w - self.padx
-            while wy > 0:
-                wy = wy - h - self.pady
-            # 往右下角方向平铺
-            ux = wx
-            while ux <= src_w:
-                uy = wy
-                while uy <= src_h:
-                    if (ux, uy) != (x, y):
-                        im.paste(mark, (ux, uy), mark)
-                    uy = uy + h + self.pady
-                ux = ux + w + self.padx
+            # 铺满整个图片，平铺的图层中已包含(x, y)位置的水印
+            self.paste_fill(im, mark, x, y)
+        else:
+            im.paste(mark, (x, y), mark)
 
         return im
+
+    def paste_fill(self, im: ImageFile.ImageFile, mark: ImageFile.ImageFile, x: int, y: int) -> None:
+        """以(x, y)为基准，将水印平铺到整个图像上
+
+        不逐个粘贴水印，而是先生成一整行水印的图层(会被缓存复用)，每行只粘贴一次图层。
+        图层不包含行间距，只处理水印所在行的像素，也不需要创建整个图像大小的图层。
+
+        Args:
+            im: 输入图像，会被直接修改
+            mark: 水印
+            x: 其中一个水印的x坐标
+            y: 其中一个水印的y坐标
+        """
+        src_w, src_h = im.size
+        w, h = mark.size
+        # 每个水印及其间距占用的单元格大小，水印之间不会重叠
+        cw, ch = w + self.padx, h + self.pady
+        # 寻找平铺最左上角的原点
+        wx = x - math.ceil(x / cw) * cw if x > 0 else x
+        wy = y - math.ceil(y / ch) * ch if y > 0 else y
+
+        key = (id(mark), cw, wx, src_w)
+        cached = fill_cache.get(key)
+        if cached is not None and cached[0] is mark:
+            layer = cached[1]
+        else:
+            cell = Image.new("RGBA", (cw, h))
+            cell.paste(mark, (0, 0))
+            layer = _tile_row(cell, src_w - wx).crop((-wx, 0, src_w - wx, h))
+            # 缓存中同时保存水印，避免id被复用
+            fill_cache.set(key, (mark, layer))
+
+        # 往下方逐行平铺
+        for uy in range(wy, src_h + 1, ch):
+            im.paste(layer, (0, uy), layer)
@@ -1,94 +1,546 @@
 #!/usr/bin/env python
 # coding=utf-8
 import typing
-import tempfile
-import colorsys
+import os
+import io
+import math
+import shutil
+import hashlib
+import functools
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
-from PIL import Image, ImageOps, ImageFile
+import PIL
+from PIL import Image, ImageFile, ImageStat
 
-from imgprocessor import enums, settings
-from imgprocessor.parsers import BaseParser, ProcessParams
-from imgprocessor.parsers.base import trans_uri_to_im
+from imgprocessor import enums, settings, hooks, VERSION
+from imgprocessor.cache import get_result_cache
+from imgprocessor.parsers import (
+    BaseParser,
+    ProcessParams,
+    CompiledParams,
+    ResizeParser,
+    CropParser,
+    RotateParser,
+    compile_params,
+    action_key,
+)
+from imgprocessor.parsers.base import (
+    trans_uri_to_im,
+    digest_input,
+    read_input,
+    load_overlay,
+    overlay_scope,
+    get_orientation,
+    is_transposed,
+    orientation_transpose,
+    apply_orientation,
+)
+from imgprocessor.optimizer import optimize_actions, plan_mode
+from imgprocessor.memory import estimate_memory, get_memory_budget, reserve_memory
+
+
+# 同 Image.thumbnail 中 reducing_gap 的默认值，draft之后的图像至少是目标大小的2倍
+_DRAFT_REDUCING_GAP = 2
+
+F = typing.TypeVar("F", bound=typing.Callable[..., typing.Any])
+
+
+def _overlay_scoped(func: F) -> F:
+    """一次处理中每个叠加图像只读取一次，计算缓存key和执行操作时共用，see `overlay_scope`"""
+
+    @functools.wraps(func)
+    def wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+        with overlay_scope():
+            return func(*args, **kwargs)
+
+    return typing.cast(F, wrapper)
 
 
 class ProcessorCtr(object):
 
     @classmethod
-    def handle_img_actions(cls, ori_im: ImageFile.ImageFile, actions: list[BaseParser]) -> ImageFile.ImageFile:
-        im = ori_im
-        # 解决旋转问题
-        im = ImageOps.exif_transpose(im)
+    def draft_img(
+        cls,
+        ori_im: ImageFile.ImageFile,
+        actions: typing.Sequence[BaseParser],
+        orientation: typing.Optional[int] = None,
+    ) -> typing.Sequence[BaseParser]:
+        """JPEG图像根据后续操作的缩放目标大小，使用draft模式(DCT缩放)解码，减少解码耗时和内存占用
+
+        仅处理操作开头的 `crop`(可以是多个) + `resize` 组合；
+        draft会选择仍不小于目标大小(2倍)的最小DCT缩放比例，生效后将这些操作替换成对缩小后图像等效的操作；
+        输出图像的宽高与不使用draft时一致，像素差异在SSIM>=0.96范围内。
+
+        Args:
+            ori_im: 输入图像，必须是尚未加载(load)的图像
+            actions: 图像处理操作
+            orientation: 输入图像EXIF中的方向信息，默认从输入图像中读取，see `get_orientation`
+
+        Returns:
+            draft之后需要执行的操作列表；未使用draft时原样返回
+        """
+        if ori_im.format != enums.ImageFormat.JPEG.value:
+            return actions
+
+        src_w, src_h = ori_im.size
+        # 方向信息会交换宽高，计算都基于旋转后的宽高
+        swap = is_transposed(orientation if orientation is not None else get_orientation(ori_im))
+        if swap:
+            src_w, src_h = src_h, src_w
+
+        # 开头的crop操作合并成一个区域
+        x0, y0, x1, y1 = 0, 0, src_w, src_h
+        resize_parser = None
+        for idx, parser in enumerate(actions):
+            if isinstance(parser, CropParser):
+                x, y, w, h = parser.compute(x1 - x0, y1 - y0)
+                x0, y0, x1, y1 = x0 + x, y0 + y, x0 + x + w, y0 + y + h
+            elif isinstance(parser, ResizeParser):
+                resize_parser = parser
+                break
+            else:
+                break
+        if not resize_parser:
+            return actions
+
+        crop_w, crop_h = x1 - x0, y1 - y0
+        w, h = resize_parser.compute(crop_w, crop_h)
+        # 保证裁剪区域在缩小后的图像中仍不小于目标大小的 _DRAFT_REDUCING_GAP 倍，保证缩放质量
+        need_w = math.ceil(_DRAFT_REDUCING_GAP * src_w * w / crop_w)
+        need_h = math.ceil(_DRAFT_REDUCING_GAP * src_h * h / crop_h)
+        if src_w // need_w < 2 or src_h // need_h < 2:
+            # 达不到最小的缩放比例1/2
+            return actions
+
+        draft_size = (need_h, need_w) if swap else (need_w, need_h)
+        if not ori_im.draft(ori_im.mode, draft_size):
+            return actions
+
+        new_w, new_h = ori_im.size
+        if swap:
+            new_w, new_h = new_h, new_w
+        if (new_w, new_h) == (src_w, src_h):
+            return actions
+
+        _actions: list[BaseParser] = []
+        if (x0, y0, x1, y1) != (0, 0, src_w, src_h):
+            # 裁剪区域按照缩小比例换算
+            fx, fy = new_w / src_w, new_h / src_h
+            nx0, ny0 = min(round(x0 * fx), new_w - 1), min(round(y0 * fy), new_h - 1)
+            nx1, ny1 = min(max(round(x1 * fx), nx0 + 1), new_w), min(max(round(y1 * fy), ny0 + 1), new_h)
+            _actions.append(CropParser(x=nx0, y=ny0, w=nx1 - nx0, h=ny1 - ny0))
+        # 缩放的目标大小已经确定，直接指定宽高
+        m = resize_parser.m
+        if m not in [enums.ResizeMode.PAD.value, enums.ResizeMode.FIT.value]:
+            m = enums.ResizeMode.FIXED.value
+        _actions.append(
+            ResizeParser(m=m, w=w, h=h, limit=0, color=resize_parser.color, f=resize_parser.f, fast=resize_parser.fast)
+        )
+        start = idx + 1
+        _actions.extend(actions[start:])
+        return _actions
+
+    @classmethod
+    def can_passthrough(
+        cls, ori_im: ImageFile.ImageFile, params_obj: CompiledParams, kwargs: typing.Optional[dict] = None
+    ) -> bool:
+        """只根据图像头信息判断处理结果是否与输入图像一致，可以直接输出输入图像的原始内容
+
+        需要同时满足：
+        - 没有方向信息(或方向正常)，只有一帧；
+        - 处理操作经过 `optimizer.optimize_actions` 之后为空，即只有不改变像素的操作，例如不放大的 `resize`、裁剪整个图像；
+        - 输出格式与输入一致，且无需重新编码：JPEG未指定质量(即保持原图质量)且不需要转换模式，PNG是无损的；
+        - 渐进显示与输入一致，没有传递其他的编码参数。
+
+        与重新编码相比，输出会保留输入图像中的EXIF等元数据。
+
+        Args:
+            ori_im: 输入图像，必须是尚未加载(load)、也未使用draft的图像
+            params_obj: 图像处理参数
+            kwargs: 透传给 `save_img_to_file` 的参数
+
+        Returns:
+            是否可以直接输出输入图像的原始内容
+        """
+        if kwargs and set(kwargs) - {"use_memoryview"}:
+            return False
+        if get_orientation(ori_im) != 1 or getattr(ori_im, "n_frames", 1) != 1:
+            return False
+
+        save_parser = params_obj.save_parser
+        fmt = ori_im.format
+        if save_parser.format and save_parser.format.upper() != fmt:
+            return False
+        if fmt == enums.ImageFormat.JPEG.value:
+            if save_parser.quality or ori_im.mode not in ["RGB", "L"]:
+                return False
+        elif fmt != enums.ImageFormat.PNG.value:
+            return False
+        interlaced = bool(ori_im.info.get("progressive") or ori_im.info.get("interlace"))
+        if interlaced != bool(save_parser.interlace):
+            return False
+
+        return not optimize_actions(params_obj.actions, *ori_im.size)
+
+    @classmethod
+    def handle_img_actions(
+        cls,
+        ori_im: ImageFile.ImageFile,
+        actions: typing.Sequence[BaseParser],
+        optimize: typing.Optional[bool] = None,
+        check: typing.Optional[typing.Callable[[], None]] = None,
+        orientation: typing.Optional[int] = None,
+    ) -> ImageFile.ImageFile:
+        """按顺序执行图像处理操作
+
+        先按EXIF中的方向信息摆正图像，开头90度倍数的 `rotate` 合并到同一次transpose中；
+        不会修改输入图像，直接修改图像的操作(`IN_PLACE`)作用在输入图像上时先复制。
+
+        Args:
+            ori_im: 输入图像
+            actions: 图像处理操作
+            optimize: 执行前是否优化操作，see `optimizer.optimize_actions`；默认为 `settings.PROCESSOR_OPTIMIZE_ACTIONS`
+            check: 每个操作执行前调用，可以抛出异常中断处理，例如处理被取消
+            orientation: 输入图像EXIF中的方向信息，默认从输入图像中读取，see `get_orientation`；已摆正的图像传1
+
+        Returns:
+            处理后的图像
+        """
+        if orientation is None:
+            orientation = get_orientation(ori_im)
+        if optimize is None:
+            optimize = settings.PROCESSOR_OPTIMIZE_ACTIONS
+        if optimize:
+            w, h = ori_im.size
+            actions = optimize_actions(actions, *((h, w) if is_transposed(orientation) else (w, h)))
+        # 按合并rotate之前的操作选择模式，结果与逐个执行一致
+        mode = plan_mode(ori_im.mode, actions, transparency=_has_transparency(ori_im))
+        im, actions = _transpose(ori_im, orientation, actions)
+        im = _convert_mode(im, mode)
+        owned = im is not ori_im
         for parser in actions:
-            im = parser.do_action(im)
+            if check:
+                check()
+            if parser.IN_PLACE and not owned and parser.working_mode(im.mode) == im.mode:
+                im = im.copy()
+            out = _do_action(parser, im)
+            owned = owned or out is not im
+            im = out
         return im
 
     @classmethod
     def save_img_to_file(
         cls,
         im: ImageFile.ImageFile,
-        out_path: typing.Optional[str] = None,
+        out_path: typing.Optional[typing.Union[str, os.PathLike, typing.BinaryIO]] = None,
+        use_memoryview: bool = False,
         **kwargs: typing.Any,
     ) -> typing.Optional[typing.ByteString]:
+        """编码并保存图像
+
+        Args:
+            im: 要保存的图像
+            out_path: 输出图像保存路径；也可以是可写入的文件对象(例如HTTP响应、socket.makefile)，直接编码写入
+            use_memoryview: 仅当out_path为空时有效，返回 `memoryview` 而非 `bytes`，避免复制编码后的内容
+            kwargs: 透传给 `Image.save` 的参数
+
+        Returns:
+            仅当out_path为空时返回编码后图像的二进制内容，直接在内存中编码，不经过临时文件
+        """
         fmt = kwargs.get("format") or im.format
 
-        if fmt and fmt.upper() == enums.ImageFormat.JPEG.value and im.mode not in ["GBA", "L"]:
-            im = im.convert("RGB")
+        with hooks.stage("save", fmt, im) as event:
+            if fmt and fmt.upper() == enums.ImageFormat.JPEG.value and im.mode not in ["RGB", "L"]:
+                # JPEG 仅支持真彩色（RGB）或灰度图（L），灰度图保持灰度
+                im = im.convert("L" if im.mode in ["1", "LA"] else "RGB")
 
-        if not kwargs.get("quality"):
-            if fmt and fmt.upper() == enums.ImageFormat.JPEG.value and im.format == enums.ImageFormat.JPEG.value:
-                kwargs["quality"] = "keep"
-            else:
-                kwargs["quality"] = settings.PROCESSOR_DEFAULT_QUALITY
+            if not kwargs.get("quality"):
+                if fmt and fmt.upper() == enums.ImageFormat.JPEG.value and im.format == enums.ImageFormat.JPEG.value:
+                    kwargs["quality"] = "keep"
+                else:
+                    kwargs["quality"] = settings.PROCESSOR_DEFAULT_QUALITY
 
-        if out_path:
-            # icc_profile 是为解决色域的问题
-            im.save(out_path, **kwargs)
-            return None
+            if isinstance(out_path, (str, os.PathLike)) and out_path:
+                # icc_profile 是为解决色域的问题
+                im.save(out_path, **kwargs)
+                if event:
+                    ext = os.path.splitext(os.fspath(out_path))[-1].lower()
+                    name = fmt or Image.registered_extensions().get(ext)
+                    event.done(im, nbytes=os.path.getsize(out_path), name=name.upper() if name else None)
+                return None
+
+            # 写入文件对象时无法通过后缀推断格式，默认png
+            kwargs["format"] = fmt or enums.ImageFormat.PNG.value
+            if out_path:
+                start = _tell(out_path) if event else None
+                im.save(out_path, **kwargs)
+                nbytes = None
+                if event and start is not None:
+                    end = _tell(out_path)
+                    nbytes = end - start if end is not None else None
+                event.done(im, nbytes=nbytes, name=kwargs["format"].upper())
+                return None
+
+            # 没有传递保存的路径，直接在内存中编码并返回文件内容
+            buf = io.BytesIO()
+            im.save(buf, **kwargs)
+            event.done(im, nbytes=buf.getbuffer().nbytes, name=kwargs["format"].upper())
+            if use_memoryview:
+                return buf.getbuffer()
+            return buf.getvalue()
+
+
+def _tell(fp: typing.Any) -> typing.Optional[int]:
+    """文件对象的当前位置，不支持时返回None"""
+    try:
+        return fp.tell()
+    except Exception:
+        return None
+
+
+def _transpose(
+    im: ImageFile.ImageFile, orientation: int, actions: typing.Sequence[BaseParser] = ()
+) -> tuple[ImageFile.ImageFile, typing.Sequence[BaseParser]]:
+    """按EXIF中的方向信息摆正图像，开头90度倍数的 `rotate` 合并到同一次transpose中
+
+    Returns:
+        (摆正后的图像，不需要变换时是输入图像, 剩余的操作)
+    """
+    rotate = 0
+    if actions and isinstance(actions[0], RotateParser) and actions[0].value % 90 == 0:
+        rotate, actions = actions[0].value, actions[1:]
+    if orientation_transpose(orientation, rotate) is None:
+        return im, actions
+    with hooks.stage("transpose", None, im) as event:
+        im = apply_orientation(im, orientation, rotate=rotate)
+        event.done(im)
+    return im, actions
+
+
+def _has_transparency(im: Image.Image) -> bool:
+    return im.info.get("transparency") is not None
+
+
+def _convert_mode(im: ImageFile.ImageFile, mode: typing.Optional[str]) -> ImageFile.ImageFile:
+    """执行操作前将图像转换成 `optimizer.plan_mode` 选择的模式，为空时不转换"""
+    if not mode or mode == im.mode:
+        return im
+    with hooks.stage("convert", mode, im) as event:
+        im = im.convert(mode)
+        event.done(im)
+    return im
+
+
+def _do_action(parser: BaseParser, im: ImageFile.ImageFile) -> ImageFile.ImageFile:
+    """执行一个图像处理操作"""
+    with hooks.stage("action", parser.KEY, im) as event:
+        im = parser.do_action(im)
+        event.done(im)
+    return im
+
+
+def iter_overlay_uris(actions: typing.Sequence[BaseParser]) -> typing.Generator[str, None, None]:
+    """遍历水印、合并等操作(包括合并操作中的操作)中叠加图像的路径或链接地址"""
+    for parser in actions:
+        image = getattr(parser, "image", None)
+        if image:
+            yield image
+        yield from iter_overlay_uris(getattr(parser, "actions", None) or [])
+
+
+def _overlay_versions(actions: typing.Sequence[BaseParser]) -> list:
+    """水印、合并等操作中叠加图像的版本，叠加图像变化后缓存的处理结果失效
+
+    在 `overlay_scope` 中读取，之后执行操作时直接使用读取到的图像，不会再次下载或重新验证。
+    """
+    return [load_overlay(uri)[0] for uri in iter_overlay_uris(actions)]
+
+
+def _result_cache_key(
+    input_digest: str,
+    params_obj: CompiledParams,
+    out_path: typing.Optional[typing.Union[str, os.PathLike, typing.BinaryIO]],
+    kwargs: dict,
+    use_draft: typing.Optional[bool] = None,
+) -> typing.Optional[str]:
+    """计算处理结果的缓存key；无法判断叠加图像是否变化时返回None，不缓存"""
+    versions = _overlay_versions(params_obj.actions)
+    if None in versions:
+        return None
+    ext = ""
+    if isinstance(out_path, (str, os.PathLike)) and out_path:
+        # 保存到文件时可能按后缀推断格式
+        ext = os.path.splitext(os.fspath(out_path))[1].lower()
+    key = (
+        VERSION,
+        PIL.__version__,
+        input_digest,
+        params_obj.key,
+        versions,
+        use_draft,
+        settings.PROCESSOR_OPTIMIZE_ACTIONS,
+        settings.PROCESSOR_DEFAULT_QUALITY,
+        ext,
+        sorted((k, v) for k, v in kwargs.items() if k != "use_memoryview"),
+    )
+    return hashlib.sha256(repr(key).encode()).hexdigest()
+
+
+def _digest_im(im: Image.Image) -> str:
+    """计算Image对象的摘要，包含影响输出结果的像素和图像信息"""
+    h = hashlib.sha256(im.tobytes())
+    h.update(repr((im.mode, im.size, im.format, im.getpalette(), im.info.get("icc_profile"))).encode())
+    h.update(repr(im.getexif().get(0x0112)).encode())
+    return f"image:{h.hexdigest()}"
 
-        # 没有传递保存的路径，返回文件内容
-        suffix = fmt or "png"
-        with tempfile.NamedTemporaryFile(suffix=f".{suffix}", dir=settings.PROCESSOR_TEMP_DIR) as fp:
-            im.save(fp.name, **kwargs)
-            fp.seek(0)
-            content = fp.read()
-        return content
 
+def _encode_result(
+    im: ImageFile.ImageFile,
+    out_path: typing.Optional[typing.Union[str, os.PathLike, typing.BinaryIO]],
+    kwargs: dict,
+) -> bytes:
+    """将处理结果编码成bytes用于缓存，编码参数与直接保存到out_path时一致"""
+    kwargs = dict(kwargs, use_memoryview=False)
+    if not kwargs.get("format") and isinstance(out_path, (str, os.PathLike)) and out_path:
+        # 直接保存到文件时按后缀推断格式
+        ext = os.path.splitext(os.fspath(out_path))[1].lower()
+        kwargs["format"] = Image.registered_extensions().get(ext)
+    return typing.cast(bytes, ProcessorCtr.save_img_to_file(im, **kwargs))
 
+
+def _write_result(
+    data: typing.Union[bytes, bytearray, memoryview],
+    out_path: typing.Optional[typing.Union[str, os.PathLike, typing.BinaryIO]],
+    use_memoryview: bool = False,
+) -> typing.Optional[typing.ByteString]:
+    """输出编码后的处理结果，同 `ProcessorCtr.save_img_to_file`"""
+    if isinstance(out_path, (str, os.PathLike)) and out_path:
+        with open(out_path, "wb") as f:
+            f.write(data)
+        return None
+    if out_path:
+        typing.cast(typing.BinaryIO, out_path).write(data)
+        return None
+    return memoryview(data) if use_memoryview else data
+
+
+def _passthrough(
+    input_uri: typing.Union[str, bytes, bytearray, memoryview],
+    ori_im: ImageFile.ImageFile,
+    out_path: typing.Optional[typing.Union[str, os.PathLike, typing.BinaryIO]],
+    use_memoryview: bool = False,
+) -> typing.Optional[typing.ByteString]:
+    """直接输出输入图像的原始内容，同 `ProcessorCtr.save_img_to_file`"""
+    with hooks.stage("save", ori_im.format, ori_im) as event:
+        if not isinstance(input_uri, str):
+            event.done(ori_im, nbytes=memoryview(input_uri).nbytes)
+            if isinstance(input_uri, memoryview) and not use_memoryview and not out_path:
+                input_uri = input_uri.tobytes()
+            return _write_result(input_uri, out_path, use_memoryview)
+
+        event.done(ori_im, nbytes=os.path.getsize(input_uri))
+        if isinstance(out_path, (str, os.PathLike)) and out_path:
+            if os.path.exists(out_path) and os.path.samefile(input_uri, out_path):
+                return None
+            # 不使用硬链接：之后覆盖写入输出文件时会同时修改输入文件
+            shutil.copyfile(input_uri, out_path)
+            return None
+        with open(input_uri, "rb") as f:
+            if out_path:
+                shutil.copyfileobj(f, typing.cast(typing.BinaryIO, out_path))
+                return None
+            data = f.read()
+        return memoryview(data) if use_memoryview else data
+
+
+@_overlay_scoped
 def process_image(
-    input_uri: str,
-    params: typing.Union[ProcessParams, dict, str],
-    out_path: typing.Optional[str] = None,
+    input_uri: typing.Union[str, bytes, bytearray, memoryview, typing.BinaryIO],
+    params: typing.Union[CompiledParams, ProcessParams, dict, str],
+    out_path: typing.Optional[typing.Union[str, os.PathLike, typing.BinaryIO]] = None,
+    use_draft: typing.Optional[bool] = None,
+    use_cache: bool = True,
+    check: typing.Optional[typing.Callable[[], None]] = None,
+    passthrough: typing.Optional[bool] = None,
     **kwargs: typing.Any,
 ) -> typing.Optional[typing.ByteString]:
     """处理图像
 
     Args:
-        input_uri: 输入图像路径
+        input_uri: 输入图像路径或链接地址；也可以是图像的二进制内容(bytes/memoryview)或可读的文件对象
         params: 图像处理参数
-        out_path: 输出图像保存路径
+        out_path: 输出图像保存路径，或者可写入的文件对象
+        use_draft: JPEG图像缩小时是否使用draft模式解码，默认为 `settings.PROCESSOR_USE_DRAFT`
+        use_cache: 是否使用处理结果的缓存，仅在配置了 `PROCESSOR_RESULT_CACHE_*` 时有效
+        passthrough: 处理结果与输入图像一致时是否直接输出原始内容，默认为 `settings.PROCESSOR_PASSTHROUGH`，
+            see `ProcessorCtr.can_passthrough`
+        check: 每个操作执行前和编码前调用，可以抛出异常中断处理，例如处理被取消
+        kwargs: 透传给 `ProcessorCtr.save_img_to_file` 的参数，例如 `use_memoryview=True`
 
     Raises:
         ProcessLimitException: 超过处理限制会抛出异常
 
     Returns:
-        默认输出直接存储无返回，仅当out_path为空时会返回处理后图像的二进制内容
+        默认输出直接存储无返回，仅当out_path为空时会返回处理后图像的二进制内容(bytes或memoryview)
     """
     # 初始化输入
-    params_obj: ProcessParams = ProcessParams.init(params)
+    params_obj = compile_params(params)
+    if use_draft is None:
+        use_draft = settings.PROCESSOR_USE_DRAFT
+    if passthrough is None:
+        passthrough = settings.PROCESSOR_PASSTHROUGH
+    if passthrough:
+        # 链接地址和文件对象读取到内存，直接输出时不需要重新读取
+        input_uri = read_input(input_uri)
+    cache = get_result_cache() if use_cache else None
+    key = None
+    if cache is not None:
+        # 链接地址和文件对象读取到内存后计算摘要
+        input_uri, digest = digest_input(input_uri)
+        key = _result_cache_key(digest, params_obj, out_path, kwargs, use_draft=use_draft)
+        data = cache.get(key) if key else None
+        if data is not None:
+            return _write_result(data, out_path, kwargs.get("use_memoryview", False))
+
     with trans_uri_to_im(input_uri) as ori_im:
-        # 处理图像
-        im = ProcessorCtr.handle_img_actions(ori_im, params_obj.actions)
-        # 输出、保存
-        _kwargs = params_obj.save_parser.compute(ori_im, im)
-        _kwargs.update(kwargs)
-        ret = ProcessorCtr.save_img_to_file(im, out_path=out_path, **_kwargs)
-    return ret
+        if passthrough and ProcessorCtr.can_passthrough(ori_im, params_obj, kwargs):
+            if check:
+                check()
+            # 原始内容不写入处理结果的缓存
+            return _passthrough(
+                typing.cast(typing.Union[str, bytes, bytearray, memoryview], input_uri),
+                ori_im,
+                out_path,
+                kwargs.get("use_memoryview", False),
+            )
+        actions: typing.Sequence[BaseParser] = params_obj.actions
+        # 方向信息只读取一次
+        orientation = get_orientation(ori_im)
+        if use_draft:
+            actions = ProcessorCtr.draft_img(ori_im, actions, orientation=orientation)
+        # 解码前按预计占用的内存申请预算
+        with reserve_memory(ori_im, actions, check=check):
+            # 处理图像
+            im = ProcessorCtr.handle_img_actions(ori_im, actions, check=check, orientation=orientation)
+            if check:
+                check()
+            # 输出、保存
+            _kwargs = params_obj.save_parser.compute(ori_im, im)
+            _kwargs.update(kwargs)
+            if cache is None or key is None:
+                return ProcessorCtr.save_img_to_file(im, out_path=out_path, **_kwargs)
+            data = _encode_result(im, out_path, _kwargs)
+    cache.set(key, data)
+    return _write_result(data, out_path, kwargs.get("use_memoryview", False))
 
 
+@_overlay_scoped
 def process_image_obj(
     ori_im: ImageFile.ImageFile,
-    params: typing.Union[ProcessParams, dict, str],
-    out_path: typing.Optional[str] = None,
+    params: typing.Union[CompiledParams, ProcessParams, dict, str],
+    out_path: typing.Optional[typing.Union[str, os.PathLike, typing.BinaryIO]] = None,
+    use_cache: bool = True,
     **kwargs: typing.Any,
 ) -> typing.Optional[typing.ByteString]:
     """处理图像
@@ -96,48 +548,239 @@ def process_image_obj(
     Args:
         ori_im: 输入图像为Image对象
         params: 图像处理参数
-        out_path: 输出图像保存路径
+        out_path: 输出图像保存路径，或者可写入的文件对象
+        use_cache: 是否使用处理结果的缓存，仅在配置了 `PROCESSOR_RESULT_CACHE_*` 时有效；需要计算全部像素的摘要
+        kwargs: 透传给 `ProcessorCtr.save_img_to_file` 的参数，例如 `use_memoryview=True`
+
+    Returns:
+        默认输出直接存储无返回，仅当out_path为空时会返回处理后图像的二进制内容(bytes或memoryview)
+    """
+    params_obj = compile_params(params)
+    cache = get_result_cache() if use_cache else None
+    key = None
+    if cache is not None:
+        key = _result_cache_key(_digest_im(ori_im), params_obj, out_path, kwargs)
+        data = cache.get(key) if key else None
+        if data is not None:
+            return _write_result(data, out_path, kwargs.get("use_memoryview", False))
+
+    with reserve_memory(ori_im, params_obj.actions):
+        im = ProcessorCtr.handle_img_actions(ori_im, params_obj.actions)
+        _kwargs = params_obj.save_parser.compute(ori_im, im)
+        _kwargs.update(kwargs)
+        if cache is None or key is None:
+            return ProcessorCtr.save_img_to_file(im, out_path=out_path, **_kwargs)
+        data = _encode_result(im, out_path, _kwargs)
+    cache.set(key, data)
+    return _write_result(data, out_path, kwargs.get("use_memoryview", False))
+
+
+@contextmanager
+def _reserve_memory_multi(
+    ori_im: ImageFile.ImageFile, plans: list[CompiledParams], check: typing.Optional[typing.Callable[[], None]] = None
+) -> typing.Generator[None, None, None]:
+    """按多组参数中占用内存最多的一组申请内存预算；共用的中间结果在分支处理完之前一直保留"""
+    budget = get_memory_budget()
+    if budget is None:
+        yield
+        return
+    nbytes = max((estimate_memory(ori_im, plan.actions, keep_intermediate=True) for plan in plans), default=0)
+    with budget.reserve(nbytes, check=check):
+        yield
+
+
+class _PlanNode(object):
+    """多组处理参数的操作前缀树节点，相同前缀的操作只执行一次"""
+
+    __slots__ = ("parser", "children", "outputs")
+
+    def __init__(self, parser: typing.Optional[BaseParser] = None) -> None:
+        self.parser = parser
+        self.children: dict[typing.Hashable, _PlanNode] = {}
+        # 操作在该节点结束的参数下标
+        self.outputs: list[int] = []
+
+
+@_overlay_scoped
+def process_image_multi(
+    input_uri: typing.Union[str, bytes, bytearray, memoryview, typing.BinaryIO],
+    params_list: typing.Sequence[typing.Union[CompiledParams, ProcessParams, dict, str]],
+    out_paths: typing.Optional[
+        typing.Sequence[typing.Optional[typing.Union[str, os.PathLike, typing.BinaryIO]]]
+    ] = None,
+    check: typing.Optional[typing.Callable[[], None]] = None,
+    passthrough: typing.Optional[bool] = None,
+    **kwargs: typing.Any,
+) -> list[typing.Optional[typing.ByteString]]:
+    """同一个输入图像按多组参数处理，输出多个图像
+
+    输入图像只读取和解码一次；多组参数的操作按前缀合并，相同的前缀操作只执行一次，结果由后续操作共用。
+    不使用draft模式解码(不同参数需要的缩小比例不同)，也不使用处理结果的缓存。
+
+    Args:
+        input_uri: 同 `process_image`
+        params_list: 多组图像处理参数
+        out_paths: 与 `params_list` 一一对应的输出路径或可写入的文件对象；为空或其中的元素为空时返回二进制内容
+        check: 同 `process_image`
+        passthrough: 同 `process_image`，处理结果与输入图像一致的参数直接输出原始内容
+        kwargs: 透传给 `ProcessorCtr.save_img_to_file` 的参数，例如 `use_memoryview=True`
+
+    Raises:
+        ProcessLimitException: 超过处理限制会抛出异常
 
     Returns:
-        默认输出直接存储无返回，仅当out_path为空时会返回处理后图像的二进制内容
+        与 `params_list` 顺序一致的结果列表，同 `process_image` 的返回值
     """
-    params_obj: ProcessParams = ProcessParams.init(params)
-    im = ProcessorCtr.handle_img_actions(ori_im, params_obj.actions)
-    _kwargs = params_obj.save_parser.compute(ori_im, im)
-    _kwargs.update(kwargs)
-    ret = ProcessorCtr.save_img_to_file(im, out_path=out_path, **_kwargs)
-    return ret
+    plans = [compile_params(params) for params in params_list]
+    _out_paths: list[typing.Optional[typing.Union[str, os.PathLike, typing.BinaryIO]]] = (
+        list(out_paths) if out_paths is not None else [None] * len(plans)
+    )
+    if len(_out_paths) != len(plans):
+        raise ValueError("out_paths 和 params_list 的数量不一致")
+    results: list[typing.Optional[typing.ByteString]] = [None] * len(plans)
+    if passthrough is None:
+        passthrough = settings.PROCESSOR_PASSTHROUGH
+    if passthrough:
+        input_uri = read_input(input_uri)
+
+    with trans_uri_to_im(input_uri) as ori_im:
+        indexes = list(range(len(plans)))
+        if passthrough:
+            # 处理结果与输入图像一致的参数直接输出原始内容，全部一致时不需要解码
+            indexes = []
+            for idx, plan in enumerate(plans):
+                if not ProcessorCtr.can_passthrough(ori_im, plan, kwargs):
+                    indexes.append(idx)
+                    continue
+                if check:
+                    check()
+                results[idx] = _passthrough(
+                    typing.cast(typing.Union[str, bytes, bytearray, memoryview], input_uri),
+                    ori_im,
+                    _out_paths[idx],
+                    kwargs.get("use_memoryview", False),
+                )
+        if indexes:
+            _process_plans(ori_im, plans, indexes, _out_paths, results, check, kwargs)
+    return results
+
+
+def _process_plans(
+    ori_im: ImageFile.ImageFile,
+    plans: list[CompiledParams],
+    indexes: list[int],
+    out_paths: list[typing.Optional[typing.Union[str, os.PathLike, typing.BinaryIO]]],
+    results: list[typing.Optional[typing.ByteString]],
+    check: typing.Optional[typing.Callable[[], None]],
+    kwargs: dict,
+) -> None:
+    """解码输入图像，按 `indexes` 中的参数处理，处理结果写入 `results`，see `process_image_multi`"""
+    with _reserve_memory_multi(ori_im, [plans[idx] for idx in indexes], check=check):
+        # 解决旋转问题，所有参数共用
+        im, _ = _transpose(ori_im, get_orientation(ori_im))
+
+        root = _PlanNode()
+        modes = set()
+        for idx in indexes:
+            plan = plans[idx]
+            actions: typing.Sequence[BaseParser] = plan.actions
+            if settings.PROCESSOR_OPTIMIZE_ACTIONS:
+                actions = optimize_actions(actions, *im.size)
+            modes.add(plan_mode(im.mode, actions, transparency=_has_transparency(im)))
+            node = root
+            for parser in actions:
+                key = action_key(parser)
+                child = node.children.get(key)
+                if child is None:
+                    child = node.children[key] = _PlanNode(parser)
+                node = child
+            node.outputs.append(idx)
+        if len(modes) == 1:
+            # 所有参数需要的模式一致时，共用的图像只转换一次
+            im = _convert_mode(im, modes.pop())
+
+        def run(node: _PlanNode, im: ImageFile.ImageFile, shared: bool) -> None:
+            # 先输出，后续操作可能会直接修改图像
+            for idx in node.outputs:
+                if check:
+                    check()
+                _kwargs = plans[idx].save_parser.compute(ori_im, im)
+                _kwargs.update(kwargs)
+                results[idx] = ProcessorCtr.save_img_to_file(im, out_path=out_paths[idx], **_kwargs)
+            # 有多个分支时，图像(也可能是未变化的上层图像)会被多个分支使用，直接修改图像的操作需要先复制
+            shared = shared or len(node.children) > 1
+            for child in node.children.values():
+                if check:
+                    check()
+                parser = typing.cast(BaseParser, child.parser)
+                run(child, _do_action(parser, im.copy() if shared and parser.IN_PLACE else im), shared)
+
+        run(root, im, False)
+
+
+def _compute_main_color(im: Image.Image, delta_h: float, sample_size: int) -> str:
+    if im.mode != "RGB":
+        im = im.convert("RGB")
+    if sample_size and max(im.size) > sample_size:
+        # 缩小后计算，BOX缩放是区域平均，不影响整体的颜色分布
+        rate = sample_size / max(im.size)
+        size = (max(1, round(im.size[0] * rate)), max(1, round(im.size[1] * rate)))
+        im = im.resize(size, resample=Image.BOX)
 
+    # 转换成HSV即 色相(Hue)、饱和度(Saturation)、明度(Value)，色相取值范围[0,255]
+    # 通过色相的直方图计算平均色相
+    hue = im.convert("HSV").getchannel("H")
+    hist = hue.histogram()
+    avg_h = sum(i * n for i, n in enumerate(hist)) / (im.size[0] * im.size[1]) / 255
+    # 取与平均色相相近的像素作为蒙版，计算像素色值rgb的平均值
+    mask = hue.point([255 if abs(i / 255 - avg_h) < delta_h else 0 for i in range(256)])
+    stat = ImageStat.Stat(im, mask)
+    # 没有匹配的像素时直接取黑色，低版本Pillow访问mean会除零
+    r, g, b = (int(v) for v in stat.mean) if stat.count[0] else (0, 0, 0)
 
-def extract_main_color(img_path: str, delta_h: float = 0.3) -> str:
+    color = "{}{}{}".format(hex(r)[2:].zfill(2), hex(g)[2:].zfill(2), hex(b)[2:].zfill(2))
+    return color.upper()
+
+
+def extract_main_color(
+    img_path: typing.Union[str, bytes, typing.BinaryIO, Image.Image], delta_h: float = 0.3, sample_size: int = 512
+) -> str:
     """获取图像主色调
 
     Args:
-        img_path: 输入图像的路径
+        img_path: 输入图像的路径、链接地址、二进制内容、可读的文件对象，或者Image对象
         delta_h: 像素色相和平均色相做减法的绝对值小于该值，才用于计算主色调，取值范围[0,1]
+        sample_size: 图像宽或高超过该值时，缩小到该大小后计算(JPEG图像使用draft模式解码)；0表示使用原图计算
 
     Returns:
         颜色值，eg: FFFFFF
     """
-    r, g, b = 0, 0, 0
-    with Image.open(img_path) as im:
-        if im.mode != "RGB":
-            im = im.convert("RGB")
-        # 转换成HSV即 色相(Hue)、饱和度(Saturation)、明度(alue)，取值范围[0,1]
-        # 取H计算平均色相
-        all_h = [colorsys.rgb_to_hsv(*im.getpixel((x, y)))[0] for x in range(im.size[0]) for y in range(im.size[1])]
-        avg_h = sum(all_h) / (im.size[0] * im.size[1])
-        # 取与平均色相相近的像素色值rgb用于计算，像素值取值范围[0,255]
-        beyond = list(
-            filter(
-                lambda x: abs(colorsys.rgb_to_hsv(*x)[0] - avg_h) < delta_h,
-                [im.getpixel((x, y)) for x in range(im.size[0]) for y in range(im.size[1])],
-            )
-        )
-    if len(beyond):
-        r = int(sum(e[0] for e in beyond) / len(beyond))
-        g = int(sum(e[1] for e in beyond) / len(beyond))
-        b = int(sum(e[2] for e in beyond) / len(beyond))
+    if isinstance(img_path, Image.Image):
+        return _compute_main_color(img_path, delta_h, sample_size)
 
-    color = "{}{}{}".format(hex(r)[2:].zfill(2), hex(g)[2:].zfill(2), hex(b)[2:].zfill(2))
-    return color.upper()
+    with trans_uri_to_im(img_path) as im:
+        if sample_size:
+            # JPEG图像直接解码成较小的图像
+            im.draft("RGB", (sample_size, sample_size))
+        return _compute_main_color(im, delta_h, sample_size)
+
+
+def extract_main_colors(
+    img_paths: typing.Iterable[typing.Union[str, bytes, typing.BinaryIO, Image.Image]],
+    delta_h: float = 0.3,
+    sample_size: int = 512,
+    max_workers: typing.Optional[int] = None,
+) -> list[str]:
+    """批量获取图像主色调，多线程并行计算
+
+    Args:
+        img_paths: 输入图像列表，同 `extract_main_color`
+        delta_h: 同 `extract_main_color`
+        sample_size: 同 `extract_main_color`
+        max_workers: 线程数，默认同 `ThreadPoolExecutor`
+
+    Returns:
+        与输入顺序一致的颜色值列表
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda p: extract_main_color(p, delta_h=delta_h, sample_size=sample_size), img_paths))
@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 # coding=utf-8
+import typing
+import os
 import base64
 import PIL
+from PIL import Image
 
 try:
     # python3.12之后被移除
@@ -14,6 +17,12 @@ def get_pil_version() -> Version:
     return Version(PIL.__version__)
 
 
+def get_im_nbytes(im: Image.Image) -> int:
+    """估算图像像素数据占用的内存字节数"""
+    w, h = im.size
+    return w * h * len(im.getbands())
+
+
 def base64url_encode(value: str) -> str:
     """
     对内容进行URL安全的Base64编码，需要将结果中的部分编码替换：
@@ -52,3 +61,88 @@ def base64url_decode(value: str) -> str:
     s = base64.urlsafe_b64decode(value.encode()).decode()
     s = s.strip("=")
     return s
+
+
+# 常见图像格式的文件头
+_IMAGE_SIGNATURES = (
+    b"\xff\xd8\xff",  # JPEG
+    b"\x89PNG\r\n\x1a\n",  # PNG
+    b"GIF87a",
+    b"GIF89a",
+    b"BM",  # BMP
+    b"II*\x00",  # TIFF
+    b"MM\x00*",
+    b"\x00\x00\x01\x00",  # ICO
+)
+
+
+def is_image_file(path: str) -> bool:
+    """根据文件头判断是否是图像文件；不在常见格式中的，尝试用Pillow解析图像头信息
+
+    Args:
+        path: 文件路径
+
+    Returns:
+        是否是Pillow可以打开的图像文件
+    """
+    try:
+        with open(path, "rb") as f:
+            header = f.read(16)
+    except OSError:
+        return False
+    if header.startswith(_IMAGE_SIGNATURES) or (header[:4] == b"RIFF" and header[8:12] == b"WEBP"):
+        return True
+    try:
+        # 只读取图像头信息，不会解码
+        with Image.open(path):
+            return True
+    except Exception:
+        return False
+
+
+def iter_image_files(
+    path: str,
+    extensions: typing.Optional[typing.Iterable[str]] = None,
+    check_magic: bool = True,
+    on_skip: typing.Optional[typing.Callable[[str], None]] = None,
+) -> typing.Generator[str, None, None]:
+    """惰性遍历目录下的图像文件，边遍历边返回，不会先列出整个目录树
+
+    每个目录内按文件名排序，先返回目录下的文件再进入子目录，每次遍历的顺序一致；不跟随目录的软链接。
+
+    Args:
+        path: 目录
+        extensions: 允许的文件后缀(不区分大小写)，例如 `["jpg", ".png"]`；默认为Pillow支持的所有图像后缀
+        check_magic: 是否根据文件头判断是否是图像文件，见 `is_image_file`
+        on_skip: 跳过的文件(后缀不符合或不是图像)会调用该函数
+
+    Returns:
+        图像文件路径的生成器
+    """
+    if extensions is None:
+        exts = set(Image.registered_extensions())
+    else:
+        exts = {f".{ext.lower().lstrip('.')}" for ext in extensions}
+
+    stack = [path]
+    while stack:
+        cur_dir = stack.pop()
+        try:
+            with os.scandir(cur_dir) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            continue
+        sub_dirs = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                sub_dirs.append(entry.path)
+                continue
+            if not entry.is_file():
+                continue
+            if os.path.splitext(entry.name)[1].lower() not in exts or (check_magic and not is_image_file(entry.path)):
+                if on_skip:
+                    on_skip(entry.path)
+                continue
+            yield entry.path
+        # 栈是后进先出，倒序放入保证按名称顺序遍历子目录
+        stack.extend(reversed(sub_dirs))
@@ -4,12 +4,18 @@ import typing
 
 import os
 import shutil
+import hashlib
 import tempfile
+import threading
+import urllib.parse
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
 import pytest
 from PIL import Image
 
 from imgprocessor import enums, utils, SettingsProxy
+from imgprocessor.fetcher import set_fetcher
 
 
 def pytest_addoption(parser):
@@ -88,3 +94,89 @@ def link_uri() -> str:
 def mock_settings(monkeypatch):
     """mock只读的settings"""
     monkeypatch.setattr(SettingsProxy, "__setattr__", lambda self, name, value: self.__setattr__(name, value))
+
+
+class _ImgHandler(BaseHTTPRequestHandler):
+    """测试用的图像服务，返回 `tests/imgs` 目录下的文件
+
+    - `/<name>?max_age=N`: 返回文件，带ETag和Last-Modified，支持条件请求；`max_age` 设置Cache-Control
+    - `/<name>?validators=0`: 返回文件，不带ETag和Last-Modified
+    - `/redirect/<name>`: 302跳转到 `/<name>`；`?to=<url>` 跳转到指定的链接
+    - `/flaky/<name>`: 每个路径的第一次请求返回503
+    - `/size/<n>`: 返回n个字节的内容
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self) -> None:
+        super().setup()
+        self.server.connections += 1  # type: ignore
+
+    def log_message(self, *args: typing.Any) -> None:
+        pass
+
+    def _send(self, status: int, headers: dict, body: bytes = b"") -> None:
+        self.server.requests.append((self.path, status, dict(self.headers)))  # type: ignore
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        parsed = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(parsed.query))
+        parts = parsed.path.strip("/").split("/", 1)
+        if parts[0] == "redirect":
+            return self._send(302, {"Location": query.get("to") or f"/{parts[1]}"})
+        if parts[0] == "size":
+            return self._send(200, {}, b"b" * int(parts[1]))
+        if parts[0] == "flaky":
+            if self.path not in self.server.flaky:  # type: ignore
+                self.server.flaky.add(self.path)  # type: ignore
+                return self._send(503, {})
+            parts = parts[1:]
+
+        path = os.path.join(self.server.img_dir, parts[0])  # type: ignore
+        if not os.path.isfile(path):
+            return self._send(404, {})
+        with open(path, "rb") as f:
+            body = f.read()
+        headers = {
+            "ETag": '"{}"'.format(hashlib.md5(body).hexdigest()),
+            "Last-Modified": formatdate(os.path.getmtime(path), usegmt=True),
+        }
+        if "max_age" in query:
+            headers["Cache-Control"] = f"max-age={query['max_age']}"
+        if query.get("validators") == "0":
+            return self._send(200, {k: v for k, v in headers.items() if k == "Cache-Control"}, body)
+        if self.headers.get("If-None-Match") == headers["ETag"]:
+            return self._send(304, headers)
+        self._send(200, headers, body)
+
+
+class _ImgServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request: typing.Any, client_address: typing.Any) -> None:
+        # 客户端提前断开连接(例如超出大小限制)属于预期行为
+        pass
+
+
+@pytest.fixture
+def http_server() -> typing.Generator:
+    """本地的图像下载服务，返回服务地址"""
+    server = _ImgServer(("127.0.0.1", 0), _ImgHandler)
+    server.img_dir = os.path.join(os.path.dirname(__file__), "imgs")  # type: ignore
+    server.connections = 0  # type: ignore
+    server.requests = []  # type: ignore
+    server.flaky = set()  # type: ignore
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = "http://127.0.0.1:{}".format(server.server_address[1])  # type: ignore
+    yield server
+    server.shutdown()
+    server.server_close()
+    # 不再复用连接到本测试服务的下载器
+    set_fetcher(None)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# coding=utf-8
+import asyncio
+import threading
+import time
+
+import pytest
+
+from imgprocessor import processor, aio
+from imgprocessor.aio import AsyncProcessor
+from imgprocessor.parsers import BlurParser
+from imgprocessor.parsers.base import overlay_cache
+from imgprocessor.utils import base64url_encode
+
+
+@pytest.fixture
+def async_processor() -> AsyncProcessor:
+    ins = AsyncProcessor(max_workers=2, max_pending=2, io_workers=2)
+    aio.set_async_processor(ins)
+    yield ins
+    aio.set_async_processor(None)
+
+
+@pytest.mark.usefixtures("clean_dir", "async_processor")
+def test_process_image_async() -> None:
+    param_str = "resize,s_100/watermark,image_d29sZi01MC5wbmc/format,png"
+    expected = processor.process_image("lenna-400x225.jpg", param_str)
+
+    async def run() -> list:
+        return await asyncio.gather(
+            aio.process_image_async("lenna-400x225.jpg", param_str),
+            aio.process_image_multi_async("lenna-400x225.jpg", [param_str, "resize,s_50"]),
+            aio.extract_main_color_async("lenna-400x225.jpg"),
+        )
+
+    out, outs, color = asyncio.run(run())
+    assert out == expected
+    assert outs[0] == expected
+    assert color == processor.extract_main_color("lenna-400x225.jpg")
+
+
+@pytest.mark.usefixtures("clean_dir", "async_processor")
+def test_process_image_async_url(http_server) -> None:
+    param_str = f"watermark,image_{base64url_encode(http_server.url + '/wolf-50.png')}/format,png"
+    expected = processor.process_image("lenna-400x225.jpg", param_str)
+
+    async def run() -> bytes:
+        return await aio.process_image_async(f"{http_server.url}/lenna-400x225.jpg", param_str)
+
+    # 第二次执行使用新的事件循环
+    assert asyncio.run(run()) == expected
+    assert asyncio.run(run()) == expected
+
+
+@pytest.mark.usefixtures("clean_dir", "async_processor")
+def test_async_overlay_prefetch(http_server) -> None:
+    """叠加图像只在IO线程中请求一次，处理时不再下载或重新验证"""
+    overlay_cache.clear()
+    path = "/wolf-50.png"
+    param_str = f"watermark,image_{base64url_encode(http_server.url + path)}/format,png"
+    counts = []
+
+    def hits() -> list:
+        return [r[1] for r in http_server.requests if r[0] == path]
+
+    async def run() -> None:
+        await aio.process_image_async("lenna-400x225.jpg", param_str)
+        counts.append(len(hits()))
+        await aio.process_image_multi_async("lenna-400x225.jpg", [param_str, f"resize,s_50/{param_str}"])
+        counts.append(len(hits()))
+
+    asyncio.run(run())
+    assert counts == [1, 2]
+    assert hits() == [200, 304]
+    overlay_cache.clear()
+
+
+def test_async_backpressure() -> None:
+    ins = AsyncProcessor(max_workers=4, max_pending=2)
+    lock = threading.Lock()
+    running, max_running = 0, 0
+
+    def func(check) -> None:
+        nonlocal running, max_running
+        with lock:
+            running += 1
+            max_running = max(max_running, running)
+        time.sleep(0.05)
+        with lock:
+            running -= 1
+
+    async def run() -> None:
+        await asyncio.gather(*(ins.run(func) for _ in range(8)))
+
+    asyncio.run(run())
+    ins.close()
+    # 线程池有4个线程，同时提交的任务不超过2个
+    assert max_running == 2
+
+
+@pytest.mark.usefixtures("clean_dir")
+def test_async_cancel(monkeypatch) -> None:
+    ins = AsyncProcessor(max_workers=1)
+    started = threading.Event()
+    calls = []
+
+    def do_action(self, im):
+        calls.append(self)
+        started.set()
+        time.sleep(0.2)
+        return im
+
+    monkeypatch.setattr(BlurParser, "do_action", do_action)
+
+    param_str = "blur,r_1/rotate,90/blur,r_2/rotate,90/blur,r_3"
+    asyncio.run(ins.process_image("lenna-400x225.jpg", param_str))
+    assert len(calls) == 3
+    calls.clear()
+    started.clear()
+
+    async def run() -> None:
+        task = asyncio.ensure_future(ins.process_image("lenna-400x225.jpg", param_str))
+        while not started.is_set():
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    ins.executor.shutdown(wait=True)
+    ins.close()
+    # 取消后不再执行后续操作
+    assert len(calls) == 1
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# coding=utf-8
+import pytest
+
+from benchmarks import run
+
+
+@pytest.mark.parametrize(
+    "case",
+    [
+        {"name": "circle", "kind": "action", "param": "circle,r_100", "size": "s", "mode": "RGBA"},
+        {"name": "watermark", "kind": "action", "param": "watermark,image_{overlay}", "size": "s", "mode": "P"},
+        {"name": "encode", "kind": "encode", "format": "JPEG", "size": "s", "mode": "L"},
+        {"name": "decode", "kind": "decode", "format": "PNG", "size": "s", "mode": "RGB"},
+    ],
+)
+def test_run_case(case: dict, tmpdir) -> None:
+    result = run.run_case(case, 2, str(tmpdir))
+    assert "error" not in result
+    assert result["time"] >= result["min"] > 0
+    assert result["mem"] >= 0
+
+
+def test_run_case_error(tmpdir) -> None:
+    case = {"name": "gif", "kind": "encode", "format": "GIF", "size": "s", "mode": "CMYK"}
+    assert "error" in run.run_case(case, 1, str(tmpdir))
+
+
+def test_iter_cases() -> None:
+    cases = list(run.iter_cases(["s"], ["RGB", "P"], ["PNG"]))
+    names = [case["name"] for case in cases]
+    assert len(names) == len(set(names))
+    assert "resize,s_200 P 640x480" in names
+    assert "decode:PNG RGB 640x480" in names
+
+
+def test_compare() -> None:
+    mb = 1024 * 1024
+    baseline = {
+        "cases": [
+            {"name": "a", "time": 0.1, "min": 0.1, "mem": 10 * mb},
+            {"name": "b", "time": 0.1, "min": 0.1, "mem": 10 * mb},
+            {"name": "c", "time": 0.1, "min": 0.1, "mem": 0},
+            {"name": "d", "error": "OSError()"},
+        ]
+    }
+    results = [
+        {"name": "a", "time": 0.11, "min": 0.1, "mem": 11 * mb},
+        {"name": "b", "time": 0.2, "min": 0.2, "mem": 20 * mb},
+        {"name": "c", "error": "OSError()"},
+        {"name": "d", "time": 1, "min": 1, "mem": 0},
+        {"name": "e", "time": 1, "min": 1, "mem": 0},
+    ]
+    regressions = run.compare(results, baseline, threshold=0.2, mem_threshold=0.2)
+    assert len(regressions) == 3
+    assert regressions[0].startswith("b: 耗时")
+    assert regressions[1].startswith("b: 峰值内存")
+    assert regressions[2].startswith("c: ")
+    assert run.compare(results[:2], baseline, threshold=1, mem_threshold=1.5) == []
+
+
+def test_main(tmpdir, capsys) -> None:
+    baseline = str(tmpdir.join("baseline.json"))
+    argv = ["-k", "gray", "--sizes", "s", "--modes", "L", "--repeat", "1", "--no-isolate"]
+    assert run.main([*argv, "--save", baseline]) == 0
+    assert run.main([*argv, "--compare", baseline, "--threshold", "100"]) == 0
+    assert "0 个用例退化" in capsys.readouterr().out
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# coding=utf-8
+import io
+import os
+import shutil
+import threading
+
+import pytest
+from PIL import Image
+
+from imgprocessor import processor, settings
+from imgprocessor.utils import base64url_encode
+from imgprocessor.cache import LRUCache, TieredCache, set_result_cache, get_result_cache
+from imgprocessor.parsers.base import overlay_cache, load_overlay, load_overlay_im
+
+
+@pytest.fixture
+def clean_overlay_cache(monkeypatch) -> None:
+    overlay_cache.clear()
+    monkeypatch.setattr(overlay_cache, "hits", 0)
+    monkeypatch.setattr(overlay_cache, "misses", 0)
+    yield
+    overlay_cache.clear()
+
+
+def test_lru_cache() -> None:
+    cache = LRUCache(10, sizeof=len)
+    cache.set("a", "1234")
+    cache.set("b", "1234")
+    assert cache.get("a") == "1234"
+    cache.set("c", "1234")
+    # b最久未使用，被淘汰
+    assert "b" not in cache
+    assert cache.get("b") is None
+    assert cache.get("c") == "1234"
+    # 超出容量的条目不缓存
+    cache.set("d", "1" * 11)
+    assert "d" not in cache
+    # 重复设置，更新大小
+    cache.set("a", "1")
+    assert cache.stats() == {"hits": 2, "misses": 1, "evictions": 1, "count": 2, "size": 5, "max_size": 10}
+    cache.pop("a")
+    assert len(cache) == 1
+    cache.clear()
+    assert cache.stats()["size"] == 0
+
+    # 容量为0不缓存
+    cache = LRUCache(0)
+    cache.set("a", 1)
+    assert len(cache) == 0
+
+
+def test_lru_cache_threads() -> None:
+    cache = LRUCache(50)
+
+    def run(n: int) -> None:
+        for i in range(1000):
+            cache.set((n, i % 100), i)
+            cache.get((n, (i + 1) % 100))
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(cache) == cache.size == 50
+
+
+@pytest.fixture
+def result_cache(tmp_path) -> TieredCache:
+    cache = TieredCache(10 * 1024 * 1024, str(tmp_path / "results"), 10 * 1024 * 1024)
+    set_result_cache(cache)
+    yield cache
+    set_result_cache(None)
+
+
+def test_tiered_cache(tmp_path) -> None:
+    cache = TieredCache(10, str(tmp_path), 1000)
+    assert cache.get("a") is None
+    cache.set("a", b"1234")
+    assert cache.get("a") == b"1234"
+    # 超出内存缓存容量的内容只在磁盘中
+    cache.set("b", b"1" * 20)
+    assert cache.get("b") == b"1" * 20
+    assert cache.stats()["disk"]["hits"] == 1
+    # 磁盘命中后放入内存
+    cache.memory.clear()
+    assert cache.get("a") == b"1234"
+    assert cache.get("a") == b"1234"
+    assert cache.stats()["disk"]["hits"] == 2
+    cache.clear()
+    assert cache.get("b") is None
+
+    # 只使用内存
+    cache = TieredCache(10)
+    cache.set("a", b"1234")
+    assert cache.get("a") == b"1234"
+    assert cache.stats()["disk"] is None
+
+
+def test_result_cache_settings(monkeypatch, mock_settings, tmp_path) -> None:
+    set_result_cache(None)
+    # 默认不使用缓存
+    assert get_result_cache() is None
+    monkeypatch.setattr(settings, "PROCESSOR_RESULT_CACHE_DIR", str(tmp_path))
+    cache = get_result_cache()
+    assert cache is not None and cache.disk is not None
+    assert get_result_cache() is cache
+    set_result_cache(None)
+
+
+@pytest.mark.usefixtures("clean_dir")
+def test_result_cache(result_cache) -> None:
+    param_str = "resize,s_100/watermark,image_d29sZi01MC5wbmc/format,png"
+    expected = processor.process_image("lenna-400x225.jpg", param_str, use_cache=False)
+    assert result_cache.stats()["memory"]["misses"] == 0
+
+    assert processor.process_image("lenna-400x225.jpg", param_str) == expected
+    assert processor.process_image("lenna-400x225.jpg", param_str) == expected
+    with open("lenna-400x225.jpg", "rb") as f:
+        data = f.read()
+    assert processor.process_image(data, param_str) == expected
+    assert processor.process_image(io.BytesIO(data), param_str) == expected
+    assert bytes(processor.process_image(data, param_str, use_memoryview=True)) == expected
+    stats = result_cache.stats()
+    # 文件路径和文件内容的key不同
+    assert stats["memory"]["hits"] == 3
+    assert stats["memory"]["misses"] == 2
+
+    # 磁盘缓存
+    result_cache.memory.clear()
+    assert processor.process_image("lenna-400x225.jpg", param_str) == expected
+    assert result_cache.stats()["disk"]["hits"] == 1
+    # 输出到文件
+    processor.process_image("lenna-400x225.jpg", param_str, out_path="out.png")
+    processor.process_image("lenna-400x225.jpg", param_str, out_path="out.png")
+    with open("out.png", "rb") as f:
+        assert f.read() == expected
+
+    # 叠加图像变化后缓存失效
+    shutil.copyfile("wolf-300.png", "wolf-50.png")
+    assert processor.process_image("lenna-400x225.jpg", param_str) != expected
+
+    # 输入文件变化后缓存失效
+    processor.process_image("lenna-400x225.jpg", "crop,w_100,h_100", out_path="lenna-400x225.jpg", use_cache=False)
+    os.utime("lenna-400x225.jpg", ns=(0, 0))
+    out = processor.process_image("lenna-400x225.jpg", param_str)
+    assert out == processor.process_image("lenna-400x225.jpg", param_str, use_cache=False)
+
+
+@pytest.mark.usefixtures("clean_dir", "clean_overlay_cache")
+def test_result_cache_overlay_url(result_cache, http_server) -> None:
+    """计算缓存key和执行操作使用同一次读取的叠加图像，每次处理只请求一次"""
+    url = f"{http_server.url}/wolf-50.png"
+    param_str = f"watermark,image_{base64url_encode(url)}/format,png"
+    out = processor.process_image("lenna-400x225.jpg", param_str)
+    assert [r[1] for r in http_server.requests] == [200]
+    assert processor.process_image("lenna-400x225.jpg", param_str) == out
+    assert [r[1] for r in http_server.requests] == [200, 304]
+
+
+@pytest.mark.usefixtures("clean_dir")
+def test_result_cache_obj(result_cache) -> None:
+    with Image.open("lenna-400x225.jpg") as im:
+        expected = processor.process_image_obj(im, "resize,s_100", use_cache=False)
+        assert processor.process_image_obj(im, "resize,s_100") == expected
+        assert processor.process_image_obj(im, "resize,s_100") == expected
+        processor.process_image_obj(im, "resize,s_100", out_path=io.BytesIO())
+    assert result_cache.stats()["memory"]["hits"] == 2
+
+    # 没有格式的图像，保存到文件时按后缀推断格式
+    im = Image.new("RGB", (50, 50), color="red")
+    processor.process_image_obj(im, "resize,s_10", out_path="out.png")
+    processor.process_image_obj(im, "resize,s_10", out_path="out2.png", use_cache=False)
+    with open("out.png", "rb") as f1, open("out2.png", "rb") as f2:
+        assert f1.read() == f2.read()
+
+
+@pytest.mark.usefixtures("clean_dir", "clean_overlay_cache")
+def test_overlay_cache_file() -> None:
+    im = load_overlay_im("wolf-50.png")
+    assert im.mode == "RGBA"
+    assert load_overlay_im("wolf-50.png") is im
+    assert overlay_cache.stats()["hits"] == 1
+
+    # 文件变化后重新读取
+    shutil.copyfile("wolf-300.png", "wolf-50.png")
+    os.utime("wolf-50.png", ns=(0, 0))
+    im2 = load_overlay_im("wolf-50.png")
+    assert im2 is not im
+    assert im2.size == (300, 300)
+
+
+@pytest.mark.usefixtures("clean_dir", "clean_overlay_cache")
+def test_overlay_cache_not_modified() -> None:
+    """水印和合并操作不能修改缓存的图像"""
+    # 参数校验时路径被转换成绝对路径
+    im = load_overlay_im(os.path.realpath("wolf-50.png"))
+    data = im.tobytes()
+    params = [
+        "watermark,image_d29sZi01MC5wbmc,t_50",
+        "merge,image_d29sZi01MC5wbmc,actions_YWxwaGEsNTA",
+    ]
+    for param_str in params:
+        out1 = processor.process_image("lenna-400x225.jpg", f"{param_str}/format,png")
+        out2 = processor.process_image("lenna-400x225.jpg", f"{param_str}/format,png")
+        assert out1 == out2
+    assert load_overlay_im(os.path.realpath("wolf-50.png")).tobytes() == data
+    assert overlay_cache.stats()["misses"] == 1
+
+
+@pytest.mark.usefixtures("clean_overlay_cache")
+def test_overlay_cache_url(http_server) -> None:
+    url = f"{http_server.url}/wolf-50.png"
+    im = load_overlay_im(url)
+    assert isinstance(im, Image.Image)
+    # 用ETag重新验证，未变化时复用缓存的图像
+    assert load_overlay_im(url) is im
+    assert [r[1] for r in http_server.requests] == [200, 304]
+
+
+@pytest.mark.usefixtures("clean_overlay_cache")
+def test_overlay_cache_url_fresh(http_server) -> None:
+    """Cache-Control有效期内不重新验证"""
+    url = f"{http_server.url}/wolf-50.png?max_age=60"
+    im = load_overlay_im(url)
+    assert load_overlay_im(url) is im
+    assert load_overlay_im(url) is im
+    assert [r[1] for r in http_server.requests] == [200]
+
+
+@pytest.mark.usefixtures("clean_overlay_cache")
+def test_overlay_cache_url_no_validators(http_server, mock_settings, monkeypatch) -> None:
+    """没有ETag/Last-Modified时按内容摘要作为版本，缓存 `PROCESSOR_OVERLAY_CACHE_TTL` 秒"""
+    url = f"{http_server.url}/wolf-50.png?validators=0"
+    version, im = load_overlay(url)
+    assert version is not None and version[:2] == (None, None)
+    assert load_overlay(url) == (version, im)
+    assert [r[1] for r in http_server.requests] == [200]
+
+    # 过期后重新下载，内容不变时版本不变
+    monkeypatch.setattr(settings, "PROCESSOR_OVERLAY_CACHE_TTL", 0)
+    overlay_cache.clear()
+    version2, im2 = load_overlay(url)
+    version3, im3 = load_overlay(url)
+    assert version2 == version3 == version
+    assert im3 is not im2
+    assert [r[1] for r in http_server.requests] == [200, 200, 200]
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# coding=utf-8
+import os
+import time
+import urllib.error
+
+import pytest
+
+from imgprocessor import settings
+from imgprocessor.cache import DiskCache
+from imgprocessor.exceptions import ParamValidateException
+from imgprocessor.fetcher import HttpFetcher, set_fetcher, get_fetcher
+from imgprocessor.parsers.base import trans_uri_to_im
+
+
+def _read(fetcher: HttpFetcher, url: str, **kwargs) -> tuple:
+    with fetcher.open(url, **kwargs) as resp:
+        return resp.status, resp.read()
+
+
+def test_keep_alive(http_server) -> None:
+    fetcher = HttpFetcher()
+    with open("tests/imgs/wolf-50.png", "rb") as f:
+        content = f.read()
+    for _ in range(5):
+        assert _read(fetcher, f"{http_server.url}/wolf-50.png") == (200, content)
+    # 复用同一个连接
+    assert http_server.connections == 1
+
+    # 未读取完整的响应不能复用连接
+    with fetcher.open(f"{http_server.url}/lenna-400x225.jpg") as resp:
+        resp.read(10)
+    assert _read(fetcher, f"{http_server.url}/wolf-50.png") == (200, content)
+    assert http_server.connections == 2
+    fetcher.close()
+
+
+def test_stale_connection(http_server) -> None:
+    """服务端关闭了空闲连接，自动换新连接"""
+    fetcher = HttpFetcher(retries=0)
+    url = f"{http_server.url}/wolf-50.png"
+    assert _read(fetcher, url)[0] == 200
+    for conns in fetcher._pool.values():
+        for conn in conns:
+            conn.sock.close()
+    assert _read(fetcher, url)[0] == 200
+
+
+def test_redirect_and_retry(http_server) -> None:
+    fetcher = HttpFetcher(retries=1)
+    with fetcher.open(f"{http_server.url}/redirect/wolf-50.png") as resp:
+        assert resp.status == 200
+        assert resp.url == f"{http_server.url}/wolf-50.png"
+        resp.read()
+
+    assert _read(fetcher, f"{http_server.url}/flaky/wolf-50.png")[0] == 200
+    assert [r[1] for r in http_server.requests[-2:]] == [503, 200]
+
+    with pytest.raises(urllib.error.HTTPError) as exc_info:
+        _read(HttpFetcher(retries=0), f"{http_server.url}/flaky/wolf-300.png")
+    assert exc_info.value.code == 503
+
+    with pytest.raises(urllib.error.HTTPError) as exc_info:
+        _read(fetcher, f"{http_server.url}/not-exists.png")
+    assert exc_info.value.code == 404
+
+
+def test_redirect_allow_domains(http_server, mock_settings, monkeypatch) -> None:
+    """跳转的域名同样需要在 `PROCESSOR_ALLOW_DOMAINS` 范围内"""
+    port = http_server.url.rsplit(":", 1)[1]
+    monkeypatch.setattr(settings, "PROCESSOR_ALLOW_DOMAINS", (f"127.0.0.1:{port}",))
+    fetcher = HttpFetcher()
+    assert _read(fetcher, f"{http_server.url}/redirect/wolf-50.png")[0] == 200
+
+    other = f"http://localhost:{port}/wolf-50.png"
+    with pytest.raises(ParamValidateException, match="域名不合法"):
+        _read(fetcher, f"{http_server.url}/redirect/wolf-50.png?to={other}")
+    # 没有请求跳转后的链接
+    assert http_server.requests[-1][1] == 302
+    fetcher.close()
+
+
+def test_timeout() -> None:
+    fetcher = HttpFetcher(timeout=0.01, retries=0)
+    # 不可路由的地址，连接超时
+    with pytest.raises(OSError):
+        fetcher.open("http://10.255.255.1/a.png")
+
+
+def test_conditional_request(http_server) -> None:
+    fetcher = HttpFetcher()
+    url = f"{http_server.url}/wolf-50.png"
+    with fetcher.open(url) as resp:
+        etag = resp.etag
+        assert resp.last_modified
+        resp.read()
+    with fetcher.open(url, etag=etag) as resp:
+        assert resp.not_modified
+        assert resp.read() == b""
+    assert http_server.requests[-1][2]["If-None-Match"] == etag
+
+
+def test_disk_cache(http_server, tmp_path) -> None:
+    fetcher = HttpFetcher(cache_dir=str(tmp_path))
+    with open("tests/imgs/wolf-50.png", "rb") as f:
+        content = f.read()
+
+    # 有效期内直接使用缓存，不发送请求
+    url = f"{http_server.url}/wolf-50.png?max_age=60"
+    assert _read(fetcher, url) == (200, content)
+    total = len(http_server.requests)
+    with fetcher.open(url) as resp:
+        assert resp.from_cache
+        assert resp.content_length == len(content)
+        assert resp.read() == content
+        etag = resp.etag
+    assert len(http_server.requests) == total
+    # 调用方已有的内容仍有效
+    assert _read(fetcher, url, etag=etag) == (304, b"")
+
+    # 过期后用ETag重新验证
+    url = f"{http_server.url}/wolf-50.png"
+    assert _read(fetcher, url) == (200, content)
+    assert _read(fetcher, url) == (200, content)
+    path, status, headers = http_server.requests[-1]
+    assert status == 304
+    assert headers["If-None-Match"] == etag
+
+    # 缓存在其他下载器实例(进程)中同样可用
+    assert _read(HttpFetcher(cache_dir=str(tmp_path)), url) == (200, content)
+
+    # 未读取完整的内容不写入缓存
+    url = f"{http_server.url}/lenna-400x225.jpg?max_age=60"
+    with fetcher.open(url) as resp:
+        resp.read(10)
+    assert fetcher.cache.get(url) is None
+
+
+def test_disk_cache_evict(tmp_path) -> None:
+    cache = DiskCache(str(tmp_path), 3500)
+    for i in range(3):
+        cache.set(f"k{i}", {"i": i}, b"x" * 1000)
+        # 保证修改时间不同
+        time.sleep(0.01)
+    assert cache.get_bytes("k0") == ({"i": 0, "key": "k0"}, b"x" * 1000)
+    cache.set("k3", {}, b"x" * 1000)
+    # k0刚被访问过，淘汰的是k1
+    assert cache.get("k1") is None
+    assert cache.get_bytes("k0") is not None
+    assert cache.stats()["evictions"] >= 1
+    assert cache.stats()["size"] <= 3500
+
+    # 超出缓存大小的内容不写入
+    cache.set("big", {}, b"x" * 4000)
+    assert cache.get("big") is None
+    assert not [name for _, _, names in os.walk(tmp_path) for name in names if name.endswith(".tmp")]
+
+    cache.clear()
+    assert cache.get("k0") is None
+
+
+def test_disk_cache_writer_evicted(tmp_path) -> None:
+    cache = DiskCache(str(tmp_path), 3500)
+    writer = cache.writer("w", {})
+    writer.write(b"x" * 1000)
+    # 淘汰时不删除其他写入者的临时文件
+    for i in range(4):
+        cache.set(f"k{i}", {}, b"x" * 1000)
+        time.sleep(0.01)
+    assert os.path.exists(writer.tmp_path)
+    assert cache.stats()["size"] <= 3500
+
+    # 临时文件仍被删除时(例如其他进程清理)，提交不报错，当作未缓存
+    os.remove(writer.tmp_path)
+    writer.commit()
+    assert cache.get("w") is None
+    cache.clear()
+
+
+def test_set_fetcher(http_server, mock_settings, monkeypatch, tmp_path) -> None:
+    monkeypatch.setattr(settings, "PROCESSOR_HTTP_CACHE_DIR", str(tmp_path))
+    set_fetcher(None)
+    fetcher = get_fetcher()
+    assert isinstance(fetcher, HttpFetcher)
+    assert fetcher.cache is not None
+    assert get_fetcher() is fetcher
+
+    with trans_uri_to_im(f"{http_server.url}/wolf-50.png?max_age=60", use_copy=True) as im:
+        pass
+    assert im.size == (50, 50)
+    with trans_uri_to_im(f"{http_server.url}/wolf-50.png?max_age=60") as im:
+        assert im.size == (50, 50)
+    assert len(http_server.requests) == 1
+
+    class MyFetcher(HttpFetcher):
+        pass
+
+    set_fetcher(MyFetcher())
+    assert isinstance(get_fetcher(), MyFetcher)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# coding=utf-8
+import io
+import os
+
+import pytest
+from PIL import Image
+
+from imgprocessor import hooks, processor
+from imgprocessor.parsers import GrayParser
+from imgprocessor.exceptions import ParamValidateException
+
+
+@pytest.fixture
+def events() -> list:
+    items: list = []
+    hooks.add_hook(items.append)
+    yield items
+    hooks.remove_hook(items.append)
+
+
+@pytest.mark.usefixtures("clean_dir")
+def test_hooks(events) -> None:
+    data = processor.process_image("wolf-50.png", "resize,s_20/alpha,50/format,jpeg")
+    assert [(e.stage, e.name) for e in events] == [
+        ("load", "PNG"),
+        ("action", "resize"),
+        ("action", "alpha"),
+        ("save", "JPEG"),
+    ]
+    load, resize, _, save = events
+    assert load.nbytes == os.path.getsize("wolf-50.png")
+    assert load.out_size == (50, 50) and load.out_mode == "RGBA"
+    assert resize.in_size == (50, 50) and resize.out_size == (20, 20)
+    assert resize.converted is False
+    # 保存为JPEG时转换了模式
+    assert save.in_mode == "RGBA" and save.out_mode == "RGB"
+    assert save.converted is True
+    assert save.nbytes == len(data)
+    for e in events:
+        assert e.wall_time >= 0 and e.cpu_time >= 0
+        assert e.error is None
+        assert repr(e).startswith(f"<StageEvent {e.stage}")
+
+    events.clear()
+    processor.process_image(data, "gray/format,png", out_path="out.png")
+    assert [(e.stage, e.name) for e in events][0] == ("load", "JPEG")
+    assert events[0].nbytes == len(data)
+    assert events[-1].name == "PNG"
+    assert events[-1].nbytes == os.path.getsize("out.png")
+
+    events.clear()
+    fp = io.BytesIO(b"abc")
+    fp.seek(3)
+    processor.process_image("wolf-50.png", "gray", out_path=fp)
+    assert events[-1].nbytes == len(fp.getvalue()) - 3
+
+
+@pytest.mark.usefixtures("clean_dir")
+def test_hooks_error(events, monkeypatch) -> None:
+    def do_action(self, im):
+        raise ParamValidateException("error")
+
+    monkeypatch.setattr(GrayParser, "do_action", do_action)
+    with pytest.raises(ParamValidateException):
+        processor.process_image("wolf-50.png", "resize,s_20/gray")
+    assert events[-1].stage == "action" and events[-1].name == "gray"
+    assert isinstance(events[-1].error, ParamValidateException)
+    assert events[-1].out_size is None
+
+    events.clear()
+    with pytest.raises(FileNotFoundError):
+        processor.process_image("not-exists.png", "gray")
+    assert [e.stage for e in events] == ["load"]
+    assert isinstance(events[0].error, FileNotFoundError)
+
+
+@pytest.mark.usefixtures("clean_dir")
+def test_hooks_multi(events) -> None:
+    processor.process_image_multi("lenna-400x225.jpg", ["resize,s_100/gray", "resize,s_100/rotate,90"])
+    stages = [(e.stage, e.name) for e in events]
+    # 相同的前缀操作只执行一次
+    assert stages.count(("action", "resize")) == 1
+    assert stages.count(("save", "JPEG")) == 2
+
+    hooks.clear_hooks()
+    events.clear()
+    processor.process_image("lenna-400x225.jpg", "resize,s_100")
+    assert events == []
+
+
+@pytest.mark.usefixtures("clean_dir")
+def test_hooks_convert(events) -> None:
+    # CMYK只转换一次成RGB，保存JPEG时不再转换
+    with Image.open("lenna-400x225.jpg") as im:
+        im.convert("CMYK").save("cmyk.jpg")
+    processor.process_image("cmyk.jpg", "resize,w_200/crop,w_100,h_100/format,jpeg", use_draft=False)
+    assert [(e.stage, e.name) for e in events if e.converted] == [("convert", "RGB")]
+    assert events[-1].in_mode == "RGB"
+
+    # 灰度图保持灰度
+    events.clear()
+    Image.linear_gradient("L").save("gray.png")
+    with Image.open(io.BytesIO(processor.process_image("gray.png", "resize,w_100/blur,r_2/rotate,90"))) as im:
+        assert im.mode == "L"
+    assert not [e for e in events if e.converted]
+
+    # 需要透明度、彩色时按需转换
+    for param_str, mode in [("rotate,45", "LA"), ("circle", "LA"), ("watermark,image_d29sZi01MC5wbmc", "RGB")]:
+        events.clear()
+        with Image.open(io.BytesIO(processor.process_image("gray.png", param_str))) as im:
+            assert im.mode == mode
+        assert [e.out_mode for e in events if e.converted] == [mode]
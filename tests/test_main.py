@@ -2,8 +2,11 @@
 # coding=utf-8
 import pytest
 import os
+import shutil
 import pathlib
 
+from PIL import Image
+
 import imgprocessor.processor
 from imgprocessor.main import main
 
@@ -40,3 +43,82 @@ def test_img_use_main() -> None:
 
     argv = f"-P {img_path}  -O ./  --action resize,s_200"
     assert main(argv=argv.split()) == 1
+
+
+@pytest.mark.usefixtures("clean_dir")
+@pytest.mark.parametrize("workers", [1, 2])
+def test_main_workers(workers: int, capsys) -> None:
+    os.makedirs("tmp/in/sub")
+    os.makedirs("tmp/out")
+    shutil.copyfile("lenna-400x225.jpg", "tmp/in/a.jpg")
+    shutil.copyfile("wolf-50.png", "tmp/in/sub/b.png")
+    # 文件头是图像但是无法处理的文件
+    pathlib.Path("tmp/in/c.jpg").write_bytes(b"\xff\xd8\xffnot image")
+
+    argv = f"-P tmp/in -O tmp/out --action resize,s_20/format,png --workers {workers}"
+    assert main(argv=argv.split()) == 1
+    # 默认遇到失败立即中断
+    assert "失败" in capsys.readouterr().err
+
+    argv = f"{argv} --continue-on-error --overwrite"
+    assert main(argv=argv.split()) == 1
+    out, err = capsys.readouterr()
+    assert "成功 2，失败 1，共 3 个文件" in err
+    for name in ["a.png", "sub/b.png"]:
+        with Image.open(os.path.join("tmp/out", name)) as im:
+            assert min(im.size) == 20
+
+    # 不同输入的输出路径重复
+    shutil.copyfile("wolf-50.png", "tmp/in/a.png")
+    os.remove("tmp/in/c.jpg")
+    assert main(argv=argv.split()) == 1
+    assert "输出路径重复" in capsys.readouterr().err
+
+    os.remove("tmp/in/a.png")
+    assert main(argv=argv.split()) == 0
+    assert "成功 2，失败 0" in capsys.readouterr().out
+
+
+@pytest.mark.usefixtures("clean_dir")
+def test_main_progress(capsys) -> None:
+    os.makedirs("tmp/in")
+    os.makedirs("tmp/out")
+    shutil.copyfile("lenna-400x225.jpg", "tmp/in/a.jpg")
+    shutil.copyfile("wolf-50.png", "tmp/in/b.png")
+    # 非图像文件跳过，不算失败
+    pathlib.Path("tmp/in/c.txt").write_text("text")
+    pathlib.Path("tmp/in/d.jpg").write_bytes(b"not image")
+
+    argv = "-P tmp/in -O tmp/out --action resize,s_20 --progress-interval 0"
+    assert main(argv=argv.split()) == 0
+    out = capsys.readouterr().out
+    # 默认不输出每个文件的结果
+    assert "a.jpg\t 成功" not in out
+    assert "成功 2，失败 0，共 2 个文件" in out
+    assert "跳过 2 个非图像文件" in out
+    assert sorted(os.listdir("tmp/out")) == ["a.jpg", "b.png"]
+
+    argv = "-P tmp/in -O tmp/out --action resize,s_20 --overwrite --ext png -v --progress-interval 0.000001"
+    assert main(argv=argv.split()) == 0
+    out = capsys.readouterr().out
+    assert "处理 tmp/in/b.png" in out and "overwrite\x1b[0m\t 成功" in out
+    assert "a.jpg" not in out
+    assert "进度：1/" in out
+    assert "跳过 3 个非图像文件" in out
+
+    # 默认不统计文件总数，只输出已处理数量和速度
+    argv = "-P tmp/in -O tmp/out --action resize,s_20 --overwrite --progress-interval 0.000001"
+    assert main(argv=argv.split()) == 0
+    out = capsys.readouterr().out
+    assert "进度：1，" in out and "预计剩余" not in out
+
+    # 统计文件总数，输出总数(统计完成后输出预计剩余时间)
+    argv = "-P tmp/in -O tmp/out --action resize,s_20 --overwrite --count-total --progress-interval 0.000001"
+    assert main(argv=argv.split()) == 0
+    out = capsys.readouterr().out
+    assert "进度：1/" in out
+
+
+def test_main_workers_invalid() -> None:
+    with pytest.raises(SystemExit):
+        main(argv="-P a.jpg -O b.jpg --action resize,s_20 --workers 0".split())
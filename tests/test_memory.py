@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# coding=utf-8
+import os
+import time
+import threading
+
+import pytest
+from PIL import Image
+
+from imgprocessor import settings, processor
+from imgprocessor.memory import (
+    MemoryBudget,
+    estimate_actions,
+    estimate_memory,
+    get_memory_budget,
+    set_memory_budget,
+)
+from imgprocessor.parsers import ProcessParams
+from imgprocessor.utils import base64url_encode
+from imgprocessor.parsers.base import overlay_cache, load_overlay_im
+from imgprocessor.exceptions import ProcessLimitException
+
+
+MB = 1024 * 1024
+
+
+@pytest.mark.parametrize(
+    "mode,param_str,expected",
+    [
+        # 输入 + 输出
+        ("L", "gray", (100, 50, "L", 100 * 50 * 2)),
+        # 灰度图保持L：输入 + 输出 + 中间图像
+        ("L", "resize,w_50", (50, 25, "L", 100 * 50 + 50 * 25 + 50 * 50)),
+        # 输入 + 转换成RGB + 输出 + 中间图像
+        ("P", "resize,w_50", (50, 25, "RGB", 100 * 50 + 100 * 50 * 4 + 50 * 25 * 4 + 50 * 50 * 4)),
+        # 直接修改输入图像，没有新分配内存
+        ("RGBA", "alpha", (100, 50, "RGBA", 100 * 50 * 4)),
+        ("RGB", "crop,w_10,h_10/rotate,90", (10, 10, "RGB", 100 * 50 * 4 + 10 * 10 * 4 * 2)),
+    ],
+)
+def test_estimate_actions(mode: str, param_str: str, expected: tuple) -> None:
+    actions = ProcessParams.parse_str(param_str).actions
+    assert estimate_actions(100, 50, mode, actions) == expected
+
+
+def test_estimate_actions_keep() -> None:
+    actions = ProcessParams.parse_str("crop,w_50,h_50/crop,w_40,h_40/blur,r_1").actions
+    _, _, _, peak = estimate_actions(100, 100, "RGB", actions)
+    _, _, _, keep_peak = estimate_actions(100, 100, "RGB", actions, keep_intermediate=True)
+    # 保留中间结果时，最后一个操作执行时第一个操作的结果仍然占用内存
+    assert keep_peak == peak + 50 * 50 * 4
+
+
+@pytest.mark.usefixtures("clean_dir")
+def test_estimate_memory() -> None:
+    params = "merge,image_d29sZi01MC5wbmc,actions_cmVzaXplLHBfMjAw,order_1"
+    with Image.open("lenna-400x225.jpg") as im:
+        small = estimate_memory(im, ProcessParams.parse_str("resize,s_100").actions)
+        large = estimate_memory(im, ProcessParams.parse_str("circle").actions)
+        merge = estimate_memory(im, ProcessParams.parse_str(params).actions)
+        # draft之后按缩小后的大小计算
+        im.draft("RGB", (100, 100))
+        draft = estimate_memory(im, ProcessParams.parse_str("resize,s_100").actions)
+    assert 400 * 225 * 4 * 2 < small < large
+    # 合并后的画布 500x225
+    assert merge > 500 * 225 * 4
+    assert draft < small
+
+
+@pytest.mark.usefixtures("clean_dir")
+@pytest.mark.parametrize("remote", [False, True])
+def test_estimate_memory_merge_probe(http_server, remote: bool) -> None:
+    """估算内存时只读取合并图像的文件头，不下载或解码整个图像"""
+    overlay_cache.clear()
+    image = f"{http_server.url}/wolf-300.png" if remote else os.path.realpath("wolf-300.png")
+    actions = ProcessParams(actions=[{"key": "merge", "image": image, "order": 1}]).actions
+    with Image.open("lenna-400x225.jpg") as im:
+        probed = estimate_memory(im, actions)
+        assert len(overlay_cache) == 0
+        assert len(http_server.requests) == int(remote)
+        # 与解码后按缓存的图像估算一致
+        load_overlay_im(image)
+        assert estimate_memory(im, actions) == probed
+    # 合并后的画布 700x300
+    assert probed > 700 * 300 * 4
+    overlay_cache.clear()
+
+
+@pytest.mark.usefixtures("clean_dir")
+def test_memory_budget_merge_remote(monkeypatch, mock_settings, http_server) -> None:
+    """设置内存预算时，远程的合并图像在估算和处理中只下载一次"""
+    overlay_cache.clear()
+    monkeypatch.setattr(settings, "PROCESSOR_MEMORY_BUDGET", 100)
+    set_memory_budget(None)
+    image = f"{http_server.url}/wolf-300.png"
+    try:
+        assert processor.process_image("lenna-400x225.jpg", f"merge,image_{base64url_encode(image)},order_1")
+        assert len(http_server.requests) == 1
+    finally:
+        set_memory_budget(None)
+        overlay_cache.clear()
+
+
+def test_memory_budget() -> None:
+    budget = MemoryBudget(100, timeout=0)
+    with pytest.raises(ProcessLimitException, match="超过了内存预算"):
+        budget.acquire(101)
+    with budget.reserve(60):
+        assert budget.stats() == {"limit": 100, "used": 60, "waiting": 0}
+        # 不等待直接失败
+        with pytest.raises(ProcessLimitException, match="超时"):
+            budget.acquire(50)
+        budget.acquire(40)
+        budget.release(40)
+    assert budget.used == 0
+
+
+def test_memory_budget_wait() -> None:
+    budget = MemoryBudget(100, timeout=5)
+    order = []
+
+    def worker(name: str, nbytes: int) -> None:
+        with budget.reserve(nbytes):
+            order.append(name)
+
+    budget.acquire(100)
+    threads = []
+    for name, nbytes in [("large", 100), ("small", 10)]:
+        t = threading.Thread(target=worker, args=(name, nbytes))
+        t.start()
+        threads.append(t)
+        while budget.stats()["waiting"] < len(threads):
+            time.sleep(0.01)
+    budget.release(100)
+    for t in threads:
+        t.join()
+    # 按申请的先后顺序分配
+    assert order == ["large", "small"]
+    assert budget.used == 0
+
+
+def test_memory_budget_check() -> None:
+    budget = MemoryBudget(100, timeout=None)
+    budget.acquire(100)
+    calls = []
+
+    def check() -> None:
+        calls.append(1)
+        if len(calls) > 2:
+            raise RuntimeError("cancelled")
+
+    with pytest.raises(RuntimeError):
+        budget.acquire(10, check=check)
+    assert budget.stats()["waiting"] == 0
+
+
+@pytest.mark.usefixtures("clean_dir")
+def test_memory_budget_settings(monkeypatch, mock_settings) -> None:
+    set_memory_budget(None)
+    assert get_memory_budget() is None
+    monkeypatch.setattr(settings, "PROCESSOR_MEMORY_BUDGET", 2)
+    monkeypatch.setattr(settings, "PROCESSOR_MEMORY_BUDGET_TIMEOUT", 0)
+    budget = get_memory_budget()
+    assert budget is not None and budget.limit == 2 * MB and budget.timeout == 0
+    assert get_memory_budget() is budget
+
+    try:
+        assert processor.process_image("lenna-400x225.jpg", "resize,s_100")
+        assert processor.process_image_multi("lenna-400x225.jpg", ["resize,s_100", "gray"])
+        with pytest.raises(ProcessLimitException, match="内存预算"):
+            processor.process_image("lenna-400x225.jpg", "rotate,45")
+        with pytest.raises(ProcessLimitException, match="内存预算"):
+            processor.process_image_multi("lenna-400x225.jpg", ["gray", "rotate,45"])
+        with Image.open("lenna-400x225.jpg") as im:
+            with pytest.raises(ProcessLimitException, match="内存预算"):
+                processor.process_image_obj(im, "rotate,45")
+        assert budget.used == 0
+    finally:
+        set_memory_budget(None)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# coding=utf-8
+import pytest
+
+from PIL import Image, ImageChops
+
+from imgprocessor.parsers import ProcessParams
+from imgprocessor.processor import ProcessorCtr
+from imgprocessor.optimizer import optimize_actions, plan_mode, BoxResizeParser
+
+
+@pytest.mark.parametrize(
+    "src_size,param_str,expected",
+    [
+        ((400, 225), "rotate,0/rotate,360/alpha,100/resize,s_225/crop,w_400", []),
+        ((400, 225), "resize,p_50/resize,p_50", [("BoxResizeParser", (100, 56))]),
+        ((400, 225), "resize,p_50/resize,p_200", [("ResizeParser", (200, 112))]),
+        ((400, 225), "resize,p_50/resize,p_200,limit_0", [("BoxResizeParser", (400, 224))]),
+        ((400, 225), "resize,w_4000,limit_0/crop,x_100,y_100,w_100,h_50", [("BoxResizeParser", (100, 50))]),
+        ((400, 225), "crop,x_10,y_10,padr_10,padb_10/crop,w_100,h_100", [("CropParser", (100, 100))]),
+        ((400, 225), "rotate,90/rotate,180/rotate,90", []),
+        ((400, 225), "rotate,90/rotate,45", [("RotateParser", (225, 400)), ("RotateParser", (443, 442))]),
+        ((400, 225), "alpha,50/alpha,30/gray/gray", [("AlphaParser", (400, 225)), ("GrayParser", (400, 225))]),
+        (
+            (400, 225),
+            "resize,m_pad,w_100,h_100/resize,p_50",
+            [("ResizeParser", (100, 100)), ("ResizeParser", (50, 50))],
+        ),
+        # 插值算法不同时不合并
+        (
+            (400, 225),
+            "resize,p_50/resize,p_50,f_bilinear",
+            [("ResizeParser", (200, 112)), ("ResizeParser", (100, 56))],
+        ),
+        ((400, 225), "resize,p_50,f_lanczos/resize,p_50", [("BoxResizeParser", (100, 56))]),
+        ((400, 225), "resize,p_50,fast_1/crop,w_100,h_50", [("BoxResizeParser", (100, 50))]),
+        (
+            (400, 225),
+            "resize,p_50/blur,r_2/resize,p_50",
+            [("ResizeParser", (200, 112)), ("BlurParser", (200, 112)), ("ResizeParser", (100, 56))],
+        ),
+    ],
+)
+def test_optimize_actions(src_size: tuple, param_str: str, expected: list) -> None:
+    params = ProcessParams.parse_str(param_str)
+    actions = optimize_actions(params.actions, *src_size)
+    out = []
+    size = src_size
+    for parser in actions:
+        size = parser.compute_output_size(*size)
+        out.append((parser.__class__.__name__, size))
+    assert out == expected
+
+
+@pytest.mark.parametrize(
+    "param_str",
+    [
+        "resize,w_1000,limit_0/crop,x_100,y_100,w_300,h_200",
+        "resize,p_30,f_box,fast_1/crop,x_10,y_10,w_50,h_30",
+        "resize,m_fixed,w_300,h_700,limit_0/crop,g_center,w_100,h_100/crop,x_10,w_50",
+        "crop,x_10,y_10,w_300,h_200/crop,g_se,w_100,h_100",
+        "rotate,90/rotate,90/alpha,60/alpha,40",
+    ],
+)
+def test_optimize_same_result(param_str: str) -> None:
+    """合并后的操作，与原操作的结果一致"""
+    im = Image.linear_gradient("L").resize((400, 225)).convert("RGB")
+    params = ProcessParams.parse_str(param_str)
+    out1 = ProcessorCtr.handle_img_actions(im, params.actions, optimize=False)
+    out2 = ProcessorCtr.handle_img_actions(im, params.actions, optimize=True)
+    assert out1.size == out2.size
+    assert out1.mode == out2.mode
+    diff = ImageChops.difference(out1, out2)
+    assert max(v for band in diff.getextrema() for v in band) <= 1
+
+
+def test_optimize_unknown_size() -> None:
+    params = ProcessParams(
+        actions=[
+            {"key": "merge", "image": "tests/imgs/wolf-50.png"},
+            {"key": "resize", "p": 50},
+            {"key": "rotate", "value": 0},
+            {"key": "resize", "p": 50},
+        ]
+    )
+    actions = optimize_actions(params.actions, 400, 225)
+    # merge之后无法推算大小，不合并resize
+    assert [a.__class__.__name__ for a in actions] == ["MergeParser", "ResizeParser", "ResizeParser"]
+    assert actions[1] is params.actions[1]
+
+
+def test_box_resize_parser() -> None:
+    parser = BoxResizeParser((0, 0, 400, 225), 400, 225)
+    assert repr(parser) == (
+        "BoxResizeParser({'m': 'fixed', 'w': 400, 'h': 225, 'l': 0, 's': 0, 'limit': 0, 'color': 'FFFFFF', 'p': 0, "
+        "'f': None, 'fast': 0, 'box': (0, 0, 400, 225)})"
+    )
+    im = Image.new("RGB", (400, 225))
+    assert parser.do_action(im) is im
+
+
+@pytest.mark.parametrize(
+    "mode,param_str,transparency,expected",
+    [
+        # 处理时使用的模式，各操作按需转换
+        ("RGB", "resize,w_10/circle", False, None),
+        ("L", "resize,w_10/watermark,text_YWJj", False, None),
+        # 其他模式按后续操作需要的模式只转换一次
+        ("CMYK", "resize,w_10/crop,w_5", False, "RGB"),
+        ("P", "resize,w_10/circle", False, "RGBA"),
+        ("P", "rotate,45", False, "RGBA"),
+        ("P", "resize,m_pad,w_10,h_10,color_FF000080", False, "RGBA"),
+        ("1", "resize,w_10/rotate,90", False, "L"),
+        ("1", "resize,w_10/alpha,50", False, "LA"),
+        ("1", "watermark,text_YWJj", False, "RGB"),
+        ("L", "resize,w_10", True, "LA"),
+        ("P", "resize,w_10", True, "RGBA"),
+        ("I;16", "crop,w_10/gray/circle", False, "L"),
+        ("I;16", "crop,w_10/circle", False, "LA"),
+        # gray直接转换，没有操作时由编码时转换
+        ("P", "gray/circle", False, None),
+        ("CMYK", "", False, None),
+    ],
+)
+def test_plan_mode(mode: str, param_str: str, transparency: bool, expected: str) -> None:
+    actions = ProcessParams.parse_str(param_str).actions
+    assert plan_mode(mode, actions, transparency=transparency) == expected
@@ -1,12 +1,14 @@
 #!/usr/bin/env python
 # coding=utf-8
 import typing
+import os
+import shutil
 import pytest
 
-from PIL import Image
+from PIL import Image, ImageOps
 
 from imgprocessor import enums, settings
-from imgprocessor.parsers import base as parser_base, ProcessParams
+from imgprocessor.parsers import base as parser_base, ProcessParams, compile_params, plan_cache
 from imgprocessor.exceptions import ParamValidateException, ParamParseException
 
 
@@ -84,10 +86,32 @@ def test_splice_two_im(params: tuple, expected: tuple) -> None:
 
 
 @pytest.mark.usefixtures("clean_dir")
-def test_pre_processing(img_rotate_90_with_exif: Image) -> None:
-    assert img_rotate_90_with_exif.getexif().get(0x0112) > 0
-    im = parser_base.pre_processing(img_rotate_90_with_exif)
+def test_apply_orientation(img_rotate_90_with_exif: Image) -> None:
+    orientation = parser_base.get_orientation(img_rotate_90_with_exif)
+    assert orientation == enums.ImageOrientation.RIGHT_TOP.value
+    im = parser_base.apply_orientation(img_rotate_90_with_exif, orientation)
+    assert im.size == (400, 225)
     assert im.getexif().get(0x0112) is None
+    assert parser_base.get_orientation(im) == 1
+    # 摆正后的图像不会再次旋转
+    assert parser_base.apply_orientation(im, parser_base.get_orientation(im)) is im
+
+
+@pytest.mark.parametrize("orientation", range(1, 9))
+@pytest.mark.parametrize("rotate", [0, 90, 180, 270])
+def test_orientation_transpose(orientation: int, rotate: int) -> None:
+    im = Image.new("L", (3, 2))
+    im.putdata(range(6))
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    im.info["exif"] = exif.tobytes()
+    # 与先摆正、再旋转的结果一致
+    expected = ImageOps.exif_transpose(im).rotate(360 - rotate, expand=True)
+    out = parser_base.apply_orientation(im, orientation, rotate=rotate)
+    assert out.size == expected.size
+    assert out.tobytes() == expected.tobytes()
+    if rotate == 0:
+        assert parser_base.is_transposed(orientation) == (out.size == (2, 3))
 
 
 def test_process_params() -> None:
@@ -97,6 +121,43 @@ def test_process_params() -> None:
     assert save_params == {"interlace": 1, "format": "png", "progressive": True}
 
 
+@pytest.mark.usefixtures("clean_dir")
+def test_compile_params(monkeypatch) -> None:
+    monkeypatch.setattr(plan_cache, "hits", 0)
+    plan_cache.clear()
+    param_str = "resize,w_100,h_50/watermark,image_d29sZi01MC5wbmc/format,png"
+    p1 = compile_params(param_str)
+    assert compile_params(param_str) is p1
+    assert compile_params(p1) is p1
+    assert plan_cache.stats()["hits"] == 1
+    assert isinstance(p1.actions, tuple)
+    with pytest.raises(AttributeError):
+        p1.actions = ()
+
+    # 参数顺序不同，处理效果相同
+    p2 = compile_params("resize,h_50,w_100/watermark,image_d29sZi01MC5wbmc/format,png")
+    assert p2 is not p1
+    assert p2 == p1
+    assert hash(p2) == hash(p1)
+    assert p1 in {p2}
+    assert compile_params(ProcessParams.parse_str(param_str)) == p1
+    assert compile_params(param_str.replace("png", "jpeg")) != p1
+
+    merge_params = {"actions": [{"key": "merge", "image": "wolf-50.png", "actions": "resize,w_10"}]}
+    assert compile_params(merge_params) == compile_params(merge_params)
+    assert compile_params(merge_params) != compile_params(
+        {"actions": [{"key": "merge", "image": "wolf-50.png", "actions": "resize,w_20"}]}
+    )
+
+    # 相对路径按当前工作目录解析，切换目录后重新编译
+    os.mkdir("sub")
+    shutil.copyfile("wolf-50.png", "sub/wolf-50.png")
+    os.chdir("sub")
+    p3 = compile_params(param_str)
+    assert p3 != p1
+    assert p3.actions[1].image == os.path.realpath("wolf-50.png")
+
+
 @pytest.mark.usefixtures("mock_settings")
 def test_validate_uri(monkeypatch, link_uri) -> None:
     monkeypatch.setattr(settings, "PROCESSOR_WORKSPACES", ("/tmp",))
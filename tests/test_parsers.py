@@ -1,11 +1,14 @@
 #!/usr/bin/env python
 # coding=utf-8
+import io
 import typing
 import pytest
+from PIL import Image, ImageChops, ImageDraw, ImageFont, ImageOps, ImageStat
 
-from imgprocessor import settings, parsers, enums
+from imgprocessor import settings, parsers, enums, processor
 from imgprocessor.utils import base64url_encode
-from imgprocessor.parsers import ProcessParams, _ACTION_PARASER_MAP
+from imgprocessor.parsers import ProcessParams, _ACTION_PARASER_MAP, watermark, circle
+from imgprocessor.parsers.base import pre_processing
 from imgprocessor.exceptions import ParamValidateException, ProcessLimitException, ParamParseException
 
 
@@ -109,6 +112,8 @@ def test_resize_compute(src_size: tuple, param_str: str, expected: tuple) -> Non
         ((1920, 1080), "resize,m_lfit", ParamValidateException, "缺少合法参数"),
         ((1920, 1080), "resize,m_fixed,w_100", ParamValidateException, "参数w和h都必不可少"),
         ((1920, 1080), "resize,m_pad2", ParamValidateException, "枚举值只能是其中之一"),
+        ((1920, 1080), "resize,w_100,f_cubic", ParamValidateException, "枚举值只能是其中之一"),
+        ((1920, 1080), "resize,w_100,fast_2", ParamValidateException, "枚举值只能是其中之一"),
         ((1920, 1080), "resize,w_a", ParamValidateException, "参数类型不符合要求"),
         ((1920, 1080), "resize,w_1.1", ParamValidateException, "必须是整数"),
         ((1920, 1080), "resize,w_0", ParamValidateException, "参数不在取值范围内"),
@@ -129,6 +134,74 @@ def test_resize_exception(src_size: tuple, params: typing.Union[str, dict], exce
         action.compute(*src_size)
 
 
+@pytest.mark.parametrize(
+    "param_str",
+    [
+        "resize,m_pad,w_300,h_300,color_FF0000",
+        "resize,m_pad,w_300,h_100",
+        "resize,m_pad,w_301,h_300",
+        "resize,m_pad,w_7,h_299",
+        "resize,m_pad,w_333,h_111,f_bilinear",
+        "resize,m_fit,w_300,h_300",
+        "resize,m_fit,w_150,h_400,limit_0",
+        "resize,m_fit,w_13,h_7",
+    ],
+)
+def test_resize_pad_fit(param_str: str) -> None:
+    """`pad`/`fit` 的结果与当前版本Pillow的 `ImageOps` 一致"""
+    with Image.open("tests/imgs/lenna-400x225.jpg") as im:
+        im.load()
+    action = parsers.ResizeParser.init_by_str(param_str)
+    size = action.compute(*im.size)
+    if action.m == enums.ResizeMode.PAD.value:
+        expected = ImageOps.pad(im, size, method=action.get_resample(), color=f"#{action.color}")
+    else:
+        expected = ImageOps.fit(im, size, method=action.get_resample())
+    out = action.do_action(im)
+    assert out.size == size
+    assert out.tobytes() == expected.tobytes()
+
+
+@pytest.mark.parametrize(
+    "param_str,resample",
+    [
+        ("resize,w_100", Image.LANCZOS),
+        ("resize,m_pad,w_100,h_100", Image.BICUBIC),
+        ("resize,m_fit,w_100,h_100,f_nearest", Image.NEAREST),
+        ("resize,w_100,f_bilinear", Image.BILINEAR),
+    ],
+)
+def test_resize_filter(param_str: str, resample: int) -> None:
+    action = parsers.ResizeParser.init_by_str(param_str)
+    assert action.get_resample() == resample
+    im = Image.linear_gradient("L").resize((400, 225)).convert("RGB")
+    out = action.do_action(im)
+    if action.m not in [enums.ResizeMode.PAD.value, enums.ResizeMode.FIT.value]:
+        assert out.tobytes() == im.resize(out.size, resample=resample).tobytes()
+
+
+@pytest.mark.parametrize(
+    "param_str",
+    [
+        "resize,w_100,fast_1",
+        "resize,m_fit,w_50,h_50,fast_1",
+        "resize,m_fit,w_33,h_71,fast_1",
+        "resize,m_pad,w_100,h_100,fast_1",
+        "resize,m_pad,w_77,h_13,fast_1",
+        "resize,p_10,fast_1",
+    ],
+)
+def test_resize_fast(param_str: str) -> None:
+    """快速模式的结果与直接插值相差很小"""
+    with Image.open("tests/imgs/lenna-400x225.jpg") as im:
+        im = im.resize((1600, 900))
+    out = parsers.ResizeParser.init_by_str(param_str).do_action(im)
+    exact = parsers.ResizeParser.init_by_str(param_str.replace("fast_1", "fast_0")).do_action(im)
+    assert out.size == exact.size
+    diff = ImageChops.difference(out, exact)
+    assert max(ImageStat.Stat(diff).mean) <= 2
+
+
 @pytest.mark.parametrize(
     "src_size,param_str,expected",
     [
@@ -193,6 +266,93 @@ def test_circle_compute(src_size: tuple, param_str: str, expected: tuple) -> Non
     assert out == expected
 
 
+@pytest.mark.parametrize("rad", [1, 7, 60])
+def test_circle_mask(rad: int) -> None:
+    mask = circle.get_corner_mask(rad)
+    assert circle.get_corner_mask(rad) is mask
+    assert mask.mode == "L" and mask.size == (rad, rad)
+    # 与放大16倍绘制后缩小的结果接近
+    big = Image.new("L", (rad * 32, rad * 32), 0)
+    ImageDraw.Draw(big).ellipse((0, 0, rad * 32 - 1, rad * 32 - 1), fill=255)
+    expected = big.resize((rad * 2, rad * 2), resample=Image.BOX).crop((0, 0, rad, rad))
+    assert max(abs(a - b) for a, b in zip(mask.tobytes(), expected.tobytes())) <= 16
+    # 角上完全透明，圆心附近不透明
+    assert mask.getpixel((0, 0)) == 0 or rad == 1
+    assert mask.getpixel((rad - 1, rad - 1)) == 255 or rad == 1
+
+
+@pytest.mark.parametrize(
+    "mode,param_str,expected",
+    [
+        ("I;16", "resize,w_100", "L"),
+        ("I;16B", "resize,w_100", "L"),
+        ("I", "crop,w_50", "L"),
+        ("F", "resize,w_100", "L"),
+        ("I;16", "alpha,50", "LA"),
+        ("I;16", "circle,r_10", "LA"),
+        ("I;16", "rotate,90", "L"),
+        ("I;16", "rotate,45", "LA"),
+    ],
+)
+def test_gray_high_bit_depth(tmp_path, mode: str, param_str: str, expected: str) -> None:
+    """16位/32位的灰度图处理时使用 `L`/`LA`，不转换成彩色"""
+    src = Image.linear_gradient("L").resize((200, 100)).convert(mode)
+    im = src
+    for action in parsers.ProcessParams.parse_str(param_str).actions:
+        im = action.do_action(pre_processing(im, mode=action.working_mode(im.mode)))
+    assert im.mode == expected
+    if expected == "L":
+        # 与转换成RGB后处理的灰度值一致
+        rgb = src.convert("RGB")
+        for action in parsers.ProcessParams.parse_str(param_str).actions:
+            rgb = action.do_action(rgb)
+        assert im.tobytes() == rgb.convert("L").tobytes()
+
+    if mode == "I;16":
+        path = str(tmp_path / "gray-16.png")
+        src.save(path)
+        # Pillow<10 读取16位PNG时是 `I` 模式
+        assert Image.open(path).mode in ["I;16", "I"]
+        out = Image.open(io.BytesIO(processor.process_image(path, param_str)))
+        assert out.mode == expected
+
+
+def test_circle_action() -> None:
+    im = Image.new("LA", (100, 60), (200, 128))
+    out = parsers.CircleParser(r=20).do_action(im)
+    assert out.mode == "LA" and out.size == (100, 60)
+    # 透明度替换成圆角遮罩，原有的透明度不保留
+    assert out.getpixel((50, 30)) == (200, 255)
+    assert out.getpixel((0, 0))[1] == out.getpixel((99, 59))[1] == 0
+    assert out.getpixel((99, 0)) == out.getpixel((0, 59)) == out.getpixel((0, 0))
+    assert out.getpixel((19, 19)) == (200, 255)
+
+
+def test_circle_alpha() -> None:
+    """透明度与放大6倍绘制圆形的遮罩替换透明度的结果一致"""
+    im = Image.open("tests/imgs/wolf-300.png").convert("RGBA")
+    rad = 50
+    out = parsers.CircleParser(r=rad).do_action(im.copy())
+    big = Image.new("L", (rad * 12, rad * 12), 0)
+    ImageDraw.Draw(big).ellipse((0, 0, rad * 12, rad * 12), fill=255)
+    circle_im = big.resize((rad * 2, rad * 2), resample=Image.LANCZOS)
+    alpha = Image.new("L", im.size, 255)
+    for box, xy in [
+        ((0, 0, rad, rad), (0, 0)),
+        ((0, rad, rad, rad * 2), (0, 300 - rad)),
+        ((rad, 0, rad * 2, rad), (300 - rad, 0)),
+        ((rad, rad, rad * 2, rad * 2), (300 - rad, 300 - rad)),
+    ]:
+        alpha.paste(circle_im.crop(box), xy)
+    # 只有圆弧经过的像素抗锯齿的结果略有差异
+    diff = ImageChops.difference(out.getchannel("A"), alpha)
+    assert ImageStat.Stat(diff).mean[0] < 0.5
+    # 原有的透明度不保留：四个角之外完全不透明
+    assert out.getchannel("A").crop((rad, 0, 300 - rad, 300)).getextrema() == (255, 255)
+    assert out.getchannel("A").crop((0, rad, 300, 300 - rad)).getextrema() == (255, 255)
+    assert out.convert("RGB").tobytes() == im.convert("RGB").tobytes()
+
+
 @pytest.mark.parametrize(
     "src_size,params,exception,error",
     [
@@ -212,6 +372,7 @@ def test_circle_exception(src_size: tuple, params: typing.Union[str, dict], exce
     "src_size,params,exception,error",
     [
         ((1920, 1080), "blur", ParamValidateException, "缺少必要参数"),
+        ((1920, 1080), "blur,r_10,fast_2", ParamValidateException, "只能是其中之一"),
     ],
 )
 def test_blur_exception(src_size: tuple, params: typing.Union[str, dict], exception: Exception, error: str) -> None:
@@ -222,6 +383,35 @@ def test_blur_exception(src_size: tuple, params: typing.Union[str, dict], except
             parsers.BlurParser.init(params)
 
 
+@pytest.mark.parametrize(
+    "src_size,param_str,expected",
+    [
+        ((1920, 1080), "blur,r_100", 1),
+        ((1920, 1080), "blur,r_100,fast_1", 12),
+        ((1920, 1080), "blur,r_10,fast_1", 1),
+        ((4000, 640), "blur,r_100,fast_1", 10),
+        # 小图、半径相对图像过大时直接模糊
+        ((300, 300), "blur,r_20,fast_1", 1),
+        ((1920, 1080), "blur,r_512,fast_1", 1),
+    ],
+)
+def test_blur_compute_scale(src_size: tuple, param_str: str, expected: int) -> None:
+    assert parsers.BlurParser.init_by_str(param_str).compute_scale(*src_size) == expected
+
+
+@pytest.mark.parametrize("r", [20, 100, 512])
+def test_blur_fast(r: int) -> None:
+    with Image.open("tests/imgs/lenna-400x225.jpg") as im:
+        im = im.resize((1201, 677))
+    exact = parsers.BlurParser(r=r).do_action(im)
+    out = parsers.BlurParser(r=r, fast=1).do_action(im)
+    assert out.size == exact.size and out.mode == exact.mode
+    # 误差范围 see `BlurParser.compute_scale`
+    diff = ImageChops.difference(out, exact)
+    assert max(ImageStat.Stat(diff).mean) <= 1
+    assert max(band[1] for band in diff.getextrema()) <= 16
+
+
 @pytest.mark.usefixtures("clean_dir")
 @pytest.mark.parametrize(
     "param_str,expected",
@@ -258,6 +448,100 @@ def test_wm_exception(params: typing.Union[str, dict], exception: Exception, err
         action.get_watermark_im()
 
 
+def test_wm_font_cache(monkeypatch) -> None:
+    calls = []
+    # 只关心加载次数，用默认字体代替（Pillow<10.1 的 load_default 不支持 size 参数）
+    default_font = ImageFont.load_default()
+
+    def truetype(font: str, size: int) -> typing.Any:
+        calls.append((font, size))
+        return default_font
+
+    monkeypatch.setattr(watermark.ImageFont, "truetype", truetype)
+    watermark.font_cache.clear()
+    watermark.preload_fonts([(None, 20), ("a.ttf", 20)])
+    assert calls == [(settings.PROCESSOR_TEXT_FONT, 20), ("a.ttf", 20)]
+
+    action = parsers.WatermarkParser.init_by_str(f"watermark,text_{base64url_encode('Hello')},size_20")
+    for _ in range(3):
+        action.get_watermark_im()
+    # 预加载之后不再加载字体
+    assert len(calls) == 2
+    # 不同字号单独缓存
+    watermark.load_font("a.ttf", 30)
+    watermark.load_font("a.ttf", 20)
+    assert calls[2:] == [("a.ttf", 30)]
+    watermark.font_cache.clear()
+
+
+@pytest.mark.usefixtures("clean_dir")
+def test_wm_mark_cache(monkeypatch) -> None:
+    watermark.mark_cache.clear()
+    action = parsers.WatermarkParser.init_by_str(
+        f"watermark,image_{base64url_encode('wolf-300.png')},x_20,y_20,t_50,rotate_30,design_200"
+    )
+    src = Image.open("lenna-400x225.jpg")
+    out1 = action.do_action(src.copy())
+    out2 = action.do_action(src.copy())
+    assert out1.tobytes() == out2.tobytes()
+    assert watermark.mark_cache.stats()["hits"] >= 1
+
+    # 水印超出图像大小，不修改操作的参数
+    out3 = action.do_action(src.resize((100, 50)))
+    assert (action.x, action.y) == (20, 20)
+    assert action.do_action(src.copy()).tobytes() == out1.tobytes()
+
+    # 与不使用缓存的结果一致
+    monkeypatch.setattr(watermark.mark_cache, "max_size", 0)
+    watermark.mark_cache.clear()
+    assert action.do_action(src.resize((100, 50))).tobytes() == out3.tobytes()
+    assert len(watermark.mark_cache) == 0
+
+
+def _paste_fill_by_loop(im: Image.Image, mark: Image.Image, x: int, y: int, padx: int, pady: int) -> None:
+    """逐个粘贴水印的平铺方式，用于对比结果"""
+    src_w, src_h = im.size
+    w, h = mark.size
+    wx, wy = x, y
+    while wx > 0:
+        wx = wx - w - padx
+    while wy > 0:
+        wy = wy - h - pady
+    ux = wx
+    while ux <= src_w:
+        uy = wy
+        while uy <= src_h:
+            im.paste(mark, (ux, uy), mark)
+            uy = uy + h + pady
+        ux = ux + w + padx
+
+
+@pytest.mark.parametrize(
+    "src_size,mark_size,xy,pad",
+    [
+        ((400, 225), (50, 30), (10, 10), (0, 0)),
+        ((400, 225), (50, 30), (175, 97), (13, 7)),
+        ((401, 333), (37, 19), (0, 0), (100, 50)),
+        ((100, 80), (100, 20), (0, 30), (5, 5)),
+        ((120, 90), (30, 30), (-10, -5), (0, 3)),
+    ],
+)
+def test_wm_paste_fill(src_size: tuple, mark_size: tuple, xy: tuple, pad: tuple) -> None:
+    mark = Image.linear_gradient("L").resize(mark_size).convert("RGBA")
+    mark.putalpha(Image.linear_gradient("L").rotate(90).resize(mark_size))
+    src = Image.radial_gradient("L").resize(src_size).convert("RGBA")
+
+    expected = src.copy()
+    _paste_fill_by_loop(expected, mark, *xy, *pad)
+    action = parsers.WatermarkParser(text="a", fill=1, padx=pad[0], pady=pad[1])
+    for _ in range(2):
+        # 第二次使用缓存的图层
+        out = src.copy()
+        action.paste_fill(out, mark, *xy)
+        assert out.tobytes() == expected.tobytes()
+    watermark.fill_cache.clear()
+
+
 @pytest.mark.usefixtures("clean_dir")
 @pytest.mark.parametrize(
     "input_params,param_str,expected",
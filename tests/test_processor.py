@@ -1,15 +1,16 @@
 #!/usr/bin/env python
 # coding=utf-8
+import io
 import os
 import tempfile
 import pytest
-from PIL import Image
+from PIL import Image, ImageOps
 
-from imgprocessor import settings, enums
+from imgprocessor import settings, enums, hooks
 from imgprocessor.utils import base64url_encode
 from imgprocessor import processor
 from imgprocessor.processor import ProcessorCtr
-from imgprocessor.parsers import ProcessParams
+from imgprocessor.parsers import ProcessParams, compile_params
 from imgprocessor.parsers.base import trans_uri_to_im, validate_ori_im, copy_full_img
 from imgprocessor.exceptions import ProcessLimitException
 
@@ -35,6 +36,34 @@ def test_save_img() -> None:
     ProcessorCtr.save_img_to_file(im)
 
 
+def test_save_img_in_memory() -> None:
+    im = Image.new("RGB", (200, 100))
+    content = ProcessorCtr.save_img_to_file(im)
+    assert isinstance(content, bytes)
+    with Image.open(io.BytesIO(content)) as out:
+        # 没有指定格式默认png
+        assert out.format == enums.ImageFormat.PNG.value
+        assert out.size == (200, 100)
+
+    content = ProcessorCtr.save_img_to_file(im, format="webp", use_memoryview=True)
+    assert isinstance(content, memoryview)
+    with Image.open(io.BytesIO(content)) as out:
+        assert out.format == enums.ImageFormat.WEBP.value
+
+    # 写入文件对象
+    fp = io.BytesIO()
+    assert ProcessorCtr.save_img_to_file(im, out_path=fp, format="jpeg") is None
+    fp.seek(0)
+    with Image.open(fp) as out:
+        assert out.format == enums.ImageFormat.JPEG.value
+
+    with Image.open("tests/imgs/lenna-400x225.jpg") as im:
+        fp = io.BytesIO()
+        processor.process_image_obj(im, "resize,s_100", out_path=fp)
+        content = processor.process_image_obj(im, "resize,s_100", use_memoryview=True)
+        assert fp.getvalue() == content.tobytes()
+
+
 @pytest.mark.usefixtures("clean_dir")
 def test_by_path() -> None:
     params = ProcessParams.parse_str("resize,s_100/crop,w_10,h_10")
@@ -52,7 +81,7 @@ def test_process_obj() -> None:
         processor.process_image_obj(im, params, out_path=output_path, quality=80)
 
 
-def test_limit_exception(monkeypatch, link_uri) -> None:
+def test_limit_exception(http_server) -> None:
     with pytest.raises(ProcessLimitException, match="图像文件大小不得超过"):
         with tempfile.NamedTemporaryFile() as fp:
             fp.write((settings.PROCESSOR_MAX_FILE_SIZE * 1024 * 1024 + 1) * b"b")
@@ -68,11 +97,91 @@ def test_limit_exception(monkeypatch, link_uri) -> None:
         im = Image.new("L", (20000, 20000))
         validate_ori_im(im)
 
-    monkeypatch.setattr(os.path, "getsize", lambda x: settings.PROCESSOR_MAX_FILE_SIZE * 1024 * 1024 + 1)
+    content = (settings.PROCESSOR_MAX_FILE_SIZE * 1024 * 1024 + 1) * b"b"
     with pytest.raises(ProcessLimitException, match="图像文件大小不得超过"):
-        with trans_uri_to_im(link_uri) as im:
+        with trans_uri_to_im(content) as im:
+            pass
+    with pytest.raises(ProcessLimitException, match="图像文件大小不得超过"):
+        with trans_uri_to_im(io.BytesIO(content)) as im:
             pass
 
+    with pytest.raises(ProcessLimitException, match="图像文件大小不得超过"):
+        with trans_uri_to_im(f"{http_server.url}/size/{len(content)}") as im:
+            pass
+
+
+def test_stream_limit() -> None:
+    """读取过程中解析出图像头信息后立即校验宽高，不用读取完整内容"""
+    w, h = settings.PROCESSOR_MAX_W_H + 1, 8
+    im = Image.frombytes("L", (w, h), os.urandom(w * h))
+    fp = io.BytesIO()
+    im.save(fp, format="png")
+    total = fp.tell()
+    fp.seek(0)
+    with pytest.raises(ProcessLimitException, match="图像宽和高单边像素不能超过"):
+        with trans_uri_to_im(fp):
+            pass
+    assert fp.tell() < total
+
+
+@pytest.mark.usefixtures("clean_dir")
+def test_input_in_memory() -> None:
+    img_path = "lenna-400x225.jpg"
+    with open(img_path, "rb") as f:
+        content = f.read()
+
+    expected = processor.process_image(img_path, "resize,s_100/format,png")
+    for input_data in [content, memoryview(content), bytearray(content), io.BytesIO(content)]:
+        assert processor.process_image(input_data, "resize,s_100/format,png") == expected
+
+    with trans_uri_to_im(content, use_copy=True) as im:
+        pass
+    # with之外仍然可以使用
+    assert im.format == enums.ImageFormat.JPEG.value
+    assert im.resize((40, 20)).size == (40, 20)
+
+
+@pytest.mark.usefixtures("clean_dir")
+def test_process_multi(monkeypatch) -> None:
+    params_list = [
+        "resize,s_100/format,png",
+        "resize,s_100/circle,r_20/format,png",
+        "resize,s_100/alpha,50/format,png",
+        "resize,s_100/watermark,image_d29sZi01MC5wbmc,t_50/format,png",
+        "resize,s_100/watermark,image_d29sZi01MC5wbmc,t_50/crop,w_50,h_50/format,jpeg",
+        "crop,w_200,h_200/rotate,90",
+        "circle/format,png",
+        "alpha,50/format,png",
+    ]
+    expected = [processor.process_image("lenna-400x225.jpg", p, use_draft=False) for p in params_list]
+
+    calls = []
+    ori_do_action = processor.ResizeParser.do_action
+    monkeypatch.setattr(
+        processor.ResizeParser, "do_action", lambda self, im: calls.append(self) or ori_do_action(self, im)
+    )
+    results = processor.process_image_multi("lenna-400x225.jpg", params_list)
+    assert results == expected
+    # 相同前缀的操作只执行一次
+    assert len(calls) == 1
+
+    out_paths = [f"out-{i}.png" for i in range(len(params_list))]
+    out_paths[0] = None
+    results = processor.process_image_multi("lenna-400x225.jpg", params_list, out_paths=out_paths)
+    assert results[0] == expected[0]
+    for idx, out_path in enumerate(out_paths[1:], 1):
+        assert results[idx] is None
+        with open(out_path, "rb") as f:
+            assert f.read() == expected[idx]
+
+    with pytest.raises(ValueError):
+        processor.process_image_multi("lenna-400x225.jpg", params_list, out_paths=out_paths[:1])
+
+    # RGBA图像的操作直接修改图像，多个分支共用时不能相互影响
+    params_list = ["alpha,50", "circle,r_10", "watermark,image_d29sZi01MC5wbmc", "crop,w_40/alpha,20", ""]
+    expected = [processor.process_image("wolf-50.png", p) for p in params_list]
+    assert processor.process_image_multi("wolf-50.png", params_list) == expected
+
 
 @pytest.mark.usefixtures("clean_dir")
 def test_main_color() -> None:
@@ -82,6 +191,25 @@ def test_main_color() -> None:
     assert processor.extract_main_color(img_path, delta_h=0) == "000000"
     assert processor.extract_main_color("wolf-300.png") == "040404"
 
+    with open(img_path, "rb") as f:
+        content = f.read()
+    assert processor.extract_main_color(content) == "905C4C"
+    assert processor.extract_main_color(io.BytesIO(content)) == "905C4C"
+    with Image.open(img_path) as im:
+        assert processor.extract_main_color(im) == "905C4C"
+        # 缩小后计算，颜色相近
+        big = im.resize((4000, 2250))
+    big.save("big.jpg")
+    assert processor.extract_main_color(big, sample_size=0) == "905C4C"
+    color = processor.extract_main_color("big.jpg")
+    assert all(abs(v1 - v2) <= 2 for v1, v2 in zip(bytes.fromhex(color), bytes.fromhex("905C4C")))
+
+    assert processor.extract_main_colors([img_path, content, "wolf-300.png"], max_workers=2) == [
+        "905C4C",
+        "905C4C",
+        "040404",
+    ]
+
 
 @pytest.mark.usefixtures("clean_dir")
 @pytest.mark.parametrize(
@@ -188,6 +316,75 @@ def test_action(img_name: str, param_str: dict, expected_path: str) -> None:
     compare_imgs_by_path(target_path, expected_path)
 
 
+@pytest.mark.usefixtures("clean_dir")
+@pytest.mark.parametrize(
+    "param_str,draft_size",
+    [
+        ("resize,w_200", (400, 225)),
+        ("resize,p_10", (800, 450)),
+        ("crop,x_400,y_200,w_1600,h_900/resize,l_300", (1600, 900)),
+        ("crop,g_center,w_1800,h_1800/resize,s_300/rotate,90", (1600, 900)),
+        ("resize,m_pad,w_300,h_300", (1600, 900)),
+        ("resize,m_fit,w_300,h_300", (1600, 900)),
+        ("resize,w_1200", (3200, 1800)),
+        ("rotate,90/resize,w_200", (3200, 1800)),
+    ],
+)
+def test_draft(param_str: str, draft_size: tuple) -> None:
+    img_path = "lenna-3200x1800.jpg"
+    with Image.open("lenna-400x225.jpg") as im:
+        im.resize((3200, 1800), resample=Image.LANCZOS).save(img_path, quality=90)
+
+    params = ProcessParams.parse_str(param_str)
+    with Image.open(img_path) as im:
+        ProcessorCtr.draft_img(im, params.actions)
+        assert im.size == draft_size
+
+    # draft输出图像与全分辨率解码的结果一致
+    processor.process_image(img_path, params, out_path="draft.png")
+    processor.process_image(img_path, params, out_path="normal.png", use_draft=False)
+    compare_imgs_by_path("draft.png", "normal.png")
+
+
+@pytest.mark.usefixtures("clean_dir")
+def test_draft_with_exif(img_rotate_90_with_exif: Image) -> None:
+    img_path = img_rotate_90_with_exif.filename
+    params = ProcessParams.parse_str("crop,w_200,h_100/resize,w_20")
+    with Image.open(img_path) as im:
+        # 原始图像宽高 (225, 400)
+        ProcessorCtr.draft_img(im, params.actions)
+        assert im.size == (57, 100)
+    processor.process_image(img_path, params, out_path="draft.png")
+    processor.process_image(img_path, params, out_path="normal.png", use_draft=False)
+    with Image.open("draft.png") as im:
+        assert im.size == (20, 10)
+    compare_imgs_by_path("draft.png", "normal.png")
+
+
+@pytest.mark.usefixtures("clean_dir")
+def test_orientation_with_rotate(img_rotate_90_with_exif: Image) -> None:
+    events: list = []
+    hooks.add_hook(events.append)
+    try:
+        with Image.open(img_rotate_90_with_exif.filename) as im:
+            out = ProcessorCtr.handle_img_actions(im, ProcessParams.parse_str("rotate,90/circle,r_50").actions)
+    finally:
+        hooks.remove_hook(events.append)
+    # 方向信息和旋转合并成一次transpose
+    assert [(e.stage, e.name) for e in events] == [("transpose", None), ("action", "circle")]
+    # 与先摆正、再旋转的结果一致
+    with Image.open(img_rotate_90_with_exif.filename) as im:
+        expected = ImageOps.exif_transpose(im).rotate(270, expand=True)
+        expected = ProcessorCtr.handle_img_actions(expected, ProcessParams.parse_str("circle,r_50").actions)
+    assert out.size == expected.size == (225, 400)
+    assert out.tobytes() == expected.tobytes()
+
+    # 不会修改输入图像
+    im = Image.new("RGBA", (20, 20), "red")
+    ProcessorCtr.handle_img_actions(im, ProcessParams.parse_str("circle,r_5/alpha,50").actions)
+    assert im.getpixel((0, 0)) == (255, 0, 0, 255)
+
+
 @pytest.mark.usefixtures("clean_dir")
 def test_copy_im():
     img_path = "img-with-icc.png"
@@ -200,3 +397,67 @@ def test_copy_im():
         assert out_im.size == im.size
         assert out_im.format == im.format
         assert out_im.info.get("icc_profile") == icc
+
+
+@pytest.mark.usefixtures("clean_dir")
+@pytest.mark.parametrize(
+    "img_path,param_str,expected",
+    [
+        ("lenna-400x225.jpg", "", True),
+        ("lenna-400x225.jpg", "format,jpeg", True),
+        ("lenna-400x225.jpg", "resize,w_1000/crop,w_400,h_225/rotate,360/alpha,100", True),
+        ("lenna-400x225.jpg", "resize,w_1000,limit_0", False),
+        ("lenna-400x225.jpg", "quality,90", False),
+        ("lenna-400x225.jpg", "interlace,1", False),
+        ("lenna-400x225.jpg", "format,png", False),
+        ("lenna-400x225.jpg", "gray", False),
+        ("wolf-300.png", "quality,90/format,png", True),
+        ("img-mode-p-animation.png", "", False),
+    ],
+)
+def test_can_passthrough(img_path: str, param_str: str, expected: bool) -> None:
+    params = compile_params(param_str)
+    with Image.open(img_path) as im:
+        assert ProcessorCtr.can_passthrough(im, params) is expected
+        # 传递了其他的编码参数
+        assert ProcessorCtr.can_passthrough(im, params, {"quality": 90}) is False
+        assert ProcessorCtr.can_passthrough(im, params, {"use_memoryview": True}) is expected
+
+
+@pytest.mark.usefixtures("clean_dir")
+def test_can_passthrough_interlace() -> None:
+    with Image.open("lenna-400x225.jpg") as im:
+        im.save("progressive.jpg", quality=90, progressive=True)
+    with Image.open("progressive.jpg") as im:
+        assert ProcessorCtr.can_passthrough(im, compile_params("interlace,1")) is True
+        assert ProcessorCtr.can_passthrough(im, compile_params("")) is False
+
+
+@pytest.mark.usefixtures("clean_dir")
+def test_passthrough(monkeypatch, mock_settings, img_rotate_90_with_exif: Image) -> None:
+    img_path = "lenna-400x225.jpg"
+    with open(img_path, "rb") as f:
+        data = f.read()
+    calls: list = []
+    with monkeypatch.context() as m:
+        # 直接输出原始内容，不会解码和处理图像
+        m.setattr(ProcessorCtr, "handle_img_actions", lambda *args, **kwargs: calls.append(args))
+        assert processor.process_image(img_path, "resize,w_1000") == data
+        assert processor.process_image(data, "format,jpeg", use_memoryview=True) == memoryview(data)
+        assert processor.process_image(io.BytesIO(data), "") == data
+        processor.process_image(img_path, "", out_path="out.jpg")
+        buf = io.BytesIO()
+        processor.process_image(img_path, "", out_path=buf)
+        with open("out.jpg", "rb") as f:
+            assert f.read() == buf.getvalue() == data
+        assert processor.process_image_multi(img_path, ["", "crop,w_400"]) == [data, data]
+    assert not calls
+
+    assert processor.process_image(img_path, "", passthrough=False) != data
+    # 方向信息需要旋转图像
+    with Image.open(img_rotate_90_with_exif.filename) as im:
+        assert ProcessorCtr.can_passthrough(im, compile_params("")) is False
+    monkeypatch.setattr(settings, "PROCESSOR_PASSTHROUGH", False)
+    assert processor.process_image(img_path, "") != data
+    results = processor.process_image_multi(img_path, ["", "resize,w_100"], passthrough=True)
+    assert results[0] == data and results[1] != data
@@ -2,6 +2,8 @@
 # coding=utf-8
 import pytest
 import base64
+import os
+import pathlib
 
 from imgprocessor import utils
 
@@ -22,3 +24,31 @@ def test_bse64(text: str, expected: str) -> None:
     assert "/" not in s
     assert not s.endswith("=")
     assert utils.base64url_decode(s) == text
+
+
+@pytest.mark.usefixtures("clean_dir")
+def test_iter_image_files() -> None:
+    os.makedirs("tmp/b")
+    os.makedirs("tmp/a")
+    pathlib.Path("tmp/z.jpg").write_bytes(b"not image")
+    pathlib.Path("tmp/a/x.txt").write_text("text")
+    for name in ["tmp/y.png", "tmp/b/1.png", "tmp/a/2.PNG"]:
+        pathlib.Path(name).write_bytes(pathlib.Path("wolf-50.png").read_bytes())
+
+    skipped: list = []
+    files = utils.iter_image_files("tmp", on_skip=skipped.append)
+    # 惰性遍历
+    assert next(files) == os.path.join("tmp", "y.png")
+    # 目录内按名称排序，先文件后子目录
+    assert list(files) == [os.path.join("tmp", "a", "2.PNG"), os.path.join("tmp", "b", "1.png")]
+    assert sorted(skipped) == [os.path.join("tmp", "a", "x.txt"), os.path.join("tmp", "z.jpg")]
+
+    assert list(utils.iter_image_files("tmp", extensions=["jpg"], check_magic=False)) == [os.path.join("tmp", "z.jpg")]
+    assert list(utils.iter_image_files("tmp", extensions=[".png"])) == [
+        os.path.join("tmp", "y.png"),
+        os.path.join("tmp", "a", "2.PNG"),
+        os.path.join("tmp", "b", "1.png"),
+    ]
+    assert utils.is_image_file("lenna-400x225.jpg") is True
+    assert utils.is_image_file("tmp/z.jpg") is False
+    assert utils.is_image_file("not-exists.jpg") is False